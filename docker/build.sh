@@ -18,14 +18,26 @@ set -o pipefail
 build_version=1.0-SNAPSHOT
 
 base_image_name=polardb_pg/polardb_pg_base
+# the parent of the engine release images, see the runtime target of Dockerfile.base
+base_runtime_image_name=polardb_pg/polardb_pg_base_runtime
 
 #base_cache_option="--no-cache"
 #dev_cache_option="--no-cache"
 
+# image.py passes the hash of Dockerfile.base and its inputs to skip unchanged rebuilds
+base_label_option=""
+if [ -n "${BASE_INPUTS_HASH}" ]; then
+    base_label_option="--label polardb_pg.base_inputs_hash=${BASE_INPUTS_HASH}"
+fi
+
 echo "building ${base_image_name}:${build_version}"
-docker build --network=host ${base_cache_option} -t ${base_image_name}:${build_version}  -f Dockerfile.base .
+docker build --network=host ${base_cache_option} ${base_label_option} --target base -t ${base_image_name}:${build_version}  -f Dockerfile.base .
+
+echo "building ${base_runtime_image_name}:${build_version}"
+docker build --network=host ${base_cache_option} ${base_label_option} --target runtime -t ${base_runtime_image_name}:${build_version}  -f Dockerfile.base .
 
 echo "
 base image:
 ${base_image_name}:${build_version}
+${base_runtime_image_name}:${build_version}
 "
\ No newline at end of file
@@ -0,0 +1,162 @@
+#!/usr/bin/python
+# _*_ coding:UTF-8
+#
+# Copyright (c) 2021, Alibaba Group Holding Limited
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#
+
+"""
+Measure the import time of a python script, e.g. /docker_script/entry_point.py
+which every manager operation runs in a new interpreter.
+
+    python import_time.py [-n repeat] <script>
+
+The script is loaded without running its __main__ part, each time in a new
+interpreter. The median total milliseconds and the median self and cumulative
+milliseconds of every module it imports are printed as "import_time: ..." lines,
+which image.py collects to check the total against a budget.
+"""
+
+import json
+import optparse
+import os
+# imported by runpy.run_path, loaded here so it is not counted for the script
+import pkgutil  # noqa: F401
+import runpy
+import subprocess
+import sys
+import time
+
+try:
+    import __builtin__ as builtins
+except ImportError:
+    import builtins
+
+
+def load_script(path):
+    sys.path.insert(0, os.path.dirname(os.path.abspath(path)))
+    runpy.run_path(path, run_name="import_time")
+
+
+def get_imported_module(name, new_modules):
+    if name in new_modules:
+        return name
+    # implicit relative imports of python2 are registered as package.name
+    for module in new_modules:
+        if module.endswith("." + name):
+            return module
+    return min(new_modules, key=len)
+
+
+def measure_modules(path):
+    """
+    Return the self and cumulative seconds of each module imported by a script.
+    Looking up the new modules of every import is not free, so the total is
+    measured separately by measure_total.
+    """
+    real_import = builtins.__import__
+    # seconds spent in the imports of new modules by each import in progress
+    children = [0.0]
+    modules = {}
+
+    def timed_import(name, *args, **kwargs):
+        before = set(sys.modules)
+        children.append(0.0)
+        start = time.time()
+        try:
+            return real_import(name, *args, **kwargs)
+        finally:
+            elapsed = time.time() - start
+            children_elapsed = children.pop()
+            # python2 registers failed implicit relative imports as None
+            new_modules = [
+                module
+                for module in set(sys.modules) - before
+                if sys.modules[module] is not None
+            ]
+            if new_modules:
+                module = get_imported_module(name, new_modules)
+                modules[module] = (elapsed - children_elapsed, elapsed)
+                children[-1] += elapsed
+
+    builtins.__import__ = timed_import
+    try:
+        load_script(path)
+    finally:
+        builtins.__import__ = real_import
+    return modules
+
+
+def measure_total(path):
+    start = time.time()
+    load_script(path)
+    return time.time() - start
+
+
+def run_child(mode, path):
+    p = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "--child", mode, path],
+        stdout=subprocess.PIPE,
+    )
+    output = p.communicate()[0]
+    if p.returncode != 0:
+        raise Exception("Failed to import %s" % path)
+    # the script may print while it is loaded, the result is the last line
+    return json.loads(output.decode("utf-8").strip().splitlines()[-1])
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [-n repeat] <script>")
+    parser.add_option("-n", "--repeat", type="int", default=5)
+    parser.add_option("--top", type="int", default=20)
+    parser.add_option("--child", help=optparse.SUPPRESS_HELP)
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error("a script is required")
+    path = args[0]
+
+    if options.child == "total":
+        print(json.dumps(measure_total(path)))
+        return
+    elif options.child == "modules":
+        print(json.dumps(measure_modules(path)))
+        return
+
+    totals = [run_child("total", path) for _ in range(options.repeat)]
+    runs = [run_child("modules", path) for _ in range(options.repeat)]
+    modules = {}
+    for name in runs[0]:
+        times = [run[name] for run in runs if name in run]
+        modules[name] = (
+            median([t[0] for t in times]) * 1000,
+            median([t[1] for t in times]) * 1000,
+        )
+
+    for name, (self_ms, cumulative_ms) in sorted(
+        modules.items(), key=lambda item: item[1][1], reverse=True
+    )[: options.top]:
+        print(
+            "import_time: module=%s self_ms=%.2f cumulative_ms=%.2f"
+            % (name, self_ms, cumulative_ms)
+        )
+    print(
+        "import_time: script=%s repeat=%d total_ms=%.2f"
+        % (path, options.repeat, median(totals) * 1000)
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env bash
+#
+# Copyright (c) 2021, Alibaba Group Holding Limited
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#
+# Run a small local workload against a PolarDB PG installation
+#
+#   pg_bench.sh train <base dir> <label>
+#       initdb, pgbench OLTP and a few analytical queries, used to collect
+#       the profile of an instrumented engine for PGO
+#
+#   pg_bench.sh gate <base dir> <label>
+#       initdb, fixed scale pgbench read-write and read-only runs, reports tps
+#       and latency percentiles to compare builds of an engine image
+#
+# Results are printed as "pg_bench: label=<label> key=value ..." lines which
+# image.py collects from the build output.
+
+set -e
+set -o pipefail
+
+mode=$1
+base_dir=$2
+label=${3:-$mode}
+
+bench_user=postgres
+bench_port=${PG_BENCH_PORT:-5499}
+bench_scale=${PG_BENCH_SCALE:-10}
+bench_clients=${PG_BENCH_CLIENTS:-8}
+bench_seconds=${PG_BENCH_SECONDS:-30}
+
+if [[ -z "${base_dir}" ]]; then
+    echo "usage: $0 train|gate <base dir> [label]"
+    exit 1
+fi
+
+work_dir=$(mktemp -d /tmp/pg_bench.XXXXXX)
+chown ${bench_user} ${work_dir}
+data_dir=${work_dir}/data
+
+function run_as_user() {
+    su ${bench_user} -c "export PATH=${base_dir}/bin:\$PATH LD_LIBRARY_PATH=${base_dir}/lib:\$LD_LIBRARY_PATH && $*"
+}
+
+function cleanup() {
+    run_as_user "pg_ctl -D ${data_dir} -m immediate stop" > /dev/null 2>&1 || true
+    rm -rf ${work_dir}
+}
+trap cleanup EXIT
+
+function pgbench_tps() {
+    run_as_user "pgbench -p ${bench_port} -c ${bench_clients} -j ${bench_clients} -T ${bench_seconds} $* postgres" \
+        | awk '$1 == "tps" { print $3; exit }'
+}
+
+# run pgbench with per transaction logs in ${work_dir}/<name>, print
+# "tps_<name>=... p50_<name>_ms=... p95_<name>_ms=... p99_<name>_ms=..."
+function pgbench_latency() {
+    local name=$1
+    shift
+    local log_dir=${work_dir}/${name}
+    mkdir -p ${log_dir} && chown ${bench_user} ${log_dir}
+    local tps=$(cd ${log_dir} && pgbench_tps -l "$@")
+    cat ${log_dir}/pgbench_log.* | awk '{ print $3 }' | sort -n | awk -v name=${name} -v tps=${tps} '
+        function percentile(p,    i) {
+            i = int(NR * p)
+            if (i < 1) i = 1
+            return v[i] / 1000
+        }
+        { v[NR] = $1 }
+        END {
+            printf "tps_%s=%s p50_%s_ms=%.3f p95_%s_ms=%.3f p99_%s_ms=%.3f",
+                name, tps, name, percentile(0.5), name, percentile(0.95), name, percentile(0.99)
+        }'
+}
+
+run_as_user "initdb -D ${data_dir} -U ${bench_user} --no-locale > /dev/null"
+run_as_user "pg_ctl -D ${data_dir} -l ${data_dir}/bench.log -w \
+    -o '-p ${bench_port} -k /tmp -c shared_buffers=512MB -c max_connections=100' start > /dev/null"
+run_as_user "pgbench -p ${bench_port} -i -q -s ${bench_scale} postgres > /dev/null 2>&1"
+
+case ${mode} in
+    train)
+        tps_rw=$(pgbench_tps)
+        tps_ro=$(pgbench_tps -S)
+        start=$(date +%s.%N)
+        run_as_user "psql -p ${bench_port} -q -X postgres > /dev/null" <<EOF
+select aid % 100, count(*), sum(abalance) from pgbench_accounts group by 1 order by 2 desc limit 10;
+select b.bid, avg(a.abalance) from pgbench_accounts a join pgbench_branches b using (bid) group by b.bid;
+select count(distinct tid) from pgbench_history;
+create index on pgbench_accounts (abalance);
+analyze;
+EOF
+        analytical_seconds=$(echo "$(date +%s.%N) ${start}" | awk '{ printf "%.2f", $1 - $2 }')
+        echo "pg_bench: label=${label} tps_rw=${tps_rw} tps_ro=${tps_ro} analytical_seconds=${analytical_seconds}"
+        ;;
+    gate)
+        rw=$(pgbench_latency rw)
+        ro=$(pgbench_latency ro -S)
+        echo "pg_bench: label=${label} scale=${bench_scale} clients=${bench_clients} seconds=${bench_seconds} ${rw} ${ro}"
+        ;;
+    *)
+        echo "unknown mode ${mode}"
+        exit 1
+        ;;
+esac
+
+# a fast shutdown lets the backends of an instrumented engine write their profile
+run_as_user "pg_ctl -D ${data_dir} -m fast -w stop > /dev/null"
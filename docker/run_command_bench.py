@@ -0,0 +1,145 @@
+#!/usr/bin/python
+# _*_ coding:UTF-8
+#
+# Copyright (c) 2021, Alibaba Group Holding Limited
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#
+
+"""
+Compare pg_common.run_command with the select polling loop of the former
+exec_command. It is a development tool, not shipped in the manager image, run it
+in a manager container:
+
+    docker run --rm -v $PWD/docker/run_command_bench.py:/run_command_bench.py \
+        <manager image> python /run_command_bench.py [-n repeat]
+
+Each case runs a command with both runners and prints the median wall and cpu
+milliseconds of the runner process as "run_command_bench: ..." lines:
+
+    exit        a command which exits at once
+    daemon      a command which leaves a process holding its stdout open, like
+                pg_ctl start, the polling loop only notices the exit at its next
+                interval
+    output      a command which prints 32MB, like pg_controldata or
+                polar_basebackup -P on a large instance
+"""
+
+import errno
+import fcntl
+import logging
+import optparse
+import os
+import resource
+import select
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.getenv("PYTHONPATH", "/docker_script"))
+
+from pg_utils.logger import logger  # noqa: E402
+from pg_utils.pg_common import run_command  # noqa: E402
+
+CASES = [
+    ("exit", "true"),
+    ("daemon", "(sleep 2 &); sleep 0.25"),
+    ("output", "head -c 33554432 /dev/zero | tr '\\0' x"),
+]
+
+
+def poll_command(cmd, timeout=180):
+    """The loop of the former exec_command: select at an interval doubling from
+    0.1s to 1s, read 1024 bytes at a time and concatenate the output."""
+    interval = 0.1
+    deadline = time.time() + timeout
+    pipe = subprocess.Popen(
+        cmd,
+        shell=True,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        close_fds=True,
+    )
+    pipe_fd = pipe.stdout.fileno()
+    fcntl.fcntl(pipe_fd, fcntl.F_SETFL, os.O_NONBLOCK)
+    output = b""
+    while time.time() < deadline:
+        if pipe.poll() is not None:
+            while True:
+                try:
+                    data = os.read(pipe_fd, 1024)
+                except OSError as e:
+                    if e.errno != errno.EAGAIN:
+                        raise
+                    break
+                if not data:
+                    break
+                output += data
+            pipe.stdout.close()
+            return pipe.returncode, output
+        rlist, _, _ = select.select([pipe_fd], [], [], interval)
+        interval = min(interval * 2, 1)
+        if rlist:
+            try:
+                output += os.read(pipe_fd, 1024)
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+    pipe.kill()
+    return 0x7F, "time out"
+
+
+def get_cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def measure(runner, cmd):
+    start_time = time.time()
+    start_cpu = get_cpu_time()
+    status, output = runner(cmd)
+    if status != 0:
+        raise Exception("Run %s error: %s" % (cmd, output[-1024:]))
+    return time.time() - start_time, get_cpu_time() - start_cpu, len(output)
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [-n repeat]")
+    parser.add_option("-n", "--repeat", type="int", default=5)
+    options, _ = parser.parse_args()
+
+    # the runners are measured, not the logging of run_command
+    logger.setLevel(logging.WARNING)
+
+    for case, cmd in CASES:
+        for name, runner in (("poll", poll_command), ("run_command", run_command)):
+            runs = [measure(runner, cmd) for _ in range(options.repeat)]
+            print(
+                "run_command_bench: runner=%s case=%s repeat=%d output_bytes=%d"
+                " wall_ms=%.1f cpu_ms=%.1f"
+                % (
+                    name,
+                    case,
+                    options.repeat,
+                    runs[0][2],
+                    median([run[0] for run in runs]) * 1000,
+                    median([run[1] for run in runs]) * 1000,
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -18,15 +18,37 @@
 #
 
 import argparse
+import collections
+import contextlib
+import fcntl
+import fnmatch
+import glob
+import gzip
+import hashlib
 import json
 import logging
+import multiprocessing
 import os
 import subprocess
 import sys
+import tarfile
 import shutil
 import yaml
 import datetime
 import re
+import threading
+import time
+import zlib
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    from shlex import quote as shell_quote
+except ImportError:
+    from pipes import quote as shell_quote
 
 engine_images = {}
 manager_images = {}
@@ -37,7 +59,7 @@ logger = logging.getLogger("polardb_pg")
 logger.setLevel(logging.DEBUG)
 
 formatter = logging.Formatter(
-    "%(asctime)s - %(levelname)s - %(filename)s:%(lineno)d - %(message)s"
+    "%(asctime)s - %(levelname)s - %(threadName)s - %(filename)s:%(lineno)d - %(message)s"
 )
 
 sh = logging.StreamHandler(sys.stdout)
@@ -61,17 +83,225 @@ parser.add_argument(
     default=False,
     help="enable docker build cache",
 )
+parser.add_argument(
+    "-j",
+    "--jobs",
+    type=int,
+    default=0,
+    help="max number of images built concurrently, 0 means no limit",
+)
+parser.add_argument(
+    "-k",
+    "--keep_going",
+    action="store_true",
+    default=False,
+    help="keep building independent images after a build failed",
+)
+parser.add_argument(
+    "--push_jobs",
+    type=int,
+    default=2,
+    help="max number of images pushed concurrently",
+)
+parser.add_argument(
+    "--ccache",
+    action="store_true",
+    default=False,
+    help="compile engines with ccache kept in a buildkit cache mount per branch",
+)
+parser.add_argument(
+    "--bench_gate",
+    action="store_true",
+    default=False,
+    help="benchmark built engine images with pgbench and gate them on regressions",
+)
+parser.add_argument(
+    "--startup_bench",
+    type=int,
+    default=0,
+    metavar="N",
+    help="start each built engine image N times and report the time until it is ready",
+)
+parser.add_argument(
+    "--image_sizes",
+    action="store_true",
+    default=False,
+    help="measure the compressed layer sizes of built images with docker save and "
+    "the pull delta against the last build, written to the result file with "
+    "--result_details",
+)
+parser.add_argument(
+    "--result_details",
+    action="store_true",
+    default=False,
+    help="list every image in the result file with its status, build duration, push "
+    "and sizes instead of only the names of the built images",
+)
+parser.add_argument(
+    "--compare",
+    type=int,
+    default=0,
+    metavar="N",
+    help="compare the time of each build stage with the last N build reports",
+)
+parser.add_argument(
+    "--regression_threshold",
+    type=float,
+    default=20,
+    help="percent a stage may be slower than in the last build reports",
+)
+parser.add_argument(
+    "-r",
+    "--reuse",
+    action="store_true",
+    default=False,
+    help="reuse a previously built image if none of its inputs changed",
+)
 
 today = datetime.datetime.now()
 
 pfsd_rpm = ""
 
+git_cache_dir = os.path.expanduser("~/.cache/polardb_pg_image/git")
+git_cache_max_age_days = 30
+git_cache_max_size_mb = 10240
+
+# fingerprint of image inputs -> previously built image
+build_manifest_file = os.path.expanduser("~/.cache/polardb_pg_image/build_manifest.json")
+build_manifest_max_entries = 10
+# image tag -> docker image id of the last push
+push_record_file = os.path.expanduser("~/.cache/polardb_pg_image/push_record.json")
+push_retries = 3
+push_retry_delay = 5
+# build_image_repo -> layer sizes of the last built image
+size_history_file = os.path.expanduser("~/.cache/polardb_pg_image/size_history.json")
+json_store_lock = threading.Lock()
+
+# downloaded rpms by sha256, with an index by url
+rpm_cache_dir = os.path.expanduser("~/.cache/polardb_pg_image/rpm")
+# fetch rpms from this directory instead of their urls, e.g. for offline builds
+rpm_source_dir = ""
+# rpms fetched concurrently if --jobs is not set
+rpm_fetch_jobs = 4
+
+# gzip logs of the docker builds are written here
+build_log_dir = "build_logs"
+# number of output lines kept to report a failed command
+output_tail_lines = 100
+
+# json reports of the time spent in each build stage are written here
+build_report_dir = "build_reports"
+# stages slower than the history by less than this are never reported as regressed
+regression_min_seconds = 5
+
+# make jobs of an engine build, 0 derives them from the cpus and memory
+build_jobs = 0
+build_job_memory_gb = 2
+# build args which do not change the built image
+fingerprint_ignored_build_args = ("ENGINE_IMAGE_FULL_NAME", "BUILD_JOBS", "USE_CCACHE")
+# keys of an image config which change the built image, e.g. not push or enable
+fingerprint_config_keys = (
+    "id",
+    "type",
+    "build_image_name",
+    "build_image_dockerfile",
+    "engine_repo",
+    "engine_branch",
+    "engine_config_template",
+    "engine_release_date",
+    "engine_image_id",
+    "pgo",
+    "debuginfo",
+    "polardb_rpm",
+    "polardb_rpm_sha256",
+    "pfsd_rpm",
+)
+
+# pgbench gate of engine images, enabled by --bench_gate, see docker/pg_bench.sh
+bench_gate = {
+    # percent tps may drop or latency may rise against the last accepted image
+    "threshold": 10,
+    # fail: fail the build, no_push: keep the image but do not push it
+    "policy": "fail",
+    "scale": 10,
+    "clients": 8,
+    "seconds": 60,
+    # build_image_repo -> results of the last accepted image
+    "history": "~/.cache/polardb_pg_image/bench_history.json",
+}
+bench_gate_lock = threading.Lock()
+# cold start benchmark of engine images, enabled by --startup_bench
+startup_bench = {
+    # seconds a container may take to become ready
+    "timeout": 300,
+    # env of a local storage instance which supervisor.py installs with
+    # install_normal_instance before it starts the postmaster
+    "env": {
+        "cluster_custins_info": json.dumps({"rw": {"1": {}}}),
+        "storage_type": "local",
+        "on_pfs": "False",
+        # install_instance.py runs install_normal_instance for a non empty dma_role
+        "dma_role": "none",
+        "service_type": "rw",
+        "ins_id": "1",
+        "logic_ins_id": "1",
+        "port": json.dumps({"1": {"access_port": [5432]}}),
+        "create_tablespace_env": json.dumps({"tablespace_path": "/disk1/tmp"}),
+        "mycnf_dict": json.dumps(
+            {
+                "huge_pages": "off",
+                "shared_buffers": "'128MB'",
+                "polar_enable_shared_storage_mode": "off",
+            }
+        ),
+    },
+}
+# time of each startup stage is measured from the docker run of the container
+startup_bench_stages = ("container_start", "install_done", "postmaster_launched", "ready")
+# run in the container, prints when the instance reaches each stage after container_start
+startup_watch_script = """
+now() { date +%s.%N; }
+until [ "$(cat /data/ins_install_step 2>/dev/null)" = done ]; do sleep 0.02; done
+echo install_done=$(now)
+until [ -f /data/postmaster.pid ]; do sleep 0.02; done
+echo postmaster_launched=$(now)
+until [ "$(tail -n 1 /data/postmaster.pid 2>/dev/null)" = ready ]; do sleep 0.02; done
+echo ready=$(now)
+"""
+# import time of /docker_script/entry_point.py in manager images, see docker/import_time.py
+import_time_budget = {
+    # median milliseconds entry_point.py may take to import, 0 disables the check
+    "total_ms": 500,
+    "repeat": 5,
+}
+# POLARDB_BASE_DIR of the engine images
+engine_base_dir = "/u01/polardb_pg"
+
+# keep in sync with docker/build.sh
+base_image_name = "polardb_pg/polardb_pg_base:1.0-SNAPSHOT"
+# the runtime target of Dockerfile.base, the parent of the engine release images
+base_runtime_image_name = "polardb_pg/polardb_pg_base_runtime:1.0-SNAPSHOT"
+base_inputs_hash_label = "polardb_pg.base_inputs_hash"
+
+# minimal per image docker build contexts are staged here
+build_context_dir = ".build_context"
+
+output_lock = threading.Lock()
+
+# set up in main, images are pushed in the background as soon as they are built
+push_queue = None
+
+# engine source checkouts shared by images, (repo, branch, commit) -> SourceCheckout
+source_checkouts = {}
+source_checkouts_lock = threading.Lock()
+
 code_branch_pattern = r"CodeBranch:\s+(\S+?)\s+"
 pfsd_pattern = r"PFSDVersion:\s+(\S+?)\s+"
 
 
 class Image:
     def __init__(self, config):
+        self.config = config
         self.id = config.get("id")
         self.type = config.get("type")
 
@@ -98,8 +328,22 @@ class Image:
         self.build_image_release_name = ""
         self.engine_source_relative_dir = "polardb_pg-%s" % self.engine_branch
         self.engine_source_dir = os.path.join(root_dir, self.engine_source_relative_dir)
+        self.engine_mirror_dir = ""
+        self.engine_commit = ""
+        self.fingerprint = ""
+        self.build_jobs = 1
+        self.pgo = config.get("pgo", False)
+        # also build the debuginfo target of the Dockerfile as <tag>-debuginfo
+        self.debuginfo = config.get("debuginfo", False)
+        self.debuginfo_image_name = ""
+        # measured sizes of the built image, see report_image_sizes
+        self.sizes = {}
+        # rejected by the pgbench gate under the no_push policy, it is neither
+        # pushed nor are images based on it built
+        self.gated = False
 
         self.polardb_rpm = config.get("polardb_rpm", "")
+        self.polardb_rpm_sha256 = config.get("polardb_rpm_sha256", "")
         self.pfsd_rpm = config.get("pfsd_rpm", "")
 
     def set_engine_branch(self, engine_branch):
@@ -126,28 +370,237 @@ def exec_command(command, cwd=None):
         raise e
 
 
-def exec_command_verbose(command, cwd=None):
+def exec_command_verbose(command, cwd=None, log_name=None, watchers=None):
+    """
+    Stream the output of a command to stdout and, if log_name is given, to a gzip
+    log under build_logs. Only the last output lines are kept in memory, they are
+    returned and reported on failure. Each watcher is called with every line.
+    """
     logger.info("Execute command: %s", command)
-    result = []
+    tail = collections.deque(maxlen=output_tail_lines)
+    # prefix output lines with the image id when images are built concurrently
+    prefix = b""
+    thread_name = threading.current_thread().name
+    if thread_name != "MainThread":
+        prefix = ("[%s] " % thread_name).encode("utf-8")
+    stdout = getattr(sys.stdout, "buffer", sys.stdout)
+    log_fd = None
     try:
+        if log_name:
+            log_dir = os.path.join(root_dir, build_log_dir)
+            if not os.path.exists(log_dir):
+                os.makedirs(log_dir)
+            log_path = os.path.join(
+                log_dir,
+                "%s-%s.log.gz"
+                % (log_name, datetime.datetime.now().strftime("%Y%m%d%H%M%S")),
+            )
+            logger.info("Output of the command is logged to %s", log_path)
+            log_fd = gzip.open(log_path, "wb")
         p = subprocess.Popen(
-            command, cwd=cwd, shell=True, stdout=subprocess.PIPE, bufsize=1
+            command,
+            cwd=cwd,
+            shell=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            bufsize=1,
         )
         for line in iter(p.stdout.readline, b""):
-            sys.stdout.write(line)
-            sys.stdout.flush()
-            result.append(line)
+            with output_lock:
+                stdout.write(prefix)
+                stdout.write(line)
+                sys.stdout.flush()
+            if log_fd is not None:
+                log_fd.write(line)
+            tail.append(line)
+            if watchers:
+                text = line.decode("utf-8", "replace").rstrip()
+                for watcher in watchers:
+                    watcher(text)
         p.wait()
         if p.returncode != 0:
             raise Exception(
-                "execute command failed, command: %s, return code %s"
-                % (command, p.returncode)
+                "execute command failed, command: %s, return code %s, last output:\n%s"
+                % (
+                    command,
+                    p.returncode,
+                    b"".join(tail).decode("utf-8", "replace").rstrip(),
+                )
             )
     except Exception as e:
         logger.exception(e)
         raise e
-
-    return "".join(result).strip()
+    finally:
+        if log_fd is not None:
+            log_fd.close()
+
+    return b"".join(tail).strip()
+
+
+class DockerStepTimer:
+    """
+    Time the steps of a docker build from its output, for the classic builder
+    ("Step 3/20 : RUN ...") and for buildkit ("#7 [builder 3/9] RUN ...", "#7 DONE 1.2s").
+    """
+
+    classic_step_pattern = re.compile(r"^Step \d+/\d+ : (.*)$")
+    buildkit_step_pattern = re.compile(r"^#(\d+) (\[.*)$")
+    buildkit_done_pattern = re.compile(r"^#(\d+) (?:DONE|CACHED)(?: (\d+\.?\d*)s)?$")
+
+    def __init__(self):
+        # [step, seconds] in the order the steps started
+        self.steps = []
+        self.buildkit_steps = {}
+        self.classic_step = None
+        self.classic_step_start = None
+
+    def __call__(self, line):
+        now = time.time()
+        match = self.classic_step_pattern.match(line)
+        if match:
+            self.finish(now)
+            self.classic_step = [match.group(1)[:100], 0.0]
+            self.classic_step_start = now
+            self.steps.append(self.classic_step)
+            return
+        match = self.buildkit_step_pattern.match(line)
+        if match and match.group(1) not in self.buildkit_steps:
+            step = [match.group(2)[:100], 0.0]
+            self.buildkit_steps[match.group(1)] = step
+            self.steps.append(step)
+            return
+        match = self.buildkit_done_pattern.match(line)
+        if match and match.group(1) in self.buildkit_steps:
+            self.buildkit_steps[match.group(1)][1] = float(match.group(2) or 0)
+
+    def finish(self, now=None):
+        if self.classic_step is not None:
+            self.classic_step[1] = (now or time.time()) - self.classic_step_start
+            self.classic_step = None
+
+    def log_slowest(self, image_id, count=5):
+        slowest = sorted(self.steps, key=lambda step: step[1], reverse=True)[:count]
+        for step, seconds in slowest:
+            logger.info("Image %s step took %.1fs: %s", image_id, seconds, step)
+
+
+class BuildReport:
+    """
+    Seconds spent in each stage of a run, keyed "<image id>.<stage>" or "<stage>",
+    stages may run in the worker threads of concurrent builds.
+    """
+
+    def __init__(self):
+        self.start_time = time.time()
+        self.stages = {}
+        self.docker_steps = {}
+        self.image_info = {}
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name, image_id=None):
+        if image_id:
+            name = "%s.%s" % (image_id, name)
+        start = time.time()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.stages[name] = self.stages.get(name, 0.0) + time.time() - start
+
+    def add_docker_steps(self, image_id, steps):
+        with self.lock:
+            self.docker_steps[image_id] = steps
+
+    def set_image_info(self, image_id, key, value):
+        with self.lock:
+            self.image_info.setdefault(image_id, {})[key] = value
+
+    def to_dict(self, tasks):
+        return {
+            "start_time": datetime.datetime.fromtimestamp(self.start_time).strftime(
+                "%Y-%m-%d %H:%M:%S"
+            ),
+            "duration": time.time() - self.start_time,
+            "stages": self.stages,
+            "docker_steps": self.docker_steps,
+            "image_info": self.image_info,
+            "images": dict(
+                (
+                    task.image.id,
+                    {
+                        "name": task.image_name,
+                        "status": task.status,
+                        "duration": task.duration(),
+                        "push": task.push_status,
+                        "gated": task.image.gated,
+                    },
+                )
+                for task in tasks
+            ),
+        }
+
+
+build_report = BuildReport()
+
+
+def write_build_report(tasks):
+    report_dir = os.path.join(root_dir, build_report_dir)
+    if not os.path.exists(report_dir):
+        os.makedirs(report_dir)
+    report_file = os.path.join(
+        report_dir,
+        "build-%s.json"
+        % datetime.datetime.fromtimestamp(build_report.start_time).strftime(
+            "%Y%m%d%H%M%S"
+        ),
+    )
+    report = build_report.to_dict(tasks)
+    with open(report_file, "w") as fd:
+        json.dump(report, fd, indent=4, sort_keys=True)
+    logger.info("Build report is written to %s", report_file)
+    return report_file, report
+
+
+def compare_build_reports(report_file, report, count, threshold):
+    """
+    Return the stages which took threshold percent longer than the median of the
+    same stage in the last count reports before report_file.
+    """
+    history = {}
+    report_files = sorted(
+        glob.glob(os.path.join(os.path.dirname(report_file), "build-*.json"))
+    )
+    report_files = [f for f in report_files if f < report_file][-count:]
+    for history_file in report_files:
+        try:
+            with open(history_file) as fd:
+                stages = json.load(fd).get("stages", {})
+        except ValueError:
+            logger.warn("Ignore corrupted build report %s", history_file)
+            continue
+        for stage, seconds in stages.items():
+            history.setdefault(stage, []).append(seconds)
+
+    regressions = []
+    for stage, seconds in sorted(report["stages"].items()):
+        if stage not in history:
+            continue
+        durations = sorted(history[stage])
+        baseline = durations[len(durations) // 2]
+        # ignore jitter of short stages
+        if seconds - baseline < regression_min_seconds:
+            continue
+        if seconds > baseline * (1 + threshold / 100.0):
+            logger.warn(
+                "Stage %s regressed: %.1fs, median of the last %d builds %.1fs",
+                stage,
+                seconds,
+                len(durations),
+                baseline,
+            )
+            regressions.append(stage)
+    return regressions
 
 
 def get_git_global_config(key):
@@ -170,53 +623,799 @@ def get_git_current_repo_url(repo_path):
     return exec_command(command, cwd=repo_path)
 
 
+def get_dir_size(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def get_git_mirror_dir(repo_url):
+    name = re.sub(r"[^\w.-]", "_", repo_url.rstrip("/").split("/")[-1])
+    digest = hashlib.sha1(repo_url.encode("utf-8")).hexdigest()[:12]
+    return os.path.join(git_cache_dir, "%s-%s" % (name, digest))
+
+
+@contextlib.contextmanager
+def git_mirror_lock(mirror_dir, blocking=True):
+    """
+    Lock a mirror against other threads and other image.py processes. The mtime
+    of the lock file records when the mirror was used last.
+    """
+    if not os.path.exists(git_cache_dir):
+        os.makedirs(git_cache_dir)
+    lock_fd = open("%s.lock" % mirror_dir, "a")
+    try:
+        flags = fcntl.LOCK_EX
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+        fcntl.flock(lock_fd, flags)
+        yield lock_fd
+    finally:
+        lock_fd.close()
+
+
+def update_git_mirror(repo_url):
+    mirror_dir = get_git_mirror_dir(repo_url)
+    with git_mirror_lock(mirror_dir) as lock_fd:
+        if not os.path.exists(os.path.join(mirror_dir, "HEAD")):
+            if os.path.exists(mirror_dir):
+                shutil.rmtree(mirror_dir)
+            # mirror branches and tags only, not the pull request refs of github
+            exec_command("git init --bare %s" % mirror_dir)
+            exec_command("git remote add origin %s" % repo_url, cwd=mirror_dir)
+            exec_command(
+                "git config remote.origin.fetch '+refs/heads/*:refs/heads/*'",
+                cwd=mirror_dir,
+            )
+            exec_command(
+                "git config --add remote.origin.fetch '+refs/tags/*:refs/tags/*'",
+                cwd=mirror_dir,
+            )
+        # only the commits missing in the mirror are transferred
+        exec_command("git fetch --prune origin", cwd=mirror_dir)
+        os.utime(lock_fd.name, None)
+    return mirror_dir
+
+
+def evict_git_mirrors():
+    if not os.path.isdir(git_cache_dir):
+        return
+    mirrors = []
+    for name in os.listdir(git_cache_dir):
+        mirror_dir = os.path.join(git_cache_dir, name)
+        if not os.path.isdir(mirror_dir):
+            continue
+        lock_file = "%s.lock" % mirror_dir
+        if os.path.exists(lock_file):
+            last_used = os.path.getmtime(lock_file)
+        else:
+            last_used = os.path.getmtime(mirror_dir)
+        mirrors.append((last_used, mirror_dir, get_dir_size(mirror_dir)))
+
+    # evict the least recently used mirrors first
+    mirrors.sort()
+    total_size = sum(size for _, _, size in mirrors)
+    max_size = git_cache_max_size_mb * 1024 * 1024
+    for last_used, mirror_dir, size in mirrors:
+        expired = time.time() - last_used > git_cache_max_age_days * 86400
+        if not expired and total_size <= max_size:
+            break
+        try:
+            with git_mirror_lock(mirror_dir, blocking=False):
+                logger.info(
+                    "Evict git mirror %s, size %d MB", mirror_dir, size / 1024 / 1024
+                )
+                shutil.rmtree(mirror_dir)
+                total_size -= size
+        except IOError:
+            logger.info("Git mirror %s is in use, skip evicting it", mirror_dir)
+
+
+class SourceCheckout:
+    def __init__(self, relative_dir):
+        self.relative_dir = relative_dir
+        self.dir = os.path.join(root_dir, relative_dir)
+        self.refs = 0
+        self.ready = False
+        self.lock = threading.Lock()
+
+
+def resolve_engine_commit(image):
+    with build_report.stage("fetch", image.id):
+        image.engine_mirror_dir = update_git_mirror(image.engine_repo)
+        image.engine_commit = exec_command(
+            "git rev-parse --verify %s^{commit}" % image.engine_branch,
+            cwd=image.engine_mirror_dir,
+        )
+    return image.engine_commit
+
+
+def acquire_engine_source(image):
+    """
+    Check out the engine source for an image. Images built from the same repo,
+    branch and commit share one checkout, the last one to release removes it.
+    """
+    key = (image.engine_repo, image.engine_branch, image.engine_commit)
+    with source_checkouts_lock:
+        checkout = source_checkouts.get(key)
+        if checkout is None:
+            checkout = SourceCheckout(
+                "polardb_pg-%s-%s" % (image.engine_branch, image.engine_commit[:8])
+            )
+            source_checkouts[key] = checkout
+        checkout.refs += 1
+    image.engine_source_relative_dir = checkout.relative_dir
+    image.engine_source_dir = checkout.dir
+
+    with checkout.lock:
+        if not checkout.ready:
+            if os.path.exists(checkout.dir):
+                shutil.rmtree(checkout.dir)
+            with build_report.stage("clone", image.id):
+                clone_and_checkout(image)
+            with build_report.stage("submodule_init", image.id):
+                submodule_init(image)
+            checkout.ready = True
+
+
+def release_engine_source(image):
+    key = (image.engine_repo, image.engine_branch, image.engine_commit)
+    with source_checkouts_lock:
+        checkout = source_checkouts[key]
+        checkout.refs -= 1
+        if checkout.refs > 0:
+            return
+        del source_checkouts[key]
+    if os.path.exists(checkout.dir):
+        shutil.rmtree(checkout.dir)
+
+
 def clone_and_checkout(image):
-    clone_command = "git clone %s --branch %s --depth 1 %s" % (
-        image.engine_repo,
-        image.engine_branch,
+    # objects are borrowed from the local mirror, nothing is fetched from the remote
+    clone_command = "git clone --shared --no-checkout %s %s" % (
+        image.engine_mirror_dir,
         image.engine_source_dir,
     )
     exec_command(clone_command)
+    exec_command(
+        "git remote set-url origin %s" % image.engine_repo, cwd=image.engine_source_dir
+    )
+    exec_command(
+        "git checkout -B %s %s" % (image.engine_branch, image.engine_commit),
+        cwd=image.engine_source_dir,
+    )
 
 
 def submodule_init(image):
-    init_command = "git -C %s submodule update --init" % image.engine_source_dir
-    exec_command(init_command)
+    if not os.path.exists(os.path.join(image.engine_source_dir, ".gitmodules")):
+        return
+    output = exec_command(
+        r"git config -f .gitmodules --get-regexp '^submodule\..*\.url$'",
+        cwd=image.engine_source_dir,
+    )
+    for line in output.splitlines():
+        key, url = line.split(None, 1)
+        path = exec_command(
+            "git config -f .gitmodules --get %s" % re.sub(r"\.url$", ".path", key),
+            cwd=image.engine_source_dir,
+        )
+        # relative submodule urls are resolved by git against the engine repo
+        reference_option = ""
+        if "://" in url or "@" in url:
+            reference_option = "--reference %s" % update_git_mirror(url)
+        init_command = "git -C %s submodule update --init %s -- %s" % (
+            image.engine_source_dir,
+            reference_option,
+            path,
+        )
+        exec_command(init_command)
+
+
+def get_file_sha256(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as fd:
+        for chunk in iter(lambda: fd.read(1024 * 1024), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def hash_tree(path):
+    sha = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        # same files as excluded by .dockerignore
+        dirs[:] = sorted(d for d in dirs if d not in (".git", "__pycache__"))
+        for name in sorted(files):
+            if name.endswith(".pyc"):
+                continue
+            file_path = os.path.join(root, name)
+            if os.path.islink(file_path):
+                content = os.readlink(file_path)
+            else:
+                content = get_file_sha256(file_path)
+            relative_path = os.path.relpath(file_path, path)
+            sha.update(("%s %s\n" % (relative_path, content)).encode("utf-8"))
+    return sha.hexdigest()
+
+
+def parse_dockerfile(dockerfile):
+    """
+    Return the (instruction, arguments) of a Dockerfile, continuation lines are joined.
+    """
+    instructions = []
+    line_buffer = ""
+    with open(dockerfile) as fd:
+        for line in fd:
+            line = line.strip()
+            # comments and empty lines are allowed inside continuation lines
+            if not line or line.startswith("#"):
+                continue
+            if line.endswith("\\"):
+                line_buffer += line[:-1] + " "
+                continue
+            line_buffer += line
+            parts = line_buffer.split(None, 1)
+            instructions.append((parts[0].upper(), parts[1] if len(parts) > 1 else ""))
+            line_buffer = ""
+    if line_buffer:
+        parts = line_buffer.split(None, 1)
+        instructions.append((parts[0].upper(), parts[1] if len(parts) > 1 else ""))
+    return instructions
+
+
+def get_dockerfile_stages(dockerfile):
+    """
+    Return the names of the build stages of a Dockerfile.
+    """
+    stages = []
+    for instruction, arguments in parse_dockerfile(dockerfile):
+        words = arguments.split()
+        if instruction == "FROM" and len(words) >= 3 and words[-2].upper() == "AS":
+            stages.append(words[-1])
+    return stages
+
+
+def substitute_dockerfile_variables(value, variables):
+    def replace(match):
+        name = match.group(1) or match.group(3)
+        default = match.group(2) or ":-"
+        return variables.get(name) or default[2:]
+
+    return re.sub(r"\$\{(\w+)(:-[^}]*)?\}|\$(\w+)", replace, value)
+
+
+def get_dockerfile_copy_sources(dockerfile, build_args=None):
+    """
+    Return the context paths a Dockerfile COPYs or ADDs, with ARG and ENV
+    variables substituted. Copies from other stages and remote ADDs are skipped.
+    """
+    build_args = dict(build_args or [])
+    variables = {}
+    sources = []
+    for instruction, arguments in parse_dockerfile(dockerfile):
+        if instruction == "FROM":
+            # ARGs are scoped to a build stage
+            variables = {}
+        elif instruction in ("ARG", "ENV"):
+            words = re.findall(r'(?:[^\s"]|"[^"]*")+', arguments)
+            if instruction == "ENV" and "=" not in words[0]:
+                # legacy form: ENV key value
+                pairs = [(words[0], arguments[len(words[0]) :].strip())]
+            else:
+                pairs = [word.split("=", 1) + [""] for word in words]
+            for name, value in [pair[:2] for pair in pairs]:
+                value = substitute_dockerfile_variables(value.strip('"'), variables)
+                if instruction == "ARG" and name in build_args:
+                    value = build_args[name]
+                variables[name] = value
+        elif instruction in ("COPY", "ADD"):
+            flags = []
+            while arguments.startswith("--"):
+                flag, arguments = (arguments.split(None, 1) + [""])[:2]
+                flags.append(flag)
+            if any(flag.startswith("--from") for flag in flags):
+                continue
+            if arguments.startswith("["):
+                paths = json.loads(arguments)
+            else:
+                paths = arguments.split()
+            for source in paths[:-1]:
+                if instruction == "ADD" and "://" in source:
+                    continue
+                sources.append(substitute_dockerfile_variables(source, variables))
+    return sources
+
+
+def hash_docker_inputs(dockerfile, context_dir, build_args=None, extra_sources=None):
+    """
+    Hash a Dockerfile together with every context file it copies in, and the
+    extra_sources the build depends on without copying them, e.g. its script.
+    """
+    sha = hashlib.sha256()
+    sha.update(get_file_sha256(dockerfile).encode("utf-8"))
+    sources = get_dockerfile_copy_sources(dockerfile, build_args)
+    for source in sources + list(extra_sources or []):
+        for path in sorted(glob.glob(os.path.join(context_dir, source))):
+            if os.path.isdir(path):
+                content = hash_tree(path)
+            else:
+                content = get_file_sha256(path)
+            relative_path = os.path.relpath(path, context_dir)
+            sha.update(("%s %s\n" % (relative_path, content)).encode("utf-8"))
+    return sha.hexdigest()
+
+
+def load_dockerignore(context_dir):
+    patterns = []
+    dockerignore = os.path.join(context_dir, ".dockerignore")
+    if os.path.exists(dockerignore):
+        with open(dockerignore) as fd:
+            for line in fd:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                exclude = not line.startswith("!")
+                pattern = os.path.normpath(line.lstrip("!").strip("/"))
+                patterns.append((pattern, exclude))
+    return patterns
+
+
+def is_dockerignored(relative_path, patterns):
+    # the last matching pattern wins, like docker does
+    ignored = False
+    for pattern, exclude in patterns:
+        if fnmatch.fnmatch(relative_path, pattern) or (
+            pattern.startswith("**/") and fnmatch.fnmatch(relative_path, pattern[3:])
+        ):
+            ignored = exclude
+    return ignored
+
+
+def get_context_size(context_dir, patterns):
+    total = 0
+    for root, dirs, files in os.walk(context_dir):
+        relative_root = os.path.relpath(root, context_dir)
+        if relative_root == ".":
+            relative_root = ""
+        dirs[:] = [
+            d
+            for d in dirs
+            if not is_dockerignored(os.path.join(relative_root, d), patterns)
+        ]
+        for name in files:
+            if is_dockerignored(os.path.join(relative_root, name), patterns):
+                continue
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def link_into_context(path, context_dir, patterns):
+    relative_path = os.path.relpath(path, root_dir)
+    if is_dockerignored(relative_path, patterns):
+        return
+    target = os.path.join(context_dir, relative_path)
+    if os.path.isdir(path) and not os.path.islink(path):
+        if not os.path.exists(target):
+            os.makedirs(target)
+        for name in sorted(os.listdir(path)):
+            link_into_context(os.path.join(path, name), context_dir, patterns)
+        return
+    if os.path.lexists(target):
+        return
+    if not os.path.exists(os.path.dirname(target)):
+        os.makedirs(os.path.dirname(target))
+    if os.path.islink(path):
+        os.symlink(os.readlink(path), target)
+        return
+    try:
+        os.link(path, target)
+    except OSError:
+        # different file systems or hardlinks not permitted
+        shutil.copy2(path, target)
+
+
+def stage_build_context(image, build_args, extra_files=None):
+    """
+    Hardlink the files the Dockerfile of an image copies in into a minimal build
+    context, instead of sending the whole repository to the docker daemon.
+    extra_files are (path, relative path in the context) pairs copied in over the
+    files of the repository, so concurrent builds do not write into the tree.
+    """
+    patterns = load_dockerignore(root_dir)
+    context_dir = os.path.join(root_dir, build_context_dir, image.id)
+    if os.path.exists(context_dir):
+        shutil.rmtree(context_dir)
+    os.makedirs(context_dir)
+
+    dockerfile = image.build_image_dockerfile
+    sources = get_dockerfile_copy_sources(os.path.join(root_dir, dockerfile), build_args)
+    for source in sources:
+        paths = glob.glob(os.path.join(root_dir, source))
+        if not paths:
+            raise Exception("Can not find %s copied by %s" % (source, dockerfile))
+        for path in paths:
+            link_into_context(path, context_dir, patterns)
+    # the Dockerfile is sent even if it is ignored
+    link_into_context(os.path.join(root_dir, dockerfile), context_dir, [])
+    for path, relative_path in extra_files or []:
+        target = os.path.join(context_dir, relative_path)
+        # a hardlink shares its content with the file in the repository
+        if os.path.lexists(target):
+            os.remove(target)
+        if not os.path.exists(os.path.dirname(target)):
+            os.makedirs(os.path.dirname(target))
+        shutil.copy2(path, target)
+
+    logger.info(
+        "Build context of image %s: %.1f MB, the whole repository: %.1f MB",
+        image.id,
+        get_context_size(context_dir, []) / 1024.0 / 1024,
+        get_context_size(root_dir, patterns) / 1024.0 / 1024,
+    )
+    return context_dir
+
+
+def get_docker_build_command(
+    image,
+    cache_option,
+    image_release_name,
+    build_args,
+    context_dir,
+    buildkit=False,
+    target=None,
+):
+    docker_build = "docker build"
+    if buildkit:
+        docker_build = "DOCKER_BUILDKIT=1 docker build --progress=plain"
+    if target:
+        docker_build += " --target %s" % target
+    return " ".join(
+        ["%s %s --network=host -t %s" % (docker_build, cache_option, image_release_name)]
+        + ["--build-arg %s=%s" % arg for arg in build_args]
+        + [
+            "-f %s %s"
+            % (os.path.join(context_dir, image.build_image_dockerfile), context_dir)
+        ]
+    )
+
+
+def get_build_jobs(concurrent_builds):
+    """
+    Number of make jobs of an engine build, bounded by the cpus and by the memory
+    of the build host shared by the engine images built concurrently.
+    """
+    if build_jobs:
+        return build_jobs
+    cpus = multiprocessing.cpu_count()
+    memory_gb = cpus * build_job_memory_gb
+    try:
+        with open("/proc/meminfo") as fd:
+            for line in fd:
+                if line.startswith("MemTotal:"):
+                    memory_gb = int(line.split()[1]) / 1024.0 / 1024
+                    break
+    except IOError:
+        pass
+    jobs = min(cpus, int(memory_gb / build_job_memory_gb)) // max(concurrent_builds, 1)
+    return max(jobs, 1)
+
+
+def enable_ccache_mount(image, context_dir):
+    """
+    Mount a buildkit cache keyed by the engine branch at /ccache for the compile
+    step of the staged Dockerfile, the cache outlives the builds.
+    """
+    dockerfile = os.path.join(context_dir, image.build_image_dockerfile)
+    with open(dockerfile) as fd:
+        content = fd.read()
+    cache_id = "ccache-%s" % re.sub(r"[^\w.-]", "_", image.engine_branch)
+    content, count = re.subn(
+        r"^RUN cd \$\{POLAR_BUILD_DIR\}",
+        "RUN --mount=type=cache,id=%s,target=/ccache cd ${POLAR_BUILD_DIR}" % cache_id,
+        content,
+        flags=re.M,
+    )
+    if not count:
+        raise Exception("Can not find the compile step in %s" % dockerfile)
+    # the staged Dockerfile is a hardlink of the one in the repository
+    os.remove(dockerfile)
+    with open(dockerfile, "w") as fd:
+        fd.write(content)
+
+
+class CcacheStats:
+    """
+    Collect the hits and misses printed by "ccache -s" at the end of a build.
+    """
+
+    stats_pattern = re.compile(
+        r"(cache hit \(direct\)|cache hit \(preprocessed\)|cache miss)\s+(\d+)\s*$"
+    )
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, line):
+        match = self.stats_pattern.search(line)
+        if not match:
+            return
+        if match.group(1) == "cache miss":
+            self.misses = int(match.group(2))
+        else:
+            self.hits += int(match.group(2))
+
+    def hit_rate(self):
+        if not self.hits + self.misses:
+            return 0.0
+        return 100.0 * self.hits / (self.hits + self.misses)
+
+
+class PgBenchOutput:
+    """
+    Collect the "pg_bench: label=<label> key=value ..." results of docker/pg_bench.sh.
+    """
+
+    def __init__(self):
+        # label -> {key: value}
+        self.results = {}
+
+    def __call__(self, line):
+        index = line.find("pg_bench: ")
+        if index < 0:
+            return
+        values = dict(
+            item.split("=", 1)
+            for item in line[index + len("pg_bench: ") :].split()
+            if "=" in item
+        )
+        label = values.pop("label", "")
+        for key, value in values.items():
+            try:
+                values[key] = float(value)
+            except ValueError:
+                pass
+        self.results[label] = values
+
+
+def get_rpm_sha256(rpm):
+    if not rpm:
+        return ""
+    package = rpm.split("/")[-1]
+    for rpm_dir in (root_dir, os.path.join(root_dir, "rootfs")):
+        rpm_path = os.path.join(rpm_dir, package)
+        if os.path.isfile(rpm_path):
+            return get_file_sha256(rpm_path)
+    return ""
+
+
+def get_docker_image_id(image_name):
+    p = subprocess.Popen(
+        "docker image inspect --format '{{.Id}}' %s" % image_name,
+        shell=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+    output = p.communicate()[0]
+    if p.returncode != 0:
+        return ""
+    return output.decode("utf-8").strip()
+
+
+def compute_image_fingerprint(image, build_args):
+    """
+    Hash everything a docker build of the image depends on. The build args carry
+    the commit of this repo and of the engine source.
+    """
+    inputs = {
+        "config": dict(
+            (key, value)
+            for key, value in image.config.items()
+            if key in fingerprint_config_keys
+        ),
+        "build_args": [
+            arg for arg in build_args if arg[0] not in fingerprint_ignored_build_args
+        ],
+        "dockerfile": get_file_sha256(
+            os.path.join(root_dir, image.build_image_dockerfile)
+        ),
+        "rootfs": hash_tree(os.path.join(root_dir, "rootfs")),
+        "docker": hash_tree(os.path.join(root_dir, "docker")),
+        "pfsd_rpm": get_rpm_sha256(pfsd_rpm),
+        "polardb_rpm": get_rpm_sha256(image.polardb_rpm),
+    }
+    if image.type == "manager":
+        inputs["engine"] = engine_images[image.engine_image_id].fingerprint
+    elif image.type == "engine":
+        inputs["config_template"] = get_engine_config_template_blob(image)
+    content = json.dumps(inputs, sort_keys=True)
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+@contextlib.contextmanager
+def open_json_store(path):
+    """
+    Load a json file shared by all image.py processes, such as the build manifest,
+    changes to it are saved when leaving the context.
+    """
+    store_dir = os.path.dirname(path)
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+    with json_store_lock:
+        with open(path + ".lock", "a") as lock_fd:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX)
+            store = {}
+            if os.path.exists(path):
+                try:
+                    with open(path) as fd:
+                        store = json.load(fd)
+                except ValueError:
+                    logger.warn("Ignore corrupted %s", path)
+            yield store
+            tmp_file = "%s.%d.tmp" % (path, os.getpid())
+            with open(tmp_file, "w") as fd:
+                json.dump(store, fd, indent=4, sort_keys=True)
+            os.rename(tmp_file, path)
+
+
+def find_built_image(image, args):
+    """
+    Return the name of a previously built image with the same fingerprint which is
+    still present, or "" if the image has to be built.
+    """
+    if not args.reuse or args.no_cache:
+        return ""
+    with open_json_store(build_manifest_file) as manifest:
+        entry = manifest.get(image.fingerprint)
+        if entry is None:
+            return ""
+        if get_docker_image_id(entry["name"]) != entry["docker_id"]:
+            logger.info("Built image %s is gone or retagged", entry["name"])
+            del manifest[image.fingerprint]
+            return ""
+        return entry["name"]
+
+
+def record_built_image(image, image_name):
+    entry = {
+        "id": image.id,
+        "name": image_name,
+        "docker_id": get_docker_image_id(image_name),
+        "build_time": datetime.datetime.now().strftime("%Y%m%d%H%M%S"),
+    }
+    with open_json_store(build_manifest_file) as manifest:
+        for fingerprint, other in list(manifest.items()):
+            # the tag has been moved to the new image
+            if other["name"] == image_name:
+                del manifest[fingerprint]
+        manifest[image.fingerprint] = entry
+        entries = sorted(
+            [item for item in manifest.items() if item[1]["id"] == image.id],
+            key=lambda item: item[1]["build_time"],
+            reverse=True,
+        )
+        for fingerprint, _ in entries[build_manifest_max_entries:]:
+            del manifest[fingerprint]
+
+
+def docker_build_base_image(args):
+    base_dir = os.path.join(root_dir, "docker")
+    # build.sh runs the build, its options change the image as well
+    inputs_hash = hash_docker_inputs(
+        os.path.join(base_dir, "Dockerfile.base"), base_dir, extra_sources=["build.sh"]
+    )
+    if not args.no_cache:
+        # both targets of Dockerfile.base are built by build.sh, one label per image
+        p = subprocess.Popen(
+            "docker image inspect --format '{{ index .Config.Labels \"%s\" }}' %s %s"
+            % (base_inputs_hash_label, base_image_name, base_runtime_image_name),
+            shell=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        image_hashes = p.communicate()[0].decode("utf-8").split()
+        if p.returncode == 0 and image_hashes == [inputs_hash, inputs_hash]:
+            logger.info(
+                "Inputs of base images %s and %s unchanged, skip building them",
+                base_image_name,
+                base_runtime_image_name,
+            )
+            return
 
-def docker_build_base_image():
     logger.info("build base image...")
-    bulid_base_command = "./build.sh"
-    exec_command_verbose(bulid_base_command, cwd=os.path.join(root_dir, "docker"))
+    # build.sh stores the hash as a label of the base image
+    bulid_base_command = "BASE_INPUTS_HASH=%s ./build.sh" % inputs_hash
+    with build_report.stage("base"):
+        exec_command_verbose(bulid_base_command, cwd=base_dir, log_name="base")
+
 
 def docker_build_engine_image(image, args):
-    if os.path.exists(image.engine_source_dir):
-        shutil.rmtree(image.engine_source_dir)
-    os.makedirs(image.engine_source_dir)
-    clone_and_checkout(image)
-    submodule_init(image)
-
-    # 拷贝内核参数模板到指定位置
-    config_template_path = os.path.join(
-        image.engine_source_dir, image.engine_config_template
-    )
-    if os.path.exists(config_template_path):
-        copy_command = "cp %s rootfs/%s" % (
-            config_template_path,
-            os.path.basename(config_template_path),
+    resolve_engine_commit(image)
+    # the inputs from the engine source are known from its commit in the mirror,
+    # a reused image is found without checking the source out
+    build_args = get_engine_build_args(image, args)
+    image.fingerprint = compute_image_fingerprint(image, build_args)
+    built_image_name = find_built_image(image, args)
+    if built_image_name:
+        logger.info("Inputs of image %s unchanged, reuse %s", image.id, built_image_name)
+        image.build_image_release_name = built_image_name
+        debuginfo_name = get_debuginfo_image_name(built_image_name)
+        if image.debuginfo and get_docker_image_id(debuginfo_name):
+            image.debuginfo_image_name = debuginfo_name
+        if image.push:
+            push_queue.submit(image, built_image_name)
+            if image.debuginfo_image_name:
+                push_queue.submit(image, image.debuginfo_image_name)
+        return built_image_name
+
+    acquire_engine_source(image)
+    try:
+        return docker_build_engine_image_from_source(image, args, build_args)
+    finally:
+        release_engine_source(image)
+
+
+def get_engine_config_template(image):
+    return os.path.join(image.engine_source_dir, image.engine_config_template)
+
+
+def get_engine_config_template_blob(image):
+    """The git blob id of the engine config template, read from the mirror."""
+    try:
+        return exec_command(
+            "git rev-parse --verify %s:%s"
+            % (image.engine_commit, image.engine_config_template.lstrip("/")),
+            cwd=image.engine_mirror_dir,
         )
-        exec_command(copy_command)
-    else:
+    except Exception:
         raise Exception(
             "Can not find engine config template: %s" % image.engine_config_template
         )
 
-    kernel_repo_url = get_git_current_repo_url(image.engine_source_dir)
-    kernel_repo_branch = get_git_current_branch_name(image.engine_source_dir)
-    kernel_repo_commit = get_git_current_commit_id(image.engine_source_dir)
 
-    current_repo_url = get_git_current_repo_url(root_dir)
-    current_repo_branch = get_git_current_branch_name(root_dir)
-    current_repo_commit = get_git_current_commit_id(root_dir)
+def get_engine_build_args(image, args):
+    """
+    The build args of an engine image. The engine source is checked out with the
+    repo, branch and commit of the image, they are not read from the checkout.
+    """
+    with build_report.stage("git_metadata", image.id):
+        current_repo_url = get_git_current_repo_url(root_dir)
+        current_repo_branch = get_git_current_branch_name(root_dir)
+        current_repo_commit = get_git_current_commit_id(root_dir)
+        user_email = get_git_global_config("user.email")
+
+    build_args = [
+        ("CodeSource", current_repo_url),
+        ("CodeBranch", current_repo_branch),
+        ("CodeVersion", current_repo_commit),
+        ("PolarSource", image.engine_repo),
+        ("PolarBranch", image.engine_branch),
+        ("PolarVersion", image.engine_commit),
+        ("BuildBy", user_email),
+        ("PFSRPM", pfsd_rpm),
+        ("PolarDBRPM", image.polardb_rpm),
+        ("BUILD_JOBS", image.build_jobs),
+        ("USE_CCACHE", "1" if args.ccache else ""),
+    ]
+    if image.pgo:
+        build_args.append(("PGO", "1"))
+    return build_args
+
+
+def docker_build_engine_image_from_source(image, args, build_args):
+    # 内核参数模板拷贝到本次构建的context中，并发构建不会互相覆盖
+    config_template_path = get_engine_config_template(image)
+    if not os.path.exists(config_template_path):
+        raise Exception(
+            "Can not find engine config template: %s" % image.engine_config_template
+        )
 
     # engine image tag: pg_major.pg_minor.polar_release_date.commit_id.build_time
     result = exec_command(
@@ -236,52 +1435,421 @@ def docker_build_engine_image(image, args):
         image_tag = "%s.%s.%s.%s" % (
             pacakge_version,
             polar_release_date,
-            kernel_repo_commit[:8],
+            image.engine_commit[:8],
             today.strftime("%Y%m%d%H%M%S"),
         )
 
-    user_email = get_git_global_config("user.email")
     cache_option = ""
     if args.no_cache:
         cache_option = "--no-cache"
     image_release_name = "%s:%s" % (image.build_image_repo, image_tag)
     image.build_image_release_name = image_release_name
 
-    build_command = " ".join(
+    # the checkout directory, named after the commit which is hashed already
+    build_args = build_args + [("POLAR_SOURCE_DIR", image.engine_source_relative_dir)]
+
+    with build_report.stage("stage_context", image.id):
+        context_dir = stage_build_context(
+            image,
+            build_args,
+            extra_files=[
+                (
+                    config_template_path,
+                    os.path.join("rootfs", os.path.basename(config_template_path)),
+                )
+            ],
+        )
+        if args.ccache:
+            enable_ccache_mount(image, context_dir)
+    build_command = get_docker_build_command(
+        image,
+        cache_option,
+        image_release_name,
+        build_args,
+        context_dir,
+        buildkit=args.ccache,
+        target="runtime" if image.debuginfo else None,
+    )
+    step_timer = DockerStepTimer()
+    ccache_stats = CcacheStats()
+    pg_bench_output = PgBenchOutput()
+    try:
+        with build_report.stage("docker_build", image.id):
+            exec_command_verbose(
+                build_command,
+                log_name=image.id,
+                watchers=[step_timer, ccache_stats, pg_bench_output],
+            )
+        if image.debuginfo:
+            # the stages shared with the runtime target are cached by its build
+            debuginfo_name = get_debuginfo_image_name(image_release_name)
+            with build_report.stage("docker_build_debuginfo", image.id):
+                exec_command_verbose(
+                    get_docker_build_command(
+                        image,
+                        cache_option,
+                        debuginfo_name,
+                        build_args,
+                        context_dir,
+                        buildkit=args.ccache,
+                        target="debuginfo",
+                    ),
+                    log_name="%s-debuginfo" % image.id,
+                )
+            image.debuginfo_image_name = debuginfo_name
+    finally:
+        shutil.rmtree(context_dir)
+        step_timer.finish()
+        build_report.add_docker_steps(image.id, step_timer.steps)
+    step_timer.log_slowest(image.id)
+    if args.ccache:
+        logger.info(
+            "Image %s ccache hits %d, misses %d, hit rate %.1f%%",
+            image.id,
+            ccache_stats.hits,
+            ccache_stats.misses,
+            ccache_stats.hit_rate(),
+        )
+        build_report.set_image_info(
+            image.id,
+            "ccache",
+            {
+                "hits": ccache_stats.hits,
+                "misses": ccache_stats.misses,
+                "hit_rate": ccache_stats.hit_rate(),
+            },
+        )
+    if image.pgo:
+        for label, values in sorted(pg_bench_output.results.items()):
+            logger.info(
+                "Image %s PGO training with %s engine: %s",
+                image.id,
+                label,
+                " ".join("%s=%s" % item for item in sorted(values.items())),
+            )
+        build_report.set_image_info(image.id, "pgo", pg_bench_output.results)
+
+    if args.bench_gate and not run_bench_gate(image, image_release_name):
+        if bench_gate["policy"] != "no_push":
+            raise Exception("Image %s failed the pgbench gate" % image_release_name)
+        # not recorded either, so it is neither reused nor pushed later
+        logger.warn(
+            "Image %s failed the pgbench gate, it will not be pushed",
+            image_release_name,
+        )
+        image.gated = True
+        return image_release_name
+    if args.startup_bench:
+        run_startup_bench(image, image_release_name, args.startup_bench)
+    if args.image_sizes:
+        report_image_sizes(image, image_release_name)
+    record_built_image(image, image_release_name)
+
+    if image.push:
+        push_queue.submit(image, image_release_name)
+        if image.debuginfo_image_name:
+            push_queue.submit(image, image.debuginfo_image_name)
+
+    return image_release_name
+
+
+def get_debuginfo_image_name(image_name):
+    return image_name + "-debuginfo"
+
+
+def get_image_layer_count(image_name):
+    return int(
+        exec_command(
+            "docker image inspect --format '{{len .RootFS.Layers}}' %s" % image_name
+        )
+    )
+
+
+def get_image_layer_sizes(image_name):
+    """
+    Return the uncompressed and gzip compressed bytes of each layer of an image,
+    the compressed size is about what docker push uploads and docker pull fetches.
+    """
+    logger.info("Measure the layer sizes of image %s", image_name)
+    p = subprocess.Popen(
+        "docker save %s" % image_name, shell=True, stdout=subprocess.PIPE
+    )
+    manifest = None
+    sizes = {}
+    tar = tarfile.open(fileobj=p.stdout, mode="r|")
+    for member in tar:
+        if not member.isfile():
+            continue
+        fd = tar.extractfile(member)
+        if member.name == "manifest.json":
+            manifest = json.loads(fd.read().decode("utf-8"))
+            continue
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        compressed = 0
+        while True:
+            data = fd.read(1024 * 1024)
+            if not data:
+                break
+            compressed += len(compressor.compress(data))
+        compressed += len(compressor.flush())
+        sizes[member.name] = (member.size, compressed)
+    tar.close()
+    p.wait()
+    if p.returncode != 0 or not manifest:
+        raise Exception("Failed to save image %s" % image_name)
+    return [sizes[layer] for layer in manifest[0]["Layers"]]
+
+
+def format_size(size, sign=""):
+    return ("%" + sign + ".1fMB") % (size / 1024.0 / 1024)
+
+
+def report_image_sizes(image, image_name):
+    """
+    Measure the layer sizes of a built image and of its debuginfo image, compare
+    the pull size with the last image built for the same build_image_repo. The
+    sizes are written to the build result and the build report.
+    """
+    with build_report.stage("image_size", image.id):
+        count = get_image_layer_count(image_name)
+        if image.debuginfo_image_name:
+            # the debuginfo image is built from the image, its first layers are
+            # those of the image, so a single docker save measures both
+            layers = get_image_layer_sizes(image.debuginfo_image_name)
+        else:
+            layers = get_image_layer_sizes(image_name)
+
+    sizes = {
+        "layers": count,
+        "size": sum(layer[0] for layer in layers[:count]),
+        "compressed": sum(layer[1] for layer in layers[:count]),
+    }
+    if image.debuginfo_image_name:
+        sizes["debuginfo_size"] = sum(layer[0] for layer in layers[count:])
+        sizes["debuginfo_compressed"] = sum(layer[1] for layer in layers[count:])
+    with open_json_store(size_history_file) as history:
+        last = history.get(image.build_image_repo)
+        if last:
+            sizes["pull_delta"] = sizes["compressed"] - last["compressed"]
+        history[image.build_image_repo] = {
+            "image": image_name,
+            "size": sizes["size"],
+            "compressed": sizes["compressed"],
+        }
+
+    logger.info(
+        "Image %s: %d layers, %s, %s compressed",
+        image_name,
+        count,
+        format_size(sizes["size"]),
+        format_size(sizes["compressed"]),
+    )
+    if last:
+        logger.info(
+            "Image %s pull size %s against %s",
+            image_name,
+            format_size(sizes["pull_delta"], "+"),
+            last["image"],
+        )
+    if image.debuginfo_image_name:
+        logger.info(
+            "Image %s adds %s, %s compressed",
+            image.debuginfo_image_name,
+            format_size(sizes["debuginfo_size"]),
+            format_size(sizes["debuginfo_compressed"]),
+        )
+    image.sizes = sizes
+    build_report.set_image_info(
+        image.id,
+        "sizes",
+        dict(sizes, layer_sizes=layers, debuginfo_image=image.debuginfo_image_name),
+    )
+    return sizes
+
+
+def compare_bench_results(results, baseline, threshold):
+    regressions = []
+    for key, value in sorted(results.items()):
+        base_value = baseline.get(key)
+        if not isinstance(value, float) or not isinstance(base_value, float):
+            continue
+        if not base_value:
+            continue
+        change = (value - base_value) * 100.0 / base_value
+        if key.startswith("tps_") and change < -threshold:
+            regressions.append("%s %.1f -> %.1f" % (key, base_value, value))
+        elif key.endswith("_ms") and change > threshold:
+            regressions.append("%s %.3f -> %.3f" % (key, base_value, value))
+    return regressions
+
+
+def run_bench_gate(image, image_name):
+    """
+    Run pgbench in a container of a freshly built engine image and compare the
+    results with the last accepted image of the same build_image_repo. Return
+    whether the image is accepted, accepted results become the new baseline.
+    """
+    bench_output = PgBenchOutput()
+    bench_command = " ".join(
         [
-            "docker build %s --network=host -t %s "
-            % (cache_option, image_release_name),
-            "--build-arg CodeSource=%s" % current_repo_url,
-            "--build-arg CodeBranch=%s" % current_repo_branch,
-            "--build-arg CodeVersion=%s" % current_repo_commit,
-            "--build-arg PolarSource=%s" % kernel_repo_url,
-            "--build-arg PolarBranch=%s" % kernel_repo_branch,
-            "--build-arg PolarVersion=%s" % kernel_repo_commit,
-            "--build-arg POLAR_SOURCE_DIR=%s" % image.engine_source_relative_dir,
-            "--build-arg BuildBy=%s" % user_email,
-            "--build-arg PFSRPM=%s" % pfsd_rpm,
-            "--build-arg PolarDBRPM=%s" % image.polardb_rpm,
-            "-f %s ." % image.build_image_dockerfile,
+            "docker run --rm --shm-size=1g --entrypoint bash",
+            "-e PG_BENCH_SCALE=%s" % bench_gate["scale"],
+            "-e PG_BENCH_CLIENTS=%s" % bench_gate["clients"],
+            "-e PG_BENCH_SECONDS=%s" % bench_gate["seconds"],
+            "%s /pg_bench.sh gate %s gate" % (image_name, engine_base_dir),
         ]
     )
+    # benchmarks of concurrently built images would disturb each other
+    with bench_gate_lock:
+        with build_report.stage("bench_gate", image.id):
+            exec_command_verbose(
+                bench_command, log_name="%s-bench" % image.id, watchers=[bench_output]
+            )
+    results = bench_output.results.get("gate")
+    if not results:
+        raise Exception("Can not find the pgbench results of image %s" % image_name)
+
+    history_file = os.path.expanduser(bench_gate["history"])
+    with open_json_store(history_file) as history:
+        baseline = history.get(image.build_image_repo)
+        regressions = []
+        if baseline:
+            regressions = compare_bench_results(
+                results, baseline["results"], bench_gate["threshold"]
+            )
+        if not regressions:
+            history[image.build_image_repo] = {
+                "image": image_name,
+                "results": results,
+                "time": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            }
+
+    logger.info(
+        "Image %s pgbench: %s",
+        image_name,
+        " ".join("%s=%s" % item for item in sorted(results.items())),
+    )
+    for regression in regressions:
+        logger.warn(
+            "Image %s regressed against %s: %s",
+            image_name,
+            baseline["image"],
+            regression,
+        )
+    build_report.set_image_info(
+        image.id,
+        "bench_gate",
+        {
+            "results": results,
+            "baseline": baseline and baseline["image"],
+            "regressions": regressions,
+            "accepted": not regressions,
+        },
+    )
+    return not regressions
 
-    exec_command_verbose(build_command)
 
-    if image.push:
-        docker_push(image_release_name)
+def get_percentile(values, percent):
+    values = sorted(values)
+    index = int(round((len(values) - 1) * percent / 100.0))
+    return values[index]
 
-    if os.path.exists(image.engine_source_dir):
-        shutil.rmtree(image.engine_source_dir)
 
-    return image_release_name
+def measure_engine_startup(image_name):
+    """
+    Start a container of an engine image, let supervisor.py install and start a
+    local storage instance and return the seconds from docker run to each stage
+    of startup_bench_stages.
+    """
+    env_options = " ".join(
+        "-e %s=%s" % (key, shell_quote(str(value)))
+        for key, value in sorted(startup_bench["env"].items())
+    )
+    start_time = time.time()
+    container_id = (
+        exec_command("docker run -d --shm-size=1g %s %s" % (env_options, image_name))
+        .decode("utf-8")
+        .strip()
+    )
+    timeline = {"container_start": time.time() - start_time}
+    try:
+        output = exec_command(
+            "docker exec %s timeout %d bash -c %s"
+            % (
+                container_id,
+                startup_bench["timeout"],
+                shell_quote(startup_watch_script),
+            )
+        ).decode("utf-8")
+        for line in output.splitlines():
+            stage, _, value = line.strip().partition("=")
+            if stage in startup_bench_stages:
+                timeline[stage] = float(value) - start_time
+    except Exception:
+        logger.error(
+            "Container of %s did not become ready, its logs:\n%s",
+            image_name,
+            exec_command("docker logs --tail 50 %s 2>&1" % container_id),
+        )
+        raise
+    finally:
+        exec_command("docker rm -f %s" % container_id)
+    return timeline
+
+
+def run_startup_bench(image, image_name, repetitions):
+    """
+    Measure the cold start of an engine image repetitions times, report the median
+    and p95 seconds until each startup stage in the log and the build report.
+    """
+    timelines = []
+    # like the pgbench gate, concurrent startups would disturb each other
+    with bench_gate_lock:
+        with build_report.stage("startup_bench", image.id):
+            for i in range(repetitions):
+                timeline = measure_engine_startup(image_name)
+                logger.info(
+                    "Image %s startup %d/%d: %s",
+                    image_name,
+                    i + 1,
+                    repetitions,
+                    " ".join(
+                        "%s=%.2fs" % (stage, timeline[stage])
+                        for stage in startup_bench_stages
+                    ),
+                )
+                timelines.append(timeline)
+
+    results = {}
+    for stage in startup_bench_stages:
+        seconds = [timeline[stage] for timeline in timelines]
+        results[stage] = {
+            "median": get_percentile(seconds, 50),
+            "p95": get_percentile(seconds, 95),
+        }
+        logger.info(
+            "Image %s %s: median %.2fs, p95 %.2fs over %d startups",
+            image_name,
+            stage,
+            results[stage]["median"],
+            results[stage]["p95"],
+            repetitions,
+        )
+    build_report.set_image_info(
+        image.id,
+        "startup",
+        {"image": image_name, "repetitions": repetitions, "stages": results},
+    )
+    return results
 
 
 def docker_build_manager_image(image, args):
-    current_repo_url = get_git_current_repo_url(root_dir)
-    current_repo_branch = get_git_current_branch_name(root_dir)
-    current_repo_commit = get_git_current_commit_id(root_dir)
+    with build_report.stage("git_metadata", image.id):
+        current_repo_url = get_git_current_repo_url(root_dir)
+        current_repo_branch = get_git_current_branch_name(root_dir)
+        current_repo_commit = get_git_current_commit_id(root_dir)
 
-    user_email = get_git_global_config("user.email")
+        user_email = get_git_global_config("user.email")
 
     kernel_image = engine_images.get(image.engine_image_id)
     if not kernel_image:
@@ -296,36 +1864,263 @@ def docker_build_manager_image(image, args):
         image_tag = "%s.%s" % (today.strftime("%Y%m%d%H%M%S"), current_repo_commit[:8])
     image_release_name = "%s:%s" % (image.build_image_repo, image_tag)
 
-    build_command = " ".join(
-        [
-            "docker build %s --network=host -t %s" % (cache_option, image_release_name),
-            "--build-arg CodeSource=%s" % current_repo_url,
-            "--build-arg CodeBranch=%s" % current_repo_branch,
-            "--build-arg CodeVersion=%s" % current_repo_commit,
-            "--build-arg BuildBy=%s" % user_email,
-            "--build-arg ENGINE_IMAGE_FULL_NAME=%s"
-            % kernel_image.build_image_release_name,
-            "-f %s ." % image.build_image_dockerfile,
-        ]
+    build_args = [
+        ("CodeSource", current_repo_url),
+        ("CodeBranch", current_repo_branch),
+        ("CodeVersion", current_repo_commit),
+        ("BuildBy", user_email),
+        ("ENGINE_IMAGE_FULL_NAME", kernel_image.build_image_release_name),
+    ]
+    image.fingerprint = compute_image_fingerprint(image, build_args)
+    built_image_name = find_built_image(image, args)
+    if built_image_name:
+        logger.info("Inputs of image %s unchanged, reuse %s", image.id, built_image_name)
+        image.build_image_release_name = built_image_name
+        if image.push:
+            push_queue.submit(image, built_image_name)
+        return built_image_name
+
+    with build_report.stage("stage_context", image.id):
+        context_dir = stage_build_context(image, build_args)
+    build_command = get_docker_build_command(
+        image, cache_option, image_release_name, build_args, context_dir
     )
-    exec_command_verbose(build_command)
+    step_timer = DockerStepTimer()
+    try:
+        with build_report.stage("docker_build", image.id):
+            exec_command_verbose(
+                build_command, log_name=image.id, watchers=[step_timer]
+            )
+    finally:
+        shutil.rmtree(context_dir)
+        step_timer.finish()
+        build_report.add_docker_steps(image.id, step_timer.steps)
+    step_timer.log_slowest(image.id)
+    if import_time_budget["total_ms"]:
+        check_import_time(image, image_release_name)
+    if args.image_sizes:
+        report_image_sizes(image, image_release_name)
+    record_built_image(image, image_release_name)
+    image.build_image_release_name = image_release_name
 
     if image.push:
-        docker_push(image_release_name)
+        push_queue.submit(image, image_release_name)
 
     return image_release_name
 
 
+def check_import_time(image, image_name):
+    """
+    Measure the import time of entry_point.py, which every operation runs in a
+    new interpreter, in a manager image and fail if it exceeds the budget.
+    """
+    command = " ".join(
+        [
+            "docker run --rm --entrypoint python -e PG_LOG=/tmp",
+            image_name,
+            "/import_time.py -n %d /docker_script/entry_point.py"
+            % import_time_budget["repeat"],
+        ]
+    )
+    with build_report.stage("import_time", image.id):
+        output = exec_command(command).decode("utf-8")
+    modules = []
+    total_ms = None
+    for line in output.splitlines():
+        if not line.startswith("import_time: "):
+            continue
+        values = dict(item.split("=", 1) for item in line.split()[1:] if "=" in item)
+        if "module" in values:
+            modules.append(
+                (
+                    values["module"],
+                    float(values["self_ms"]),
+                    float(values["cumulative_ms"]),
+                )
+            )
+        elif "total_ms" in values:
+            total_ms = float(values["total_ms"])
+    if total_ms is None:
+        raise Exception("Can not find the import time of image %s" % image_name)
+
+    logger.info(
+        "Image %s imports entry_point.py in %.1fms, budget %dms, slowest modules: %s",
+        image_name,
+        total_ms,
+        import_time_budget["total_ms"],
+        ", ".join("%s %.1fms" % (module[0], module[2]) for module in modules[:5]),
+    )
+    build_report.set_image_info(
+        image.id, "import_time", {"total_ms": total_ms, "modules": modules}
+    )
+    if total_ms > import_time_budget["total_ms"]:
+        raise Exception(
+            "Image %s imports entry_point.py in %.1fms, over the budget of %dms"
+            % (image_name, total_ms, import_time_budget["total_ms"])
+        )
+
+
 def docker_push(image_name):
     push_command = "docker push %s" % image_name
     exec_command_verbose(push_command)
 
 
-def wget_and_rpm_info(rpm_url):
+class PushQueue:
+    """
+    Push images from background threads, so pushes overlap with later builds.
+    Failed pushes are retried with exponential backoff, an image already pushed
+    under the same tag, according to the push record, is skipped.
+    """
+
+    def __init__(self, jobs, retries):
+        self.queue = queue.Queue()
+        self.retries = retries
+        # image id -> pushed, skipped or failed
+        self.results = {}
+        self.lock = threading.Lock()
+        self.workers = []
+        for i in range(jobs):
+            worker = threading.Thread(target=self.run, name="push-%d" % i)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, image, image_name):
+        if image.gated:
+            logger.warn("Image %s is gated, skip pushing it", image_name)
+            with self.lock:
+                self.results[image.id] = "gated"
+            return
+        logger.info("Queue pushing image %s", image_name)
+        self.queue.put((image, image_name))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            image, image_name = item
+            try:
+                with build_report.stage("push", image.id):
+                    result = self.push(image_name)
+            except Exception as e:
+                logger.error("Failed to push image %s: %s", image_name, e)
+                result = "failed"
+            with self.lock:
+                # an image may be pushed with its debuginfo image
+                if self.results.get(image.id) != "failed":
+                    self.results[image.id] = result
+
+    def push(self, image_name):
+        image_id = get_docker_image_id(image_name)
+        with open_json_store(push_record_file) as record:
+            pushed = image_id and record.get(image_name) == image_id
+        if pushed:
+            logger.info("Image %s has been pushed before, skip pushing it", image_name)
+            return "skipped"
+
+        delay = push_retry_delay
+        for attempt in range(self.retries + 1):
+            try:
+                docker_push(image_name)
+                break
+            except Exception:
+                if attempt == self.retries:
+                    raise
+                logger.warn("Retry pushing image %s in %ds", image_name, delay)
+                time.sleep(delay)
+                delay *= 2
+
+        with open_json_store(push_record_file) as record:
+            record[image_name] = image_id
+        return "pushed"
+
+    def join(self):
+        for _ in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            # Thread.join without timeout can not be interrupted by Ctrl-C in python2
+            while worker.is_alive():
+                worker.join(1)
+        return self.results
+
+
+@contextlib.contextmanager
+def rpm_cache_lock(rpm_url):
+    lock_dir = os.path.join(rpm_cache_dir, "urls")
+    if not os.path.exists(lock_dir):
+        os.makedirs(lock_dir)
+    key = hashlib.sha1(rpm_url.encode("utf-8")).hexdigest()
+    with open(os.path.join(lock_dir, key + ".lock"), "a") as lock_fd:
+        fcntl.flock(lock_fd, fcntl.LOCK_EX)
+        yield os.path.join(lock_dir, key)
+
+
+def get_cached_rpm_path(sha256, package):
+    return os.path.join(rpm_cache_dir, "sha256", sha256, package)
+
+
+def download_rpm(rpm_url, target):
+    source = rpm_url
+    if rpm_source_dir:
+        source = os.path.join(rpm_source_dir, rpm_url.split("/")[-1])
+    elif source.startswith("file://"):
+        source = source[len("file://") :]
+    if "://" not in source:
+        logger.info("Copy rpm %s", source)
+        shutil.copyfile(source, target)
+    else:
+        exec_command_verbose("wget --no-verbose -O %s %s" % (target, source))
+
+
+def fetch_rpm(rpm_url, expected_sha256=""):
+    """
+    Return the path of an rpm in the content addressed rpm cache, downloading it
+    if neither its checksum nor its url has been seen before.
+    """
     package = rpm_url.split("/")[-1]
-    wget_command = "rm -f %s && wget %s" % (package, rpm_url)
-    exec_command_verbose(wget_command)
-    rpm_info_command = "rpm -pqi ./%s" % package
+    with rpm_cache_lock(rpm_url) as url_index:
+        sha256 = expected_sha256
+        if not sha256 and os.path.exists(url_index):
+            with open(url_index) as fd:
+                sha256 = fd.read().strip()
+        if sha256 and os.path.exists(get_cached_rpm_path(sha256, package)):
+            logger.info("Use cached rpm %s", get_cached_rpm_path(sha256, package))
+            return get_cached_rpm_path(sha256, package)
+
+        tmp_file = "%s.%d.tmp" % (url_index, os.getpid())
+        try:
+            download_rpm(rpm_url, tmp_file)
+            sha256 = get_file_sha256(tmp_file)
+            if expected_sha256 and sha256 != expected_sha256:
+                raise Exception(
+                    "Checksum of rpm %s mismatch, expected %s, got %s"
+                    % (rpm_url, expected_sha256, sha256)
+                )
+            rpm_path = get_cached_rpm_path(sha256, package)
+            if not os.path.exists(os.path.dirname(rpm_path)):
+                os.makedirs(os.path.dirname(rpm_path))
+            os.rename(tmp_file, rpm_path)
+        finally:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+        with open(url_index, "w") as fd:
+            fd.write(sha256)
+        return rpm_path
+
+
+def get_rpm_info(rpm_path):
+    """
+    Parse CodeBranch and PFSDVersion from the rpm header, the result is cached
+    next to the rpm.
+    """
+    info_file = rpm_path + ".info.json"
+    if os.path.exists(info_file):
+        with open(info_file) as fd:
+            info = json.load(fd)
+        return (info["code_branch"], info["pfsd"])
+
+    rpm_info_command = "rpm -pqi %s" % rpm_path
     code_branch = ""
     pfsd = ""
     output = exec_command(rpm_info_command)
@@ -335,16 +2130,259 @@ def wget_and_rpm_info(rpm_url):
     pfsd_obj = re.search(pfsd_pattern, output, re.M | re.I)
     if pfsd_obj is not None:
         pfsd = pfsd_obj.groups()[0]
+
+    tmp_file = "%s.%d.tmp" % (info_file, os.getpid())
+    with open(tmp_file, "w") as fd:
+        json.dump({"code_branch": code_branch, "pfsd": pfsd}, fd)
+    os.rename(tmp_file, info_file)
     return (code_branch, pfsd)
 
 
+def wget_and_rpm_info(rpm_url, expected_sha256=""):
+    rpm_path = fetch_rpm(rpm_url, expected_sha256)
+    # keep a copy of the rpm in the repository as before, hardlinked from the cache
+    package = os.path.join(root_dir, rpm_url.split("/")[-1])
+    if os.path.lexists(package):
+        os.remove(package)
+    try:
+        os.link(rpm_path, package)
+    except OSError:
+        shutil.copyfile(rpm_path, package)
+    return get_rpm_info(rpm_path)
+
+
+def prefetch_rpms(rpms, jobs):
+    """
+    Fetch the (url, sha256) rpms with at most jobs threads, return
+    url -> (code_branch, pfsd). Every rpm is copied into the repository by its
+    file name, rpms of different urls must not share it.
+    """
+    urls = {}
+    packages = {}
+    for rpm_url, expected_sha256 in rpms:
+        sha256 = urls.get(rpm_url)
+        if sha256 and expected_sha256 and sha256 != expected_sha256:
+            raise Exception("Rpm %s is given different checksums" % rpm_url)
+        urls[rpm_url] = sha256 or expected_sha256
+        package = rpm_url.split("/")[-1]
+        if packages.setdefault(package, rpm_url) != rpm_url:
+            raise Exception(
+                "Rpms %s and %s have the same file name" % (packages[package], rpm_url)
+            )
+
+    pending = queue.Queue()
+    for item in sorted(urls.items()):
+        pending.put(item)
+    rpm_infos = {}
+    errors = []
+
+    def fetch():
+        while True:
+            try:
+                rpm_url, expected_sha256 = pending.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                rpm_infos[rpm_url] = wget_and_rpm_info(rpm_url, expected_sha256)
+            except Exception as e:
+                errors.append(e)
+
+    workers = []
+    for index in range(min(jobs, len(urls))):
+        worker = threading.Thread(target=fetch, name="fetch_rpm_%d" % index)
+        worker.start()
+        workers.append(worker)
+    for worker in workers:
+        worker.join()
+    if errors:
+        raise Exception("Failed to fetch rpms: %s" % ", ".join(str(e) for e in errors))
+    return rpm_infos
+
+
+class BuildTask:
+    def __init__(self, image):
+        self.image = image
+        self.deps = []
+        self.status = "pending"
+        self.image_name = ""
+        self.start_time = None
+        self.end_time = None
+        self.error = None
+        self.push_status = ""
+
+    def duration(self):
+        if self.start_time is None or self.end_time is None:
+            return 0.0
+        return self.end_time - self.start_time
+
+
+def build_image(image, args):
+    if image.type == "engine":
+        return docker_build_engine_image(image, args)
+    elif image.type == "manager":
+        return docker_build_manager_image(image, args)
+    else:
+        raise Exception("Unknown image type: %s" % image)
+
+
+def run_build_task(task, args, done):
+    try:
+        task.image_name = build_image(task.image, args)
+        task.status = "gated" if task.image.gated else "success"
+    except Exception as e:
+        task.error = e
+        task.status = "failed"
+    task.end_time = time.time()
+    done.put(task)
+
+
+def schedule_builds(images, args):
+    """
+    Build images as a DAG: every engine image can start at once, a manager image
+    starts as soon as the engine image it is based on is built. Images based on
+    a gated image are gated as well without being built.
+    """
+    tasks = [BuildTask(image) for image in images]
+    task_map = dict((task.image.id, task) for task in tasks)
+    for task in tasks:
+        engine_task = task_map.get(task.image.engine_image_id)
+        if task.image.type == "manager" and engine_task is not None:
+            task.deps.append(engine_task)
+
+    done = queue.Queue()
+    pending = list(tasks)
+    running = 0
+    failed = False
+    while pending or running:
+        for task in list(pending):
+            if failed and not args.keep_going:
+                task.status = "skipped"
+            elif any(dep.status in ("failed", "skipped") for dep in task.deps):
+                task.status = "skipped"
+            elif any(dep.status == "gated" for dep in task.deps):
+                task.status = "gated"
+                task.image.gated = True
+                task.end_time = task.start_time = time.time()
+                logger.warn("Skip image %s based on a gated image", task.image.id)
+            elif args.jobs and running >= args.jobs:
+                break
+            elif all(dep.status == "success" for dep in task.deps):
+                task.status = "running"
+                task.start_time = time.time()
+                worker = threading.Thread(
+                    target=run_build_task, args=(task, args, done), name=task.image.id
+                )
+                worker.daemon = True
+                worker.start()
+                running += 1
+            else:
+                continue
+            pending.remove(task)
+            if task.status == "skipped":
+                logger.warn("Skip image %s", task.image.id)
+
+        if not running:
+            break
+        # Queue.get without timeout can not be interrupted by Ctrl-C in python2
+        try:
+            finished = [done.get(timeout=1)]
+        except queue.Empty:
+            continue
+        # collect every finished build before scheduling, so failures are seen first
+        while True:
+            try:
+                finished.append(done.get_nowait())
+            except queue.Empty:
+                break
+        for task in finished:
+            running -= 1
+            if task.status == "failed":
+                failed = True
+                logger.error(
+                    "Failed to build image %s in %.1fs: %s",
+                    task.image.id,
+                    task.duration(),
+                    task.error,
+                )
+            else:
+                logger.info(
+                    "Build image %s done in %.1fs", task.image_name, task.duration()
+                )
+            if task.status == "gated":
+                logger.warn("Image %s is gated by the pgbench gate", task.image_name)
+
+    return tasks
+
+
+def format_build_result(task):
+    line = "%s status=%s duration=%.1fs" % (
+        task.image_name or task.image.build_image_name,
+        task.status,
+        task.duration(),
+    )
+    if task.push_status:
+        line += " push=%s" % task.push_status
+    sizes = task.image.sizes
+    if sizes:
+        line += " size=%s compressed=%s" % (
+            format_size(sizes["size"]),
+            format_size(sizes["compressed"]),
+        )
+        if "pull_delta" in sizes:
+            line += " pull_delta=%s" % format_size(sizes["pull_delta"], "+")
+    if task.image.debuginfo_image_name:
+        line += " debuginfo=%s" % task.image.debuginfo_image_name
+        if "debuginfo_compressed" in sizes:
+            line += " debuginfo_compressed=+%s" % format_size(
+                sizes["debuginfo_compressed"]
+            )
+    return line
+
+
+def write_build_result(result_file, tasks, details=False):
+    """
+    Write the names of the built images one per line, or with details a line for
+    every image with its status, duration, push and sizes.
+    """
+    with open(result_file, "w") as fd:
+        for task in tasks:
+            if details:
+                fd.write(format_build_result(task) + "\n")
+            elif task.status == "success":
+                fd.write("%s\n" % task.image_name)
+
+
 def main():
-    global pfsd_rpm
+    global pfsd_rpm, git_cache_dir, git_cache_max_age_days, git_cache_max_size_mb
+    global build_manifest_file, rpm_cache_dir, rpm_source_dir
+    global push_record_file, push_queue, build_jobs, size_history_file
     args = parser.parse_args()
     with open(args.image_config) as fd:
         config = yaml.safe_load(fd)
         result_file = config.get("result", "./image.out")
         pfsd_rpm = config.get("pfsd_rpm", "bash")
+        git_cache_dir = os.path.expanduser(config.get("git_cache_dir", git_cache_dir))
+        git_cache_max_age_days = config.get(
+            "git_cache_max_age_days", git_cache_max_age_days
+        )
+        git_cache_max_size_mb = config.get(
+            "git_cache_max_size_mb", git_cache_max_size_mb
+        )
+        build_manifest_file = os.path.expanduser(
+            config.get("build_manifest", build_manifest_file)
+        )
+        rpm_cache_dir = os.path.expanduser(config.get("rpm_cache_dir", rpm_cache_dir))
+        build_jobs = config.get("build_jobs", build_jobs)
+        bench_gate.update(config.get("bench_gate", {}))
+        startup_bench.update(config.get("startup_bench", {}))
+        import_time_budget.update(config.get("import_time_budget", {}))
+        push_record_file = os.path.expanduser(
+            config.get("push_record", push_record_file)
+        )
+        rpm_source_dir = os.path.expanduser(config.get("rpm_source_dir", rpm_source_dir))
+        size_history_file = os.path.expanduser(
+            config.get("size_history", size_history_file)
+        )
         ids = set()
         for item in config.get("images", []):
             image = Image(item)
@@ -356,41 +2394,87 @@ def main():
                 raise Exception("Found duplicate image id: %s" % image.id)
             ids.add(image.id)
 
-            if image.polardb_rpm != "":
-                (engine_branch, pfsd) = wget_and_rpm_info(image.polardb_rpm)
-                image.set_engine_branch(engine_branch)
+            if image.debuginfo:
+                stages = get_dockerfile_stages(
+                    os.path.join(root_dir, image.build_image_dockerfile)
+                )
+                if "runtime" not in stages or "debuginfo" not in stages:
+                    raise Exception(
+                        "Image %s sets debuginfo, but %s has no runtime and "
+                        "debuginfo stages" % (image.id, image.build_image_dockerfile)
+                    )
 
             if image.type == "manager":
                 manager_images[image.id] = image
             elif image.type == "engine":
                 engine_images[image.id] = image
 
-    summary = []
     all_images = []
     all_images.extend(engine_images.values())
     all_images.extend(manager_images.values())
 
-    docker_build_base_image()
-    
+    concurrent_builds = len(engine_images)
+    if args.jobs:
+        concurrent_builds = min(args.jobs, concurrent_builds)
+    jobs = get_build_jobs(concurrent_builds)
+    logger.info("Compile engines with %d make jobs", jobs)
+    for image in engine_images.values():
+        image.build_jobs = jobs
+
+    with build_report.stage("fetch_rpms"):
+        rpm_infos = prefetch_rpms(
+            [
+                (image.polardb_rpm, image.polardb_rpm_sha256)
+                for image in all_images
+                if image.polardb_rpm != ""
+            ],
+            args.jobs or rpm_fetch_jobs,
+        )
+    for image in all_images:
+        if image.polardb_rpm != "":
+            (engine_branch, pfsd) = rpm_infos[image.polardb_rpm]
+            image.set_engine_branch(engine_branch)
+
+    evict_git_mirrors()
+
+    docker_build_base_image(args)
+
     prompt_info = json.dumps([image.build_image_name for image in all_images], indent=4, sort_keys=True)
     logger.info("Will build images: %s", prompt_info)
 
-    for image in all_images:
-        if image.type == "engine":
-            image_name = docker_build_engine_image(image, args)
-        elif image.type == "manager":
-            image_name = docker_build_manager_image(image, args)
-        else:
-            raise Exception("Unknown image type: %s" % image)
+    push_queue = PushQueue(max(args.push_jobs, 1), push_retries)
+    tasks = schedule_builds(all_images, args)
 
-        summary.extend([image_name])
+    for task in tasks:
+        if task.status == "success":
+            logger.info("Successfully build image: %s", task.image_name)
 
-    for item in summary:
-        logger.info("Successfully build image: %s", item)
+    push_results = push_queue.join()
+    for task in tasks:
+        task.push_status = push_results.get(
+            task.image.id, "gated" if task.image.gated else ""
+        )
 
-    with open(result_file, "w") as fd:
-        for image in summary:
-            fd.write("%s\n" % image)
+    write_build_result(result_file, tasks, args.result_details)
+    report_file, report = write_build_report(tasks)
+    if args.compare:
+        regressions = compare_build_reports(
+            report_file, report, args.compare, args.regression_threshold
+        )
+        if regressions:
+            logger.warn("Build stages regressed: %s", ", ".join(regressions))
+
+    gated = [task.image.id for task in tasks if task.status == "gated"]
+    if gated:
+        logger.warn("Images gated and not pushed: %s", ", ".join(gated))
+    failed = [
+        task.image.id for task in tasks if task.status not in ("success", "gated")
+    ]
+    if failed:
+        raise Exception("Failed to build images: %s" % ", ".join(failed))
+    failed = [task.image.id for task in tasks if task.push_status == "failed"]
+    if failed:
+        raise Exception("Failed to push images: %s" % ", ".join(failed))
 
 
 if __name__ == "__main__":
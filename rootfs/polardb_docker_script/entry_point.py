@@ -29,6 +29,14 @@ srv_opr_action:             The action of the task, the srv_opr_type and srv_opr
 
 srv_opr_timeout:            The timeout args for task
 
+srv_opr_batch:              Optional, a json list of operations run one after another in one process,
+                            each a srv_opr_type, srv_opr_action and the env it overrides, like this:
+                                [{"srv_opr_type": "hostins_ops", "srv_opr_action": "stop_instance"},
+                                 {"srv_opr_type": "account", "srv_opr_action": "create", "user": "xxx"}]
+                            A json summary of the steps is printed as the last line.
+
+srv_opr_batch_policy:       abort (default) skips the steps after a failed step, continue runs them
+
 cluster_custins_info:       The cluster and custins info, like this(the pgsql is the pengine):
                                 {
                                     "pgsql":
@@ -62,40 +70,13 @@ The env above is the common part of the different task, the different part we wi
 
 """
 
+import importlib
+import json
 import os
 import sys
 
-from pg_tasks.backup_instance import BackupInstance
-from pg_tasks.health_check import HealthChecker
-from pg_tasks.host_operator import (
-    grow_pfs,
-    lock_stop_instance,
-    unlock_start_instance,
-    restart_instance,
-    rebuild_local_dir,
-    setup_logagent_config,
-    switch_new_wal,
-    check_download_archive_status,
-    restore_prepared,
-    check_restore_running_status,
-    fetch_archive_log_from_source,
-    check_fetch_archive_from_source_status,
-    do_fetch_archive_log_from_source,
-    create_tablespace,
-    add_dma_follower_to_cluster,
-    update_recovery_conf,
-    get_system_identifier,
-)
-from pg_tasks.install_instance import setup_install_instance
-from pg_tasks.lock_instance import LockInstance
-from pg_tasks.manager_replica import ReplicaManager
-from pg_tasks.manager_user import UserManager
-from pg_tasks.modify_postgresql_conf import PgConfiger
-from pg_tasks.restore_instance import RestoreInstance
-from pg_tasks.stop_instance import StopInstance
-from pg_tasks.ssl_instance import SSLInstance
-from pg_tasks.update_tde_kek import TDEManager
 from pg_utils.logger import logger
+from pg_utils.manager_daemon import install_operation_output, run_batch, run_in_daemon
 from pg_utils.pg_const import ALL_LIBRARY_PATHS, SECRET_ENV_KEYS, MANAGER
 
 # init global vars
@@ -103,6 +84,125 @@ LD_LIBRARY_PATH = ":".join(filter(None, ALL_LIBRARY_PATHS))
 os.environ["LD_LIBRARY_PATH"] = LD_LIBRARY_PATH
 
 
+class Task(object):
+    """
+    The handler of an operation, imported from its module only when the operation
+    runs, so an operation loads just the task modules it needs. By default the
+    handler is a task class run as handler(docker_env).do_action(), run may be
+    given to call it in another way.
+    """
+
+    def __init__(self, module, name, run=None):
+        self.module = module
+        self.name = name
+        self.run = run
+
+    def load(self):
+        return getattr(importlib.import_module(self.module), self.name)
+
+    def __call__(self, docker_env):
+        handler = self.load()
+        if self.run:
+            return self.run(handler, docker_env)
+        return handler(docker_env).do_action()
+
+
+def call_without_env(handler, docker_env):
+    return handler()
+
+
+def call_with_env(handler, docker_env):
+    return handler(docker_env)
+
+
+def skip_initdb(docker_env):
+    logger.info("WANNING: skip initdb step")
+    sys.exit(0)
+
+
+def unsupported_init_ins_action(docker_env):
+    raise Exception("Unsupported operate action")
+
+
+def host_operation(name, run=call_without_env):
+    return Task("pg_tasks.host_operator", name, run)
+
+
+# (srv_opr_type, srv_opr_action) -> handler, None matches any type or action.
+# An operation is looked up by its type and action first, then by its type,
+# then by its action.
+TASKS = {
+    ("init_ins", "initdb"): skip_initdb,
+    ("init_ins", None): unsupported_init_ins_action,
+    ("replica", None): Task("pg_tasks.manager_replica", "ReplicaManager"),
+    ("stop", None): Task("pg_tasks.stop_instance", "StopInstance"),
+    ("account", None): Task("pg_tasks.manager_user", "UserManager"),
+    ("health_check", None): Task("pg_tasks.health_check", "HealthChecker"),
+    ("backup", None): Task("pg_tasks.backup_instance", "BackupInstance"),
+    ("restore", None): Task("pg_tasks.restore_instance", "RestoreInstance"),
+    ("lock_ins", None): Task("pg_tasks.lock_instance", "LockInstance"),
+    ("update_conf", None): Task("pg_tasks.modify_postgresql_conf", "PgConfiger"),
+    # 生成UE需要的监控元信息
+    ("hostins_ops", "setup_logagent_config"): host_operation("setup_logagent_config"),
+    ("hostins_ops", "get_system_identifier"): host_operation("get_system_identifier"),
+    ("hostins_ops", "grow_pfs"): host_operation("grow_pfs"),
+    ("hostins_ops", "build_recovery"): host_operation("update_recovery_conf"),
+    ("hostins_ops", "stop_instance"): host_operation("lock_stop_instance"),
+    ("hostins_ops", "start_instance"): host_operation("unlock_start_instance"),
+    ("hostins_ops", "restart_instance"): host_operation("restart_instance"),
+    ("hostins_ops", "setup_install_instance"): Task(
+        "pg_tasks.install_instance",
+        "setup_install_instance",
+        lambda handler, docker_env: handler(source=MANAGER),
+    ),
+    ("hostins_ops", "generate_new_wal"): host_operation("switch_new_wal"),
+    ("hostins_ops", "check_download_archive_status"): host_operation(
+        "check_download_archive_status"
+    ),
+    ("hostins_ops", "fetch_archive_log_from_source"): host_operation(
+        "fetch_archive_log_from_source", call_with_env
+    ),
+    ("hostins_ops", "do_fetch_archive_log_from_source"): host_operation(
+        "do_fetch_archive_log_from_source"
+    ),
+    ("hostins_ops", "check_fetch_archive_from_source_status"): host_operation(
+        "check_fetch_archive_from_source_status"
+    ),
+    ("hostins_ops", "restore_prepared"): host_operation("restore_prepared"),
+    ("hostins_ops", "check_restore_running_status"): host_operation(
+        "check_restore_running_status"
+    ),
+    ("hostins_ops", "add_dma_follower_to_cluster"): host_operation(
+        "add_dma_follower_to_cluster"
+    ),
+    ("hostins_ops", "enable_ssl"): Task("pg_tasks.ssl_instance", "SSLInstance"),
+    ("hostins_ops", "disable_ssl"): Task("pg_tasks.ssl_instance", "SSLInstance"),
+    ("hostins_ops", "process_cleanup"): host_operation(
+        "lock_stop_instance", lambda handler, docker_env: handler(lock=False)
+    ),
+    ("hostins_ops", "create_tablespace"): host_operation("create_tablespace"),
+    (None, "lock_stop_instance"): host_operation("lock_stop_instance"),
+    (None, "unlock_start_instance"): host_operation("unlock_start_instance"),
+    (None, "rebuild_local_dir"): host_operation("rebuild_local_dir"),
+    (None, "rotate_tde_key"): Task(
+        "pg_tasks.update_tde_kek",
+        "TDEManager",
+        lambda handler, docker_env: handler(docker_env).rotate_tde_key(),
+    ),
+}
+
+
+def find_task(srv_opr_type, srv_opr_action):
+    for key in (
+        (srv_opr_type, srv_opr_action),
+        (srv_opr_type, None),
+        (None, srv_opr_action),
+    ):
+        if key in TASKS:
+            return TASKS[key]
+    raise Exception("Not support the operator of %s type" % srv_opr_type)
+
+
 # 管控传递的env的key一般是小写
 def print_operation_envs(srv_opr_type, srv_opr_action, all_envs):
     operation_envs = {}
@@ -123,119 +223,42 @@ def print_operation_envs(srv_opr_type, srv_opr_action, all_envs):
     )
 
 
+def run_batch_operations(docker_env):
+    from pg_utils import pg_connection
+
+    # the logs of the steps go to stdout already, capture what they print
+    install_operation_output(log_records=False)
+    if pg_connection.connection_pool is None:
+        pg_connection.enable_connection_pool()
+
+    response = run_batch(docker_env, tee=True)
+    print(json.dumps(response["result"]))
+    if response["exit_code"] != 0:
+        sys.exit(response["exit_code"])
+
+
 def entry(docker_env):
+    if docker_env.get("srv_opr_batch"):
+        run_batch_operations(docker_env)
+        return
+
     srv_opr_action = docker_env.get("srv_opr_action")
     srv_opr_type = docker_env.get("srv_opr_type")
 
     print_operation_envs(srv_opr_type, srv_opr_action, docker_env)
 
-    if srv_opr_type == "init_ins":
-        if srv_opr_action == "initdb":
-            logger.info("WANNING: skip initdb step")
-            sys.exit(0)
-        else:
-            raise Exception("Unsupported operate action")
-    elif srv_opr_type == "replica":
-        replica_manager = ReplicaManager(docker_env)
-        replica_manager.do_action()
-    elif srv_opr_type == "stop":
-        stop_instance = StopInstance(docker_env)
-        stop_instance.do_action()
-    elif srv_opr_type == "account":
-        user_manager = UserManager(docker_env)
-        user_manager.do_action()
-    elif srv_opr_type == "health_check":
-        health_checker = HealthChecker(docker_env)
-        health_checker.do_action()
-    elif srv_opr_type == "backup":
-        instance_backuper = BackupInstance(docker_env)
-        instance_backuper.do_action()
-    elif srv_opr_type == "restore":
-        instance_restorer = RestoreInstance(docker_env)
-        instance_restorer.do_action()
-    elif srv_opr_type == "lock_ins":
-        instance_locker = LockInstance(docker_env)
-        instance_locker.do_action()
-    elif srv_opr_type == "update_conf":
-        instance_configer = PgConfiger(docker_env)
-        instance_configer.do_action()
-    # 生成UE需要的监控元信息
-    elif srv_opr_type == "hostins_ops" and srv_opr_action == "setup_logagent_config":
-        setup_logagent_config()
-    elif srv_opr_type == "hostins_ops" and srv_opr_action == "get_system_identifier":
-        get_system_identifier()
-    elif srv_opr_type == "hostins_ops" and srv_opr_action == "grow_pfs":
-        grow_pfs()
-    elif srv_opr_type == "hostins_ops" and srv_opr_action == "build_recovery":
-        update_recovery_conf()
-    elif srv_opr_type == "hostins_ops" and srv_opr_action == "stop_instance":
-        lock_stop_instance()
-    elif srv_opr_type == "hostins_ops" and srv_opr_action == "start_instance":
-        unlock_start_instance()
-    elif srv_opr_type == "hostins_ops" and srv_opr_action == "restart_instance":
-        restart_instance()
-    elif srv_opr_type == "hostins_ops" and srv_opr_action == "setup_install_instance":
-        setup_install_instance(source=MANAGER)
-    elif srv_opr_type == "hostins_ops" and srv_opr_action == "generate_new_wal":
-        switch_new_wal()
-    elif (
-        srv_opr_type == "hostins_ops"
-        and srv_opr_action == "check_download_archive_status"
-    ):
-        check_download_archive_status()
-    elif (
-        srv_opr_type == "hostins_ops"
-        and srv_opr_action == "fetch_archive_log_from_source"
-    ):
-        fetch_archive_log_from_source(docker_env)
-    elif (
-        srv_opr_type == "hostins_ops"
-        and srv_opr_action == "do_fetch_archive_log_from_source"
-    ):
-        do_fetch_archive_log_from_source()
-    elif (
-        srv_opr_type == "hostins_ops"
-        and srv_opr_action == "check_fetch_archive_from_source_status"
-    ):
-        check_fetch_archive_from_source_status()
-    elif srv_opr_type == "hostins_ops" and srv_opr_action == "restore_prepared":
-        restore_prepared()
-    elif (
-        srv_opr_type == "hostins_ops"
-        and srv_opr_action == "check_restore_running_status"
-    ):
-        check_restore_running_status()
-    elif (
-        srv_opr_type == "hostins_ops"
-        and srv_opr_action == "add_dma_follower_to_cluster"
-    ):
-        add_dma_follower_to_cluster()
-    elif srv_opr_type == "hostins_ops" and srv_opr_action == "enable_ssl":
-        instance_ssl = SSLInstance(docker_env)
-        instance_ssl.do_action()
-    elif srv_opr_type == "hostins_ops" and srv_opr_action == "disable_ssl":
-        instance_ssl = SSLInstance(docker_env)
-        instance_ssl.do_action()
-    elif srv_opr_action == "lock_stop_instance":
-        lock_stop_instance()
-    elif srv_opr_action == "unlock_start_instance":
-        unlock_start_instance()
-    elif srv_opr_action == "rebuild_local_dir":
-        rebuild_local_dir()
-    elif srv_opr_action == "rotate_tde_key":
-        tde_manger = TDEManager(docker_env)
-        tde_manger.rotate_tde_key()
-    elif srv_opr_type == "hostins_ops" and srv_opr_action == "process_cleanup":
-        lock_stop_instance(lock=False)
-    elif srv_opr_type == "hostins_ops" and srv_opr_action == "create_tablespace":
-        create_tablespace()
-    else:
-        raise Exception("Not support the operator of %s type" % srv_opr_type)
+    task = find_task(srv_opr_type, srv_opr_action)
+    task(docker_env)
 
 
 if __name__ == "__main__":
     docker_env = os.environ
 
+    # run in the operation daemon of init_and_pause.py if it is serving
+    exit_code = run_in_daemon(docker_env)
+    if exit_code is not None:
+        sys.exit(exit_code)
+
     try:
         entry(docker_env)
     except Exception as e:
@@ -17,6 +17,8 @@ import time
 import os
 
 from pg_utils.envs import engine_env
+from pg_utils.logger import logger
+from pg_utils.manager_daemon import serve_operations
 from pg_utils.os_operate import (
     add_os_user,
     del_os_user,
@@ -38,6 +40,13 @@ def main():
         del_os_user(initdb_user, True)
         add_os_user(initdb_user, initdb_user_uid)
 
+    # serve the operations of entry_point.py, which run them in new interpreters
+    # while the daemon is not available
+    try:
+        serve_operations()
+    except Exception as e:
+        logger.exception(e)
+
     while True:
         time.sleep(86400 * 365)
 
@@ -25,6 +25,7 @@ import time
 from pg_tasks.install_instance import (
     build_recovery_conf,
     build_hba_conf,
+    get_replica_initdb_args,
     post_installation,
 )
 from pg_tasks.modify_postgresql_conf import (
@@ -34,7 +35,13 @@ from pg_tasks.modify_postgresql_conf import (
 from pg_utils.envs import engine_env
 from pg_utils.logger import logger
 from pg_utils.utils import pid_exists
-from pg_utils.os_operate import exec_command, safe_rmtree, mkdir_paths, chown_paths
+from pg_utils.os_operate import safe_rmtree, mkdir_paths, chown_paths
+from pg_utils.pg_common import (
+    copy_user_file,
+    run_as_user,
+    run_command,
+    write_user_file,
+)
 from pg_utils.pg_connection import Connection
 from pg_utils.pg_const import (
     PATH,
@@ -48,6 +55,7 @@ from pg_utils.pg_const import (
     RESTORE_JOB_STATUS,
     RESTORE_JOB_WORKER,
     RESTORE_JOB_LOG,
+    ENTRY_POINT_SCRIPT,
     SSL_CERT_PATH,
     SSL_KEY_PATH,
 )
@@ -139,7 +147,7 @@ def lock_stop_instance(lock=True):
         logger.warn("shutdown failed: %s", str(e))
         if "server does not shut down" in str(e):
             logger.info("execute shutdown_cleanup.sh")
-            exec_command("sh /shutdown_cleanup.sh", 60)
+            run_command("sh /shutdown_cleanup.sh", 60)
 
     # pg_ctl正常返回，但是pg进程可能还没有马上退出，不断检查直到退出或者超时
     while True:
@@ -150,13 +158,13 @@ def lock_stop_instance(lock=True):
             datetime.datetime.utcnow() - begin_time
         ).total_seconds() > engine_env.shutdown_timeout:
             logger.info("shutdown timeout, execute shutdown_cleanup.sh")
-            exec_command("sh /shutdown_cleanup.sh", 60)
+            run_command("sh /shutdown_cleanup.sh", 60)
         time.sleep(1)
 
     # https://work.aone.alibaba-inc.com/issue/23787647?spm=a2o8d.corp_prod_issue_detail_v2.0.0.5c1a38ccHESPoo
     if engine_env.shutdown_cleanup:
         cmd = "ps --no-headers -eo pid,ppid,cmd"
-        status, stdout = exec_command(cmd)
+        status, stdout = run_command(cmd)
         if status != 0:
             raise Exception("execute cmd failed, %s, %s" % (cmd, stdout))
         else:
@@ -207,18 +215,11 @@ def restart_instance():
 
 
 def build_pgsql_conf():
-    pcmd = 'su - %s -c "cat %s > %s/postgresql.conf "' % (
-        engine_env.get_initdb_user(),
-        POSTGRESQL_CONF_DEMO,
-        PGDATA,
-    )
-    logger.info("Run cmd: %s", pcmd)
-    status, stdout = exec_command(pcmd)
-    if status != 0:
-        raise Exception("ERROR: Run cmd error: %s" % stdout)
-    else:
-        logger.info("build empty postgresql.conf successfully!")
     postgres_conf_file = os.path.join(PGDATA, "postgresql.conf")
+    copy_user_file(
+        engine_env.get_initdb_user(), POSTGRESQL_CONF_DEMO, postgres_conf_file
+    )
+    logger.info("build empty postgresql.conf successfully!")
     build_postgresql_conf(
         postgres_conf_file,
         engine_env.get_server_port(),
@@ -253,14 +254,7 @@ def rebuild_local_dir():
     initdb_user = engine_env.get_initdb_user()
 
     _, polar_datadir = engine_env.get_polar_storage_params()
-    initdb_cmd = 'su - %s -c "sh %s/polar-replica-initdb.sh %s/ %s/ "' % (
-        initdb_user,
-        PATH,
-        polar_datadir,
-        PGDATA,
-    )
-    logger.info("Run polar-replica-initdb cmd: %s", initdb_cmd)
-    status, stdout = exec_command(initdb_cmd)
+    status, stdout = run_as_user(initdb_user, get_replica_initdb_args(polar_datadir))
     if status != 0:
         raise Exception("Run initdb cmd error: %s" % stdout)
     else:
@@ -337,13 +331,16 @@ def check_download_archive_status():
 
 def fetch_archive_log_from_source(docker_env):
     cmd = "mkdir -p %s" % RESTORE_DOWNLOADS_DIR
-    exec_command(cmd)
-    docker_env["srv_opr_action"] = "do_fetch_archive_log_from_source"
+    run_command(cmd)
+    job_env = dict(docker_env)
+    job_env["srv_opr_action"] = "do_fetch_archive_log_from_source"
+    # the job outlives the operation starting it
+    job_env.pop("srv_opr_timeout", None)
     f_log = open(RESTORE_JOB_LOG, "a")
+    # not sys.argv, the operation may run in the daemon of init_and_pause.py
     subprocess.Popen(
-        sys.argv,
-        env=docker_env,
-        shell=True,
+        [sys.executable, ENTRY_POINT_SCRIPT],
+        env=job_env,
         stdin=None,
         stdout=f_log,
         stderr=f_log,
@@ -419,12 +416,12 @@ def do_fetch_archive_log_from_source():
             RESTORE_DOWNLOADS_DIR,
             end_lsn,
         )
-        status, err = exec_command(cmd, timeout=320)
+        status, err = run_command(cmd, timeout=320)
         if status != 0:
             result["status"] = "failed"
             result["msg"] = "pg_receivewal exec failed: %s" % err
         else:
-            exec_command("rename .partial '' %s/*" % RESTORE_DOWNLOADS_DIR)
+            run_command("rename .partial '' %s/*" % RESTORE_DOWNLOADS_DIR)
             result["status"] = "completed"
             result["msg"] = "pg_receivewal done, end lsn: %s" % end_lsn
 
@@ -496,7 +493,7 @@ def move_log_to_pbd():
             )
         logger.info("move_log_to_pbd cmd is %s" % cmd)
         # lease of pbd mount is 5min, so timeout shoud be greater than that
-        status, _ = exec_command(cmd, timeout=320)
+        status, _ = run_command(cmd, timeout=320)
         if status != 0:
             raise Exception(
                 "pfs cp pg_wal file error, status is %d, cmd is %s" % (status, cmd)
@@ -512,27 +509,31 @@ def restore_prepared():
     if engine_env.pitr_time == "":
         logger.exception("pitr_time is empty")
     recovery_conf = "%s/recovery.conf" % PGDATA
-    status, _ = exec_command("grep 'recovery_target_time=' %s -n" % recovery_conf)
+    status, _ = run_command("grep 'recovery_target_time=' %s -n" % recovery_conf)
     if status == 0:
-        exec_command(
+        run_command(
             "sed -i \"s/recovery_target_time=.*$/recovery_target_time='%s'/g\" %s"
             % (engine_env.pitr_time, recovery_conf)
         )
     else:
-        exec_command(
-            'su -l %s -c "echo \\"recovery_target_time=\'%s\'\\" >> %s"'
-            % (engine_env.get_initdb_user(), engine_env.pitr_time, recovery_conf)
+        write_user_file(
+            engine_env.get_initdb_user(),
+            recovery_conf,
+            "recovery_target_time='%s'\n" % engine_env.pitr_time,
+            append=True,
         )
 
-    status, _ = exec_command("grep 'restore_command=' %s -n" % recovery_conf)
+    status, _ = run_command("grep 'restore_command=' %s -n" % recovery_conf)
     if status == 0:
-        exec_command(
+        run_command(
             "sed -i \"s/restore_command=.*$/restore_command=''/g\" %s" % recovery_conf
         )
     else:
-        exec_command(
-            'su -l %s -c "echo \\"restore_command=\'\'\\" >> %s"'
-            % (engine_env.get_initdb_user(), recovery_conf)
+        write_user_file(
+            engine_env.get_initdb_user(),
+            recovery_conf,
+            "restore_command=''\n",
+            append=True,
         )
 
     logger.info("creating backup_label")
@@ -540,17 +541,17 @@ def restore_prepared():
     pfs_backup_label = "/%s/data/polar_exclusive_backup_label" % disk
     local_backup_label = "/%s/backup_label" % PGDATA
     cmd = "pfs -C disk cp -S disk -f %s %s" % (pfs_backup_label, local_backup_label)
-    status, _ = exec_command(cmd)
+    status, _ = run_command(cmd)
     if status != 0:
         raise Exception(
             "pfs cp backup label error, status is %d, cmd is %s" % (status, cmd)
         )
 
-    exec_command("chown postgres:postgres %s" % local_backup_label)
-    exec_command("cat %s" % local_backup_label)
+    run_command("chown postgres:postgres %s" % local_backup_label)
+    run_command("cat %s" % local_backup_label)
 
     logger.info("removing old logindex")
-    exec_command("pfs -C disk rm -r /%s/data/pg_logindex" % disk, timeout=320)
+    run_command("pfs -C disk rm -r /%s/data/pg_logindex" % disk, timeout=320)
 
     result = {"status": "completed", "msg": "restore_prepared done"}
     logger.info(json.dumps(result))
@@ -666,31 +667,17 @@ def switch_new_wal():
 
 
 def prepare_ssl_files(crt_content, key_content):
-    # create cert and key file
-    rc, _ = exec_command(
-        'su -l %s -c "echo \\"%s\\" > %s"'
-        % (engine_env.get_initdb_user(), crt_content, SSL_CERT_PATH)
-    )
-
-    if rc != 0:
-        logger.exception("can't find create ssl cert file, ret code %d" % (rc))
-
-    rc, _ = exec_command(
-        'su -l %s -c "echo \\"%s\\" > %s"'
-        % (engine_env.get_initdb_user(), key_content, SSL_KEY_PATH)
-    )
-
-    if rc != 0:
-        logger.exception("can't find create ssl key file, ret code %d" % (rc))
-
-    # change file permission to 600
-    rc, _ = exec_command(
-        'su -l %s -c "chmod 600 %s %s"'
-        % (engine_env.get_initdb_user(), SSL_CERT_PATH, SSL_KEY_PATH)
-    )
-
-    if rc != 0:
-        logger.exception("change ssl cert/key file permission fail, ret code %d" % (rc))
+    # create cert and key file with permission 600
+    for name, path, content in (
+        ("cert", SSL_CERT_PATH, crt_content),
+        ("key", SSL_KEY_PATH, key_content),
+    ):
+        try:
+            write_user_file(
+                engine_env.get_initdb_user(), path, "%s\n" % content, mode=0o600
+            )
+        except (IOError, OSError) as e:
+            logger.exception("can't create ssl %s file: %s" % (name, e))
 
     logger.info("prepare ssl cert/key file done.")
 
@@ -766,7 +753,7 @@ def get_system_identifier():
     pfs_control_file = "/%s/data/global/pg_control" % disk
     local_control_file = "/%s/global/pg_control" % PGDATA
     cmd = "pfs -C disk cp -S disk -f %s %s" % (pfs_control_file, local_control_file)
-    status, stdout = exec_command(cmd, timeout=320)
+    status, stdout = run_command(cmd, timeout=320)
     if status != 0:
         raise Exception("Run cmd error: %s" % stdout)
     else:
@@ -775,7 +762,7 @@ def get_system_identifier():
         )
 
     cmd = "%s/pg_controldata -D %s" % (PATH, PGDATA)
-    status, stdout = exec_command(cmd)
+    status, stdout = run_command(cmd)
     if status != 0:
         raise Exception("Failed to get system identifier: %s" % stdout)
 
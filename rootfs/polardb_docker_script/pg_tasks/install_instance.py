@@ -37,6 +37,7 @@ port: The list of port:
 """
 
 import os
+import shlex
 import shutil
 import json
 
@@ -61,8 +62,14 @@ from pg_utils.os_operate import (
     del_os_user,
     is_os_user_exists,
     add_user_to_group,
+    get_process_pids,
+)
+from pg_utils.pg_common import (
+    copy_user_file,
+    is_share_storage,
+    run_as_user,
+    run_command,
 )
-from pg_utils.pg_common import exec_command, is_share_storage
 from pg_utils.pg_const import (
     PG_EXTERNAL_DATA,
     DMA_ROLE_MASTER,
@@ -72,6 +79,11 @@ from pg_utils.pg_const import (
     STORAGE_TYPE_FC_SAN,
     DEFAULT_TDE_CLUSTER_COMMAND_PREFIX,
     DEFAULT_TDE_FUNCTION_OPT,
+    PFSD_PROCESS_NAME,
+    PFSD_PROBE_TIMEOUT,
+    PFSD_READY_MAX_INTERVAL,
+    PFSD_READY_MIN_INTERVAL,
+    PFSD_READY_TIMEOUT,
 )
 from pg_utils.pg_const import (
     INS_CTX,
@@ -92,6 +104,7 @@ from pg_tasks.update_tde_kek import copy_tde_script
 import time
 
 from pg_utils.os_operate import remove_file
+from pg_utils.path_watcher import PathWatcher
 
 INSTANCE_INSTALLATION_STEPS = ["prepare", "done"]
 
@@ -166,16 +179,12 @@ def write_recovery_cnf(cust_params):
 
 
 def build_recovery_conf(custom_params):
-    pcmd = 'su - %s -c "cat /recovery.conf.demo > %s/recovery.conf "' % (
+    copy_user_file(
         engine_env.get_initdb_user(),
-        PGDATA,
+        "/recovery.conf.demo",
+        "%s/recovery.conf" % PGDATA,
     )
-    logger.info("Run cmd: %s", pcmd)
-    status, stdout = exec_command(pcmd)
-    if status != 0:
-        raise Exception("Run cmd error: %s" % stdout)
-    else:
-        logger.info("Build empty recovery.conf successfully!")
+    logger.info("Build empty recovery.conf successfully!")
     write_recovery_cnf(custom_params)
 
 
@@ -191,32 +200,23 @@ def install_datamax_instance(initdb_user, polar_storage_cluster_name=""):
     if pfs_inited:
         init_pfs(False, initdb_user, polar_datadir, polar_storage_cluster_name)
 
-        pcmd = 'su - %s -c "cat %s > %s "' % (
-            initdb_user,
-            POSTGRESQL_CONF_DEMO,
-            postgres_conf_file,
-        )
-        logger.info("Run cmd: %s", pcmd)
-        status, stdout = exec_command(pcmd)
-        if status != 0:
-            raise Exception("Run cmd error: %s" % stdout)
-        else:
-            logger.info("Build empty postgresql.conf successfully!")
+        copy_user_file(initdb_user, POSTGRESQL_CONF_DEMO, postgres_conf_file)
+        logger.info("Build empty postgresql.conf successfully!")
     else:
         # exec initdb by user initdb_user
-        initdb_cmd = (
-            'su - %s -c "%s/initdb -E UTF8 --locale=C -U %s %s -D %s -i %s"'
-            % (
-                initdb_user,
-                engine_env.pg_base_bin_dir,
+        initdb_args = (
+            [
+                "%s/initdb" % engine_env.pg_base_bin_dir,
+                "-E",
+                "UTF8",
+                "--locale=C",
+                "-U",
                 initdb_user,
-                POSTGRES_INITDB_ARGS,
-                PGDATA,
-                engine_env.primary_system_identifier,
-            )
+            ]
+            + shlex.split(POSTGRES_INITDB_ARGS)
+            + ["-D", PGDATA, "-i", engine_env.primary_system_identifier]
         )
-        logger.info("Run initdb cmd: %s", initdb_cmd)
-        status, stdout = exec_command(initdb_cmd)
+        status, stdout = run_as_user(initdb_user, initdb_args)
         if status != 0:
             raise Exception("Run initdb cmd error: %s" % stdout)
         else:
@@ -256,6 +256,27 @@ def install_datamax_instance(initdb_user, polar_storage_cluster_name=""):
         init_pfs(True, initdb_user, polar_datadir, polar_storage_cluster_name)
 
 
+def get_initdb_args(initdb_user):
+    return (
+        ["%s/initdb" % engine_env.pg_base_bin_dir, "--username=%s" % initdb_user]
+        + shlex.split(POSTGRES_INITDB_ARGS)
+        + ["-D", PGDATA]
+    )
+
+
+def get_replica_initdb_args(polar_datadir, polar_storage_cluster_name=""):
+    replica_initdb_args = [
+        "sh",
+        "%s/polar-replica-initdb.sh" % PATH,
+        "%s/" % polar_datadir,
+        "%s/" % PGDATA,
+    ]
+    # an empty cluster name is no argument, like in the shell command it replaced
+    if polar_storage_cluster_name:
+        replica_initdb_args.append(polar_storage_cluster_name)
+    return replica_initdb_args
+
+
 def init_pfs(first_init, initdb_user, polar_datadir, polar_storage_cluster_name):
     make_dir_use_pfs(polar_datadir, polar_storage_cluster_name)
 
@@ -266,16 +287,13 @@ def init_pfs(first_init, initdb_user, polar_datadir, polar_storage_cluster_name)
             polar_datadir,
             polar_storage_cluster_name,
         )
+        logger.info("Run cmd: %s", pinitdb_cmd)
+        status, stdout = run_command(pinitdb_cmd)
     else:
-        pinitdb_cmd = 'su - %s -c "sh %s/polar-replica-initdb.sh %s/ %s/ %s"' % (
+        status, stdout = run_as_user(
             initdb_user,
-            PATH,
-            polar_datadir,
-            PGDATA,
-            polar_storage_cluster_name,
+            get_replica_initdb_args(polar_datadir, polar_storage_cluster_name),
         )
-    logger.info("Run cmd: %s", pinitdb_cmd)
-    status, stdout = exec_command(pinitdb_cmd)
     if status != 0:
         raise Exception("Run cmd error: %s" % stdout)
     else:
@@ -297,41 +315,23 @@ def install_rw_instance(initdb_user, polar_storage_cluster_name=""):
     if pfs_inited:
         init_pfs(False, initdb_user, polar_datadir, polar_storage_cluster_name)
 
-        pcmd = 'su - %s -c "cat %s > %s "' % (
-            initdb_user,
-            POSTGRESQL_CONF_DEMO,
-            postgres_conf_file,
-        )
-        logger.info("Run cmd: %s", pcmd)
-        status, stdout = exec_command(pcmd)
-        if status != 0:
-            raise Exception("Run cmd error: %s" % stdout)
-        else:
-            logger.info("Build empty postgresql.conf successfully!")
+        copy_user_file(initdb_user, POSTGRESQL_CONF_DEMO, postgres_conf_file)
+        logger.info("Build empty postgresql.conf successfully!")
     else:
         # exec initdb by user initdb_user
-        tde_opt = ""
+        initdb_args = get_initdb_args(initdb_user)
         if tde_enable:
             secret_get = engine_env.secret_get
             cluster_passphrase_command = "%s %s" % (
                 DEFAULT_TDE_CLUSTER_COMMAND_PREFIX,
                 secret_get,
             )
-            tde_opt = "--cluster-passphrase-command='%s' %s" % (
-                cluster_passphrase_command,
-                DEFAULT_TDE_FUNCTION_OPT,
+            initdb_args.append(
+                "--cluster-passphrase-command=%s" % cluster_passphrase_command
             )
+            initdb_args.extend(shlex.split(DEFAULT_TDE_FUNCTION_OPT))
 
-        initdb_cmd = 'su - %s -c "%s/initdb --username=%s %s -D %s %s"' % (
-            initdb_user,
-            engine_env.pg_base_bin_dir,
-            initdb_user,
-            POSTGRES_INITDB_ARGS,
-            PGDATA,
-            tde_opt,
-        )
-        logger.info("Run initdb cmd: %s", initdb_cmd)
-        status, stdout = exec_command(initdb_cmd, 600)
+        status, stdout = run_as_user(initdb_user, initdb_args, timeout=600)
         if status != 0:
             raise Exception("Run initdb cmd error: %s" % stdout)
         else:
@@ -368,15 +368,10 @@ def install_rw_instance(initdb_user, polar_storage_cluster_name=""):
 def install_ro_instance(initdb_user, standby_mode=False, polar_storage_cluster_name=""):
     # exec polar-replica-initdb by user initdb_user
     polar_disk_name, polar_datadir = engine_env.get_polar_storage_params()
-    pinitdb_cmd = 'su - %s -c "sh %s/polar-replica-initdb.sh %s/ %s/ %s"' % (
+    status, stdout = run_as_user(
         initdb_user,
-        PATH,
-        polar_datadir,
-        PGDATA,
-        polar_storage_cluster_name,
+        get_replica_initdb_args(polar_datadir, polar_storage_cluster_name),
     )
-    logger.info("Run polar-replica-initdb cmd: %s", pinitdb_cmd)
-    status, stdout = exec_command(pinitdb_cmd)
     if status != 0:
         raise Exception("Run initdb cmd error: %s" % stdout)
     else:
@@ -386,18 +381,9 @@ def install_ro_instance(initdb_user, standby_mode=False, polar_storage_cluster_n
         copy_tde_script()
 
     # build postgresql.conf
-    pcmd = 'su - %s -c "cat %s > %s/postgresql.conf "' % (
-        initdb_user,
-        POSTGRESQL_CONF_DEMO,
-        PGDATA,
-    )
-    logger.info("Run cmd: %s", pcmd)
-    status, stdout = exec_command(pcmd)
-    if status != 0:
-        raise Exception("Run cmd error: %s" % stdout)
-    else:
-        logger.info("Build empty postgresql.conf successfully!")
     postgres_conf_file = os.path.join(PGDATA, "postgresql.conf")
+    copy_user_file(initdb_user, POSTGRESQL_CONF_DEMO, postgres_conf_file)
+    logger.info("Build empty postgresql.conf successfully!")
     build_postgresql_conf(
         postgres_conf_file,
         engine_env.get_access_port_from_port(),
@@ -427,15 +413,7 @@ def install_ro_instance(initdb_user, standby_mode=False, polar_storage_cluster_n
 
 def install_normal_instance(initdb_user, standby_mode=False):
     # exec initdb by user initdb_user
-    initdb_cmd = 'su - %s -c "%s/initdb --username=%s %s -D %s"' % (
-        initdb_user,
-        engine_env.pg_base_bin_dir,
-        initdb_user,
-        POSTGRES_INITDB_ARGS,
-        PGDATA,
-    )
-    logger.info("Run initdb cmd: %s", initdb_cmd)
-    status, stdout = exec_command(initdb_cmd)
+    status, stdout = run_as_user(initdb_user, get_initdb_args(initdb_user))
     if status != 0:
         raise Exception("Run initdb cmd error: %s" % stdout)
     else:
@@ -464,28 +442,19 @@ def install_dma_instance(initdb_user):
     dma_conf_file = os.path.join(PGDATA, "polar_dma.conf")
     if engine_env.dma_role == DMA_ROLE_MASTER:
         # exec initdb by user initdb_user
-        initdb_cmd = 'su - %s -c "%s/initdb --username=%s %s -D %s"' % (
-            initdb_user,
-            engine_env.pg_base_bin_dir,
-            initdb_user,
-            POSTGRES_INITDB_ARGS,
-            PGDATA,
-        )
-        logger.info("Run initdb cmd: %s", initdb_cmd)
-        status, stdout = exec_command(initdb_cmd)
+        status, stdout = run_as_user(initdb_user, get_initdb_args(initdb_user))
         if status != 0:
             raise Exception("Run initdb cmd error: %s" % stdout)
         else:
             logger.info("Run initdb cmd successfully!")
 
-        polar_initdb_cmd = 'su - %s -c "%s/polar-initdb.sh %s/ %s/ localfs"' % (
-            initdb_user,
-            engine_env.pg_base_bin_dir,
-            PGDATA,
-            PG_EXTERNAL_DATA,
-        )
-        logger.info("Run polar initdb cmd: %s", polar_initdb_cmd)
-        status, stdout = exec_command(polar_initdb_cmd)
+        polar_initdb_args = [
+            "%s/polar-initdb.sh" % engine_env.pg_base_bin_dir,
+            "%s/" % PGDATA,
+            "%s/" % PG_EXTERNAL_DATA,
+            "localfs",
+        ]
+        status, stdout = run_as_user(initdb_user, polar_initdb_args)
         if status != 0:
             raise Exception("Run polar initdb error: %s" % stdout)
         else:
@@ -526,18 +495,28 @@ def install_dma_instance(initdb_user):
         repl_account_info = engine_env.get_primary_account_by_privilege_type(
             PRIVILEDGE_TYPE_REPLICATE
         )[0]
-        backup_cmd = 'su - %s -c "PGPASSWORD=%s %s/polar_basebackup -h %s -p %s -U %s -P -R -D %s --polardata=%s -X stream"' % (
-            initdb_user,
-            repl_account_info["password"],
-            engine_env.pg_base_bin_dir,
+        backup_args = [
+            "%s/polar_basebackup" % engine_env.pg_base_bin_dir,
+            "-h",
             primary_ins_info["ins_ip"],
-            primary_ins_info["port"],
+            "-p",
+            str(primary_ins_info["port"]),
+            "-U",
             repl_account_info["account"],
+            "-P",
+            "-R",
+            "-D",
             PGDATA,
-            PG_EXTERNAL_DATA,
+            "--polardata=%s" % PG_EXTERNAL_DATA,
+            "-X",
+            "stream",
+        ]
+        status, stdout = run_as_user(
+            initdb_user,
+            backup_args,
+            env={"PGPASSWORD": repl_account_info["password"]},
+            log_output=True,
         )
-        logger.info("Run polar_basebackup cmd: %s", backup_cmd)
-        status, stdout = exec_command(backup_cmd)
         if status != 0:
             raise Exception("Run polar_basebackup error: %s" % stdout)
         else:
@@ -550,18 +529,20 @@ def install_dma_instance(initdb_user):
         master_suffix = "@1"
         dma_join_key = "polar_dma_members_info"
     ins_info = engine_env.get_ins_info()
-    cmd = 'su - %s -c "%s/polar-postgres -D %s -c polar_dma_init_meta=ON -c %s="%s:%s%s" -p %s"' % (
-        initdb_user,
-        engine_env.pg_base_bin_dir,
+    dma_init_args = [
+        "%s/polar-postgres" % engine_env.pg_base_bin_dir,
+        "-D",
         PGDATA,
-        dma_join_key,
-        ins_info["ins_ip"],
-        ins_info["port"],
-        master_suffix,
-        ins_info["port"],
-    )
-    logger.info("Run dma %s init cmd: %s", engine_env.dma_role, cmd)
-    status, stdout = exec_command(cmd)
+        "-c",
+        "polar_dma_init_meta=ON",
+        "-c",
+        "%s=%s:%s%s"
+        % (dma_join_key, ins_info["ins_ip"], ins_info["port"], master_suffix),
+        "-p",
+        str(ins_info["port"]),
+    ]
+    logger.info("Run dma %s init", engine_env.dma_role)
+    status, stdout = run_as_user(initdb_user, dma_init_args)
     if status != 0:
         raise Exception("Run dma %s init cmd error: %s" % (engine_env.dma_role, stdout))
     else:
@@ -669,34 +650,32 @@ def backup_from_rw(initdb_user, polar_storage_cluster_name=""):
     polar_disk_name, polar_datadir = engine_env.get_polar_storage_params()
     polar_host_id = engine_env.polarfs_host_id
     is_write_recovery_conf = engine_env.is_write_recovery_conf()
+    backup_args = [
+        "%s/polar_basebackup" % engine_env.pg_base_bin_dir,
+        "-h",
+        primary_ins_info["ins_ip"],
+        "-p",
+        str(primary_ins_info["port"]),
+        "-U",
+        repl_account_info["account"],
+        "-P",
+        "-D",
+        PGDATA,
+        "--polardata=%s" % polar_datadir,
+        "--polar_storage_cluster_name=%s" % polar_storage_cluster_name,
+        "--polar_disk_name=%s" % polar_disk_name,
+        "--polar_host_id=%s" % polar_host_id,
+    ]
     if is_write_recovery_conf:
-        write_recovery_flag = " -R"
-    else:
-        write_recovery_flag = " "
+        backup_args.append("-R")
+    backup_args.extend(["-X", "stream"])
 
-    backup_cmd = (
-        'su - %s -c "PGPASSWORD=%s %s/polar_basebackup -h %s -p %s -U %s -P -D %s '
-        "--polardata=%s  --polar_storage_cluster_name=%s "
-        '--polar_disk_name=%s --polar_host_id=%s  %s -X stream"'
-        % (
-            initdb_user,
-            repl_account_info["password"],
-            engine_env.pg_base_bin_dir,
-            primary_ins_info["ins_ip"],
-            primary_ins_info["port"],
-            repl_account_info["account"],
-            PGDATA,
-            polar_datadir,
-            polar_storage_cluster_name,
-            polar_disk_name,
-            polar_host_id,
-            write_recovery_flag,
-        )
+    status, stdout = run_as_user(
+        initdb_user,
+        backup_args,
+        env={"PGPASSWORD": repl_account_info["password"]},
+        log_output=True,
     )
-
-    logger.info("Run polar_basebackup cmd: %s", backup_cmd)
-    status, stdout = exec_command(backup_cmd)
-    logger.info("Run polar_basebackup output [%s]" % stdout)
     if status != 0:
         raise Exception("Run polar_basebackup error: %s" % stdout)
     else:
@@ -746,15 +725,9 @@ def is_installation_prepare():
 
 
 def wait_for_installation_completed():
-    sleep_times = 0
-    while True:
-        if is_installation_completed():
-            break
-
-        if sleep_times % 60 == 0:
+    with PathWatcher(INS_INSTALL_STEP) as watcher:
+        while not watcher.wait_for(is_installation_completed, 60):
             logger.info("Instance is installing, wait and check later...")
-        time.sleep(1)
-        sleep_times += 1
     logger.info("Instance installation completed, ready to start")
 
 
@@ -793,30 +766,70 @@ def post_installation():
         fd.write(json.dumps(ctx))
 
 
-def wait_pfs_deamon_ready():
-    # We wait for the pfsdeamon process no more than five times for 8 seconds each time.
-    wait_pfs_deamon_sleep_count = 0
-    while wait_pfs_deamon_sleep_count < 5:
-        pfs_daemon = os.popen("pgrep pfsdaemon")
-        pfs_daemon_pid = pfs_daemon.read()
-        pfs_daemon.close()
+def is_pfs_daemon_running():
+    return bool(get_process_pids(PFSD_PROCESS_NAME))
 
-        if pfs_daemon_pid:
-            break
-        time.sleep(8)
-        wait_pfs_deamon_sleep_count += 1
-        logger.info(
-            "pfsdaemon process is not exist, Waiting for 8 seconds has been %s times.",
-            wait_pfs_deamon_sleep_count,
-        )
-        if wait_pfs_deamon_sleep_count >= 5:
-            break
-    logger.info("The pfsd is ready, continue")
+
+def is_pfs_disk_usable(disk_name):
+    """
+    Whether pfsdaemon serves the disk, probed with pfs stat like the pfs commands
+    of the operations. pfsdaemon talks to pfs through a shm channel, there is no
+    socket of it to check. A missing pfs tool is not waited for.
+    """
+    cmd = "pfs -C disk stat /%s" % disk_name.strip("/")
+    status, output = run_command(cmd, timeout=PFSD_PROBE_TIMEOUT)
+    if status == 127:
+        logger.warn("Can not probe the disk with pfs: %s", output.strip())
+        return True
+    if status != 0:
+        logger.info("The disk is not usable yet, %s: %s", cmd, output.strip())
+    return status == 0
+
+
+def wait_with_backoff(predicate, deadline):
+    """
+    Check predicate() at an interval doubling from PFSD_READY_MIN_INTERVAL to
+    PFSD_READY_MAX_INTERVAL until it is true or the deadline passed.
+    """
+    interval = PFSD_READY_MIN_INTERVAL
+    while not predicate():
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+        time.sleep(min(interval, remaining))
+        interval = min(interval * 2, PFSD_READY_MAX_INTERVAL)
+    return True
+
+
+def wait_pfs_deamon_ready(disk_name=None):
+    """
+    Wait no longer than PFSD_READY_TIMEOUT seconds for the pfsdaemon process in
+    /proc, then for the disk to be usable through it, probed with pfs stat once
+    the process is there. Without a disk_name only the process is waited for.
+    Return the seconds waited, the instance is started anyway after the timeout.
+    """
+    start_time = time.time()
+    deadline = start_time + PFSD_READY_TIMEOUT
+    is_ready = wait_with_backoff(is_pfs_daemon_running, deadline)
+    if is_ready and disk_name:
+        is_ready = wait_with_backoff(lambda: is_pfs_disk_usable(disk_name), deadline)
+
+    wait_time = time.time() - start_time
+    if is_ready:
+        logger.info("The pfsd is ready after %.3fs, continue", wait_time)
+    else:
+        logger.warn("The pfsd is not ready after %.3fs, continue", wait_time)
+    return wait_time
 
 
 def setup_install_instance(source):
     if is_share_storage(engine_env.storage_type):
-        wait_pfs_deamon_ready()
+        try:
+            polar_disk_name, _ = engine_env.get_polar_storage_params()
+        except Exception as e:
+            logger.warn("Can not get the disk to probe, wait for pfsd only: %s", e)
+            polar_disk_name = None
+        wait_pfs_deamon_ready(polar_disk_name)
 
     if is_installation_completed():
         logger.info("The installation is already completed, skip")
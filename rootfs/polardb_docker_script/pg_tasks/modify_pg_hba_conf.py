@@ -17,7 +17,7 @@
 build pg_hba.conf file
 """
 from pg_utils.logger import logger
-from pg_utils.pg_common import exec_command
+from pg_utils.pg_common import run_command
 
 
 def clear_hba_conf(pg_hba_conf):
@@ -98,7 +98,7 @@ def add_new_replicator_in_hba(pg_hba_conf, new_slave_ip):
         % pg_hba_conf
     )
     logger.info("syscmd: %s", syscmd)
-    stat, output = exec_command(syscmd)
+    stat, output = run_command(syscmd)
     if stat == 0 and output.strip() == "No":
         logger.info("This is an old pg_hba.conf format instance.to compatible")
         add_user_in_hba(pg_hba_conf, userinfo)
@@ -109,7 +109,7 @@ def add_new_replicator_in_hba(pg_hba_conf, new_slave_ip):
             % (line, pg_hba_conf)
         )
         logger.info("syscmd: %s", syscmd)
-        stat, output = exec_command(syscmd)
+        stat, output = run_command(syscmd)
         if stat != 0:
             raise Exception("syscmd '%s' failed. output:%s" % (syscmd, output))
     else:
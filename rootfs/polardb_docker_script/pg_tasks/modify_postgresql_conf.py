@@ -22,7 +22,7 @@ import os
 from pg_utils.envs import engine_env
 from pg_utils.logger import logger
 from pg_utils.parse_docker_env import get_instance_user
-from pg_utils.pg_common import exec_command
+from pg_utils.pg_common import run_command
 from pg_utils.pg_const import (
     POSTGRESQL_CONF_DEMO,
     NEED_UPGRADE_POSTGRESQL_CONF_PARAMS,
@@ -209,7 +209,7 @@ def set_sysctl_conf(mem_size):
     # other_os_params.update({'kernel.shmall':int(mem_size)*0.8*1024, 'kernel.shmmax':int(mem_size)*0.5*1024})
     write_properties_cnf(other_os_params, democfg, outcfg)
     sysctl_reload_cmd = "sysctl -p"
-    status, stdout = exec_command(sysctl_reload_cmd)
+    status, stdout = run_command(sysctl_reload_cmd)
     if status != 0:
         raise Exception("ERROR: %s!" % stdout)
 
@@ -34,7 +34,8 @@ from pg_utils.os_operate import (
 )
 from pg_utils.utils import get_initdb_user_uid
 from pg_utils.os_operate import chown_paths
-from pg_utils.pg_common import exec_command, is_share_storage
+from pg_utils.path_watcher import PathWatcher
+from pg_utils.pg_common import is_share_storage
 from pg_utils.pg_const import (
     PGDATA,
     PATH,
@@ -46,8 +47,10 @@ from pg_utils.pg_const import (
     ENGINE,
     HUGETLB_SHM_GROUP,
     PG_LOCK_FILE,
+    POSTGRES_READY,
     STORAGE_TYPE_POLAR_STORE,
 )
+from pg_utils.pg_ctl import check_postgres_is_running, get_postgres_state
 
 # init global vars
 LD_LIBRARY_PATH = ":".join(filter(None, ALL_LIBRARY_PATHS))
@@ -61,31 +64,20 @@ def wait_for_postgres_exit(pg_user, pg_bin_dir, pg_data, time_out=300):
         time.sleep(1)
 
 
-def check_postgres_is_running(pg_user, pg_bin_dir, pg_data, time_out=300):
-    pg_ctl_cmd = "%s/pg_ctl status -D %s" % (pg_bin_dir, pg_data)
-    cmd = 'su -l %s -c "%s"' % (pg_user, pg_ctl_cmd)
-    status, _ = exec_command(cmd, time_out)
-    if status == 0:
-        return True
-
-    return False
-
-
 def is_instance_locked():
     return os.path.exists(INS_LOCK_FILE)
 
 
+def is_instance_unlocked():
+    return not is_instance_locked()
+
+
 def wait_for_instance_unlocked():
-    sleep_times = 0
-    while True:
-        if not is_instance_locked():
-            break
-        if sleep_times % 60 == 0:
+    with PathWatcher(INS_LOCK_FILE) as watcher:
+        while not watcher.wait_for(is_instance_unlocked, 60):
             logger.info(
                 "Found stop lock file %s, wait and check later...", INS_LOCK_FILE
             )
-        time.sleep(1)
-        sleep_times += 1
     logger.info("No stop lock file %s, instance is ready to start", INS_LOCK_FILE)
 
 
@@ -100,40 +92,21 @@ def get_pg_conf(key):
 
 # Read postmaster.pid to get the instance status and check if it is ready
 def is_instance_ready():
-    lock_file = PGDATA + "/" + PG_LOCK_FILE
-    try:
-        with open(lock_file, "r") as f:
-            lines = f.readlines()
-            # the status is at the last line (now is 8th line).
-            if len(lines) < 8:
-                return False
-            last_line = lines[-1]
-            logger.info("Instance status is %s" % last_line)
-            if last_line.strip() == "ready":
-                return True
-        return False
-    except IOError:
-        logger.info("Instance lock file %s does not exists." % lock_file)
-        return False
+    status = get_postgres_state(PGDATA)
+    logger.info("Instance status is %s" % status.state)
+    return status.state == POSTGRES_READY
 
 
 def wait_until_remove_user_from_group(process, user, group):
     logger.info("Try to remove user %s from group %s" % (user, group))
-    while not check_postgres_is_running(user, PATH, PGDATA):
-        logger.info("Instance hasn't start yet, waiting for it")
-        time.sleep(5)
-        if process.poll() is None:
-            continue
-        else:
-            return
-    while process.poll() is None:
-        time.sleep(5)
-        if is_instance_ready():
-            remove_user_from_group(user, group)
-            return
-        else:
+    # postmaster.pid is written when the postmaster starts and when it is ready,
+    # the exit of the process is checked every 5 seconds
+    with PathWatcher(os.path.join(PGDATA, PG_LOCK_FILE)) as watcher:
+        while process.poll() is None:
+            if watcher.wait_for(is_instance_ready, 5):
+                remove_user_from_group(user, group)
+                return
             logger.info("Instance is not ready, waiting ...")
-            continue
 
 
 def check_is_preload_polar_perf_tool(filepath):
@@ -203,16 +176,17 @@ def run_supervisor():
                 "can not find %s, use default storage type %s", INS_CTX, storage_type
             )
 
+        polar_disk_name = get_pg_conf("polar_disk_name")
+        if polar_disk_name:
+            polar_disk_name = polar_disk_name.strip("'").strip('"')
+
         if is_share_storage(storage_type):
-            wait_pfs_deamon_ready()
+            wait_pfs_deamon_ready(polar_disk_name)
 
         check_pfs_daemon_count += 1
 
-        polar_disk_name = get_pg_conf("polar_disk_name")
         if polar_disk_name:
-            block_device_name = "/dev/%s" % polar_disk_name.strip("'").strip(
-                '"'
-            ).replace("_", "/", 1)
+            block_device_name = "/dev/%s" % polar_disk_name.replace("_", "/", 1)
             if os.path.exists(block_device_name):
                 chown_paths([block_device_name], user="postgres", mode=660)
 
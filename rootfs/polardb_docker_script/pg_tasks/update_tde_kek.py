@@ -29,7 +29,7 @@ from pg_utils.pg_const import (
 )
 from pg_utils.envs import engine_env
 from pg_tasks.modify_postgresql_conf import modify_postgresql_conf
-from pg_utils.os_operate import exec_command
+from pg_utils.pg_common import run_command
 
 
 class TDEManager:
@@ -100,7 +100,7 @@ def copy_tde_script():
         "chmod +x %s" % (DEFAULT_TDE_SCRIPT, DEFAULT_TDE_SCRIPT)
     )
     logger.info("copy the tde_get_plain_dk script: %s", copy_tde_script_cmd)
-    status, stdout = exec_command(copy_tde_script_cmd)
+    status, stdout = run_command(copy_tde_script_cmd)
     if status != 0:
         raise Exception("Copy the tde_get_plain_dk script error: %s" % stdout)
     else:
@@ -14,8 +14,11 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 #
 
+import base64
 import json
 import os
+import zlib
+from collections import namedtuple
 
 from pg_utils.pg_const import (
     PGSQL_DB_VERSION,
@@ -32,19 +35,164 @@ from pg_utils.pg_const import (
 
 MIN_UID = 10000
 
+# large env payloads may be passed as the path of a json file or as zlib
+# compressed json in base64, a json value never starts with these prefixes
+ENV_PAYLOAD_FILE_PREFIX = "file:"
+ENV_PAYLOAD_ZLIB_PREFIX = "zlib:"
+
+
+def decode_env_payload(value):
+    if value.startswith(ENV_PAYLOAD_FILE_PREFIX):
+        with open(value[len(ENV_PAYLOAD_FILE_PREFIX):]) as f:
+            return f.read()
+    if value.startswith(ENV_PAYLOAD_ZLIB_PREFIX):
+        data = base64.b64decode(value[len(ENV_PAYLOAD_ZLIB_PREFIX):])
+        return zlib.decompress(data).decode("utf-8")
+    return value
+
+
+def load_env_payload(key, default=None):
+    """The json payload of the env key, default if it is not set."""
+    value = os.getenv(key)
+    if not value or value == '""':
+        return default
+    return json.loads(decode_env_payload(value))
+
+
+class cached_property(object):
+    """A property computed on first access and then stored in the instance."""
+
+    def __init__(self, func):
+        self.func = func
+        self.__name__ = func.__name__
+        self.__doc__ = func.__doc__
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        value = instance.__dict__[self.__name__] = self.func(instance)
+        return value
+
+
+# an instance of the topology: its role, the standby custins_id of the cluster it
+# belongs to (None for the primary cluster), its info, the rw instances it
+# replicates from and their accounts by privilege type
+TopologyInstance = namedtuple(
+    "TopologyInstance",
+    ["custins_id", "service_type", "cluster_id", "info", "primary_insts", "primary_accounts"],
+)
+
+
+def get_accounts_by_privilege_type(primary_insts):
+    accounts = {}
+    if primary_insts:
+        primary_ins = list(primary_insts.values())[0]
+        for acc_info in primary_ins.get("accounts", {}).values():
+            accounts.setdefault(acc_info["priviledge_type"], []).append(acc_info)
+    return accounts
+
+
+class TopologyIndex(object):
+    """
+    The instances of cluster_custins_info indexed once by service type and
+    custins_id, so a lookup does not scan every standby cluster for an RO.
+    With clustered standbys a standby maps to a cluster of its own:
+
+        {"rw": {id: info}, "ro": {id: info},
+         "standby": {standby_id: {"rw": {standby_id: info}, "ro": {id: info}}}}
+
+    The index is not changed after it is built, a new topology needs a new index.
+    """
+
+    def __init__(self, cluster_custins_info, ins_topology_4_replication=None):
+        self.instances = {}
+        self.replication = ins_topology_4_replication or {}
+        # the service type of each custins_id of ins_topology_4_replication
+        self.replication_service_types = {}
+        for service_type, ins_map in self.replication.items():
+            for ins_id in ins_map:
+                self.replication_service_types.setdefault(ins_id, service_type)
+
+        primary_insts = cluster_custins_info.get(SERVICE_TYPE_RW) or {}
+        primary_accounts = get_accounts_by_privilege_type(primary_insts)
+        standbys = cluster_custins_info.get(SERVICE_TYPE_STANDBY)
+        self.is_clustered_standby = bool(standbys) and (
+            SERVICE_TYPE_RW in list(standbys.values())[0]
+        )
+
+        if self.is_clustered_standby:
+            for standby_id, cluster in standbys.items():
+                cluster_primary_insts = cluster.get(SERVICE_TYPE_RW, {})
+                cluster_primary_accounts = get_accounts_by_privilege_type(
+                    cluster_primary_insts
+                )
+                for custins_id, info in cluster.get(SERVICE_TYPE_RO, {}).items():
+                    self.add(
+                        SERVICE_TYPE_RO,
+                        custins_id,
+                        standby_id,
+                        info,
+                        cluster_primary_insts,
+                        cluster_primary_accounts,
+                    )
+                if standby_id in cluster_primary_insts:
+                    self.add(
+                        SERVICE_TYPE_STANDBY,
+                        standby_id,
+                        standby_id,
+                        cluster_primary_insts[standby_id],
+                        primary_insts,
+                        primary_accounts,
+                    )
+
+        # instances of the primary cluster come last, they win over the standby clusters
+        for service_type, ins_map in cluster_custins_info.items():
+            if not isinstance(ins_map, dict):
+                continue
+            if self.is_clustered_standby and service_type == SERVICE_TYPE_STANDBY:
+                continue
+            if service_type in (SERVICE_TYPE_RO, SERVICE_TYPE_STANDBY):
+                insts, accounts = primary_insts, primary_accounts
+            else:
+                insts, accounts = {}, {}
+            for custins_id, info in ins_map.items():
+                self.add(service_type, custins_id, None, info, insts, accounts)
+
+    def add(self, service_type, custins_id, cluster_id, info, primary_insts, primary_accounts):
+        self.instances[(service_type, custins_id)] = TopologyInstance(
+            custins_id, service_type, cluster_id, info, primary_insts, primary_accounts
+        )
+
+    def get_instance(self, service_type, custins_id):
+        return self.instances.get((service_type, custins_id))
+
+    def is_in_primary_cluster(self, service_type, custins_id):
+        instance = self.get_instance(service_type, custins_id)
+        return instance is not None and instance.cluster_id is None
+
+    def get_replication_service_type(self, custins_id):
+        return self.replication_service_types.get(custins_id)
+
+    def get_replication_insts(self, service_type):
+        return self.replication.get(service_type, {})
+
 
 class EngineImageEnv(object):
+    """
+    The env of an operation. The json payloads are parsed on first access, an
+    operation which only reads access_port does not parse the cluster topology.
+    __init__ parses the env again, e.g. after the manager daemon changed it.
+    """
+
     def __init__(self):
+        # drop the payloads parsed from the previous env
+        self.__dict__.clear()
         self.port = os.getenv("port")
         self.access_port = os.getenv("access_port")
         self.ins_id = os.getenv("ins_id")
         self.db_type = os.getenv("db_type", DB_TYPE_PGSQL)
         self.db_version = os.getenv("db_version", PGSQL_DB_VERSION)
         self.cluster_custins_info = os.getenv("cluster_custins_info")
-        if not self.cluster_custins_info or self.cluster_custins_info == '""':
-            self.cluster_custins_info_json = {}
-        else:
-            self.cluster_custins_info_json = json.loads(self.cluster_custins_info)
         self.srv_opr_action = os.getenv("srv_opr_action")
         self.srv_opr_type = os.getenv("srv_opr_type")
         self.write_recovery_conf = os.getenv("write_recovery_conf")
@@ -53,7 +201,6 @@ class EngineImageEnv(object):
         self.service_type = os.getenv("service_type")
         self.standby_rebuild_type = os.getenv("standby_rebuild_type")
         self.mycnf_dict = os.getenv("mycnf_dict", "")
-        self.srv_opr_host_ip = json.loads(os.getenv("srv_opr_host_ip", "{}"))
         self.password = os.getenv("srv_opr_password")
         self.pg_base_dir = os.getenv("PG_BASE_DIR", PG_BASE_DIR)
         self.pg_base_bin_dir = "%s/bin" % self.pg_base_dir
@@ -76,60 +223,92 @@ class EngineImageEnv(object):
         # 三节点
         self.dma_role = os.getenv("dma_role", "")
         self.primary_system_identifier = os.getenv("primary_system_identifier", "")
-        self.recovery_conf = json.loads(os.getenv("recovery_conf", "{}"))
 
         # DataMax
         self.primary_system_identifier = os.getenv("primary_system_identifier", "")
 
         # PITR related
         self.pitr_time = os.getenv("pitr_time", "")
-        self.restore_job_env = json.loads(os.getenv("restore_job_env", "{}"))
-        self.pitr_fetch_logs_env = json.loads(os.getenv("pitr_fetch_logs_env", "{}"))
         self.lock_install_ins = os.getenv("lock_install_ins", "False")
 
         self.ro_custins_current = os.getenv("ro_custins_current")
-        if self.ro_custins_current:
-            self.ro_custins_current_json = json.loads(self.ro_custins_current)
-
         self.ro_custins_all = os.getenv("ro_custins_all")
-        if self.ro_custins_all:
-            self.ro_custins_all_json = json.loads(self.ro_custins_all)
-
         self.current_ins = os.getenv("current_ins")
-        if self.current_ins:
-            self.current_ins_json = json.loads(self.current_ins)
-
         self.ins_topology_4_replication = os.getenv("ins_topology_4_replication")
-        if self.ins_topology_4_replication:
-            self.ins_topology_4_replication_json = json.loads(
-                self.ins_topology_4_replication
-            )
 
         self.custins_id = os.getenv("custins_id")
         if self.custins_id is None:
             self.custins_id = self.cust_ins_id
 
-        ro_insts = self.cluster_custins_info_json.get(SERVICE_TYPE_RO)
-        self.is_standby_ro = True
-        if ro_insts:
-            ro_inst_ids = ro_insts.keys()
-            if self.is_polardb_pg_ro() and self.cust_ins_id in ro_inst_ids:
-                self.is_standby_ro = False
-
-        standbys = self.cluster_custins_info_json.get(SERVICE_TYPE_STANDBY)
-        self.is_clustered_standby = False
-        if standbys:
-            if SERVICE_TYPE_RW in standbys.values()[0]:
-                self.is_clustered_standby = True
         self.is_tde_enable = os.getenv("tde_enable", "false") == "true"
-        if self.is_tde_enable:
-            self.tde_attribute = json.loads(os.getenv("tde_attribute"))
-            self.secret_get = self.tde_attribute["secret_get"]
 
-        self.create_tablespace_env = json.loads(
-            os.getenv("create_tablespace_env", "{}")
+    @cached_property
+    def cluster_custins_info_json(self):
+        return load_env_payload("cluster_custins_info", {})
+
+    @cached_property
+    def srv_opr_host_ip(self):
+        return load_env_payload("srv_opr_host_ip", {})
+
+    @cached_property
+    def recovery_conf(self):
+        return load_env_payload("recovery_conf", {})
+
+    @cached_property
+    def restore_job_env(self):
+        return load_env_payload("restore_job_env", {})
+
+    @cached_property
+    def pitr_fetch_logs_env(self):
+        return load_env_payload("pitr_fetch_logs_env", {})
+
+    @cached_property
+    def ro_custins_current_json(self):
+        return load_env_payload("ro_custins_current")
+
+    @cached_property
+    def ro_custins_all_json(self):
+        return load_env_payload("ro_custins_all")
+
+    @cached_property
+    def current_ins_json(self):
+        return load_env_payload("current_ins")
+
+    @cached_property
+    def ins_topology_4_replication_json(self):
+        return load_env_payload("ins_topology_4_replication")
+
+    @cached_property
+    def tde_attribute(self):
+        if not self.is_tde_enable:
+            return None
+        return load_env_payload("tde_attribute")
+
+    @cached_property
+    def secret_get(self):
+        return self.tde_attribute["secret_get"]
+
+    @cached_property
+    def create_tablespace_env(self):
+        return load_env_payload("create_tablespace_env", {})
+
+    @cached_property
+    def topology(self):
+        return TopologyIndex(
+            self.cluster_custins_info_json, self.ins_topology_4_replication_json
         )
 
+    @cached_property
+    def is_standby_ro(self):
+        return not (
+            self.is_polardb_pg_ro()
+            and self.topology.is_in_primary_cluster(SERVICE_TYPE_RO, self.cust_ins_id)
+        )
+
+    @cached_property
+    def is_clustered_standby(self):
+        return self.topology.is_clustered_standby
+
     @staticmethod
     def is_engine_type_on_pangu(engine_type):
         return "pangu" == engine_type
@@ -163,41 +342,20 @@ class EngineImageEnv(object):
     def get_standby_rebuild_type(self):
         return self.standby_rebuild_type
 
+    def get_current_instance(self):
+        return self.topology.get_instance(self.service_type, self.cust_ins_id)
+
     def get_inst_attr(self, attr):
         if not self.cluster_custins_info_json:
             raise Exception("failed to get cluster custins info")
 
-        if not self.is_clustered_standby:
-            return self.cluster_custins_info_json.get(self.service_type, {}).get(
-                self.cust_ins_id, {}
-            )[attr]
-
-        if self.is_polardb_pg_rw():
-            return self.cluster_custins_info_json.get(SERVICE_TYPE_RW, {}).get(
-                self.cust_ins_id, {}
-            )[attr]
-
-        if self.is_polardb_pg_ro():
-            if self.is_standby_ro:
-                for standby_cluster in self.cluster_custins_info_json.get(
-                    SERVICE_TYPE_STANDBY
-                ).values():
-                    inst = standby_cluster.get(SERVICE_TYPE_RO, {}).get(
-                        self.cust_ins_id
-                    )
-                    if inst:
-                        return inst[attr]
-            else:
-                return self.cluster_custins_info_json.get(SERVICE_TYPE_RO, {}).get(
-                    self.cust_ins_id, {}
-                )[attr]
-
-        if self.is_polardb_pg_standby():
-            standby = self.cluster_custins_info_json.get(SERVICE_TYPE_STANDBY, {}).get(
-                self.cust_ins_id
+        instance = self.get_current_instance()
+        if instance is None:
+            raise Exception(
+                "failed to get %s custins %s in cluster custins info"
+                % (self.service_type, self.cust_ins_id)
             )
-            if standby:
-                return standby.get(SERVICE_TYPE_RW).get(self.cust_ins_id)[attr]
+        return instance.info[attr]
 
     def get_polar_storage_params(self):
         if self.storage_type == STORAGE_TYPE_POLAR_STORE:
@@ -236,20 +394,12 @@ class EngineImageEnv(object):
         return port_struct[self.ins_id]["access_port"][0]
 
     def get_primary_insts(self):
-        primary_insts = {}
-        if self.is_polardb_pg_standby():
-            primary_insts = self.cluster_custins_info_json.get(SERVICE_TYPE_RW)
-        elif self.is_polardb_pg_ro():
-            if self.is_standby_ro:
-                for standby_cluster in self.cluster_custins_info_json.get(
-                    SERVICE_TYPE_STANDBY
-                ).values():
-                    if self.cust_ins_id in standby_cluster.get(SERVICE_TYPE_RO, {}):
-                        return standby_cluster.get(SERVICE_TYPE_RW, {})
-            else:
-                primary_insts = self.cluster_custins_info_json.get(SERVICE_TYPE_RW, {})
-
-        return primary_insts
+        if not (self.is_polardb_pg_standby() or self.is_polardb_pg_ro()):
+            return {}
+        instance = self.get_current_instance()
+        if instance is None:
+            return {}
+        return instance.primary_insts
 
     def get_primary_ins_info(self):
         primary_insts = self.get_primary_insts()
@@ -259,41 +409,36 @@ class EngineImageEnv(object):
         return self.get_primary_insts().values()[0]["accounts"]
 
     def get_primary_account_by_privilege_type(self, privilege_type):
-        target_accounts = []
-        accounts = self.get_primary_accounts()
-        for acc, acc_info in accounts.iteritems():
-            if acc_info["priviledge_type"] == privilege_type:
-                target_accounts.append(acc_info)
-        return target_accounts
+        if not (self.is_polardb_pg_standby() or self.is_polardb_pg_ro()):
+            return []
+        instance = self.get_current_instance()
+        if instance is None:
+            return []
+        return list(instance.primary_accounts.get(privilege_type, []))
 
     def get_current_ins_service_type(self):
         custins_id = self.current_ins_json.get("custins_id")
-        for service_type, ins_map in self.ins_topology_4_replication_json.items():
-            for ins_id, ins_info in ins_map.items():
-                if ins_id == custins_id:
-                    return service_type
+        return self.topology.get_replication_service_type(custins_id)
 
     @staticmethod
     def get_initdb_user():
         return INITDB_SUPERUSER
 
     def get_envs(self):
-        for k, v in os.environ.items():
-            if k not in self.__dict__:
-                self.__dict__[k] = v
-        return self.__dict__
+        # not stored in the instance, the env would hide the payloads not parsed yet
+        envs = dict(os.environ)
+        envs.update(self.__dict__)
+        return envs
 
     def get_slot_names_by_service_type(self, service_type):
         slot_names = []
         if self.ins_topology_4_replication:
-            for ins_info in self.ins_topology_4_replication_json.get(
-                service_type
-            ).values():
+            for ins_info in self.topology.get_replication_insts(service_type).values():
                 slot_names.append(
                     self.get_slot_name_by_ins_info(service_type, ins_info)
                 )
         else:
-            for ins_info in engine_env.ro_custins_all_json.values():
+            for ins_info in self.ro_custins_all_json.values():
                 slot_names.append(
                     self.get_slot_name_by_ins_info(service_type, ins_info)
                 )
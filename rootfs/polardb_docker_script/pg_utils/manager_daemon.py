@@ -0,0 +1,490 @@
+#!/usr/bin/python
+# _*_ coding:UTF-8
+#
+# Copyright (c) 2021, Alibaba Group Holding Limited
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#
+
+"""
+The operation daemon of the manager container.
+
+init_and_pause.py serves operations on a unix socket, each in a process forked
+from the daemon, so an operation does not pay for a new interpreter and imports.
+As a process of its own, an operation may change os.environ and module state and
+spawn commands with preexec_fn like one started by docker exec. entry_point.py
+stays the client: it sends its env to the daemon, writes the output of the
+operation to its stdout and exits with its exit code, or runs the operation
+itself if no daemon is listening.
+
+A request is a json line {"env": {...}}. The response is a json line
+{"output": ...} for each write of the operation as it runs, then a json line with
+exit_code, result (the last json printed by the operation), error and duration.
+An operation is stopped after srv_opr_timeout seconds. The paths of pg_const
+are fixed when the daemon imports it, an operation whose env changes one of
+IMPORT_ENV_KEYS, e.g. PG_DATA, is left to the client, which runs it in a new
+interpreter like before the daemon.
+
+An env with srv_opr_batch runs a json list of operations one after another, see
+run_batch. entry_point.py runs a batch itself the same way if no daemon is
+listening.
+"""
+
+import contextlib
+import json
+import logging
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+
+try:
+    import SocketServer as socketserver
+except ImportError:
+    import socketserver
+
+from pg_utils.logger import logger
+from pg_utils.pg_const import IMPORT_ENV_KEYS, MANAGER_SOCKET
+
+# env keys which select an operation, no module state is derived from them
+OPERATION_ENV_KEYS = ("srv_opr_type", "srv_opr_action", "srv_opr_timeout", "request_id")
+# env keys of the shell which runs docker exec, not of the operation
+IGNORED_ENV_KEYS = ("_", "TERM", "SHLVL", "PWD", "OLDPWD", "HOME", "HOSTNAME")
+# env keys of a batch, not passed to the operations of the batch
+BATCH_ENV_KEYS = ("srv_opr_batch", "srv_opr_batch_policy")
+BATCH_POLICIES = ("abort", "continue")
+# exit code of an operation stopped by srv_opr_timeout, like run_command
+OPERATION_TIMEOUT_EXIT_CODE = 0x7F
+
+operation_local = threading.local()
+
+
+def get_operation_output():
+    return getattr(operation_local, "output", None)
+
+
+def send_output(data):
+    """Stream output of an operation to the client of the daemon, if any."""
+    stream = getattr(operation_local, "stream", None)
+    if stream is None:
+        return
+    try:
+        stream.write((json.dumps({"output": data}) + "\n").encode("utf-8"))
+        stream.flush()
+    except (IOError, socket.error) as e:
+        # the operation goes on without its client
+        operation_local.stream = None
+        logger.warn("Failed to send the output of the operation: %s", e)
+
+
+class OperationTimeout(BaseException):
+    """Raised in an operation after srv_opr_timeout seconds. It is not an Exception,
+    so the except clauses of the operation do not catch it."""
+
+
+def raise_operation_timeout(signum, frame):
+    raise OperationTimeout()
+
+
+def get_operation_timeout(env):
+    try:
+        return int(float(env.get("srv_opr_timeout") or 0))
+    except ValueError:
+        logger.warn("Ignore invalid srv_opr_timeout %s", env.get("srv_opr_timeout"))
+        return 0
+
+
+class OperationStdout(object):
+    """
+    sys.stdout of the daemon, what an operation prints goes to its output. An
+    operation run with tee also prints to the real stdout, like a batch run by
+    entry_point.py itself.
+    """
+
+    def __init__(self, stdout):
+        self.stdout = stdout
+
+    def write(self, data):
+        output = get_operation_output()
+        if output is None or getattr(operation_local, "tee", False):
+            self.stdout.write(data)
+        if output is not None:
+            output.write(data)
+
+    def flush(self):
+        if get_operation_output() is None or getattr(operation_local, "tee", False):
+            self.stdout.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stdout, name)
+
+
+class OperationLogHandler(logging.Handler):
+    """Copy the log records of an operation to its output, like entry_point.py
+    logged them to the stdout of the docker exec."""
+
+    def __init__(self):
+        logging.Handler.__init__(self, logging.DEBUG)
+        self.setFormatter(
+            logging.Formatter(
+                "%(asctime)s - %(levelname)s - %(request_id)s"
+                " - %(filename)s:%(lineno)d - %(message)s"
+            )
+        )
+
+    def emit(self, record):
+        output = get_operation_output()
+        if output is None:
+            return
+        record.request_id = operation_local.request_id
+        output.write(self.format(record) + "\n")
+
+
+class OperationOutput(object):
+    def __init__(self):
+        self.parts = []
+
+    def write(self, data):
+        if not isinstance(data, type(u"")):
+            data = data.decode("utf-8", "replace")
+        self.parts.append(data)
+        send_output(data)
+
+    def getvalue(self):
+        return "".join(self.parts)
+
+    def get_result(self):
+        """The last json object printed by the operation, if any."""
+        for line in reversed(self.getvalue().splitlines()):
+            line = line.strip()
+            if line.startswith("{"):
+                try:
+                    return json.loads(line)
+                except ValueError:
+                    pass
+        return None
+
+
+def install_operation_output(log_records=True):
+    """Capture the output of operations run by run_operation in this process."""
+    if not isinstance(sys.stdout, OperationStdout):
+        sys.stdout = OperationStdout(sys.stdout)
+    if log_records:
+        logger.addHandler(OperationLogHandler())
+
+
+def get_env_overrides(env):
+    return dict(
+        (key, value)
+        for key, value in env.items()
+        if key not in IGNORED_ENV_KEYS and os.environ.get(key) != value
+    )
+
+
+def get_import_env_overrides(env):
+    return sorted(key for key in get_env_overrides(env) if key in IMPORT_ENV_KEYS)
+
+
+def get_operation_env():
+    # a batch run by entry_point.py itself has its keys in os.environ
+    return dict(
+        (key, value) for key, value in os.environ.items() if key not in BATCH_ENV_KEYS
+    )
+
+
+@contextlib.contextmanager
+def operation_env(env):
+    """Yield the docker_env of an operation, set it up in the daemon if needed."""
+    overrides = get_env_overrides(env)
+    if all(key in OPERATION_ENV_KEYS for key in overrides):
+        docker_env = get_operation_env()
+        docker_env.update(overrides)
+        yield docker_env
+        return
+
+    from pg_utils.envs import engine_env
+
+    # restored for the next step of a batch run by the same process
+    saved = dict((key, os.environ.get(key)) for key in overrides)
+    os.environ.update(overrides)
+    # modules keep a reference to engine_env, parse the env again in place
+    engine_env.__init__()
+    try:
+        yield get_operation_env()
+    finally:
+        for key, value in saved.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+        engine_env.__init__()
+
+
+def run_operation(env, tee=False):
+    from entry_point import entry
+
+    output = OperationOutput()
+    operation_local.output = output
+    operation_local.tee = tee
+    operation_local.request_id = env.get("request_id", "")
+    start_time = time.time()
+    exit_code = 0
+    error = None
+    timeout = get_operation_timeout(env)
+    if timeout:
+        previous_handler = signal.signal(signal.SIGALRM, raise_operation_timeout)
+        signal.alarm(timeout)
+    try:
+        with operation_env(env) as docker_env:
+            entry(docker_env)
+    except OperationTimeout:
+        logger.error("Operation time out after %ds", timeout)
+        exit_code = OPERATION_TIMEOUT_EXIT_CODE
+        error = "time out"
+    except SystemExit as e:
+        exit_code = e.code or 0
+        if not isinstance(exit_code, int):
+            output.write("%s\n" % exit_code)
+            exit_code = 1
+    except Exception as e:
+        logger.exception(e)
+        exit_code = 1
+        error = str(e)
+    finally:
+        if timeout:
+            signal.alarm(0)
+            signal.signal(signal.SIGALRM, previous_handler)
+        operation_local.output = None
+        operation_local.tee = False
+    return {
+        "exit_code": exit_code,
+        "output": output.getvalue(),
+        "result": output.get_result(),
+        "error": error,
+        "duration": time.time() - start_time,
+    }
+
+
+def get_step_env(env, step):
+    step_env = dict(
+        (key, value) for key, value in env.items() if key not in BATCH_ENV_KEYS
+    )
+    for key, value in step.items():
+        if key in BATCH_ENV_KEYS:
+            raise Exception("A step of srv_opr_batch can not be a batch")
+        # the env of docker exec only has strings, payloads are json
+        if not isinstance(value, (type(""), type(u""))):
+            value = json.dumps(value)
+        step_env[key] = value
+    return step_env
+
+
+def run_batch(env, tee=False):
+    """
+    Run the operations of srv_opr_batch one after another, each with the env of
+    the batch updated with its step, e.g.
+
+        srv_opr_batch='[{"srv_opr_type": "hostins_ops", "srv_opr_action": "stop_instance"},
+                        {"srv_opr_type": "hostins_ops", "srv_opr_action": "build_recovery"},
+                        {"srv_opr_type": "hostins_ops", "srv_opr_action": "start_instance"}]'
+
+    The operations share the modules, the parsed env and the pooled connections
+    of this process. With srv_opr_batch_policy abort, the default, the steps
+    after a failed step are skipped, with continue they run anyway.
+
+    The response is the response of run_operation, its output has the output of
+    all steps, its result is the summary of the batch, printed as the last line:
+    exit_code, duration and the exit_code, result, error and duration of each step.
+    """
+    start_time = time.time()
+    steps = json.loads(env["srv_opr_batch"])
+    policy = env.get("srv_opr_batch_policy") or "abort"
+    if not isinstance(steps, list):
+        raise Exception("srv_opr_batch must be a json list of operations")
+    if policy not in BATCH_POLICIES:
+        raise Exception("Not support srv_opr_batch_policy %s" % policy)
+    for step in steps:
+        import_overrides = get_import_env_overrides(get_step_env(env, step))
+        if import_overrides:
+            raise Exception(
+                "A step of srv_opr_batch can not change %s, set it for the batch"
+                % ", ".join(import_overrides)
+            )
+
+    outputs = []
+    results = []
+    exit_code = 0
+    for index, step in enumerate(steps):
+        result = {
+            "step": index,
+            "srv_opr_type": step.get("srv_opr_type"),
+            "srv_opr_action": step.get("srv_opr_action"),
+        }
+        results.append(result)
+        if exit_code != 0 and policy == "abort":
+            result["status"] = "skipped"
+            continue
+
+        logger.info(
+            "Batch step %d/%d srv_opr_type: %s, srv_opr_action: %s",
+            index + 1,
+            len(steps),
+            result["srv_opr_type"],
+            result["srv_opr_action"],
+        )
+        response = run_operation(get_step_env(env, step), tee=tee)
+        outputs.append(response["output"])
+        result["status"] = "succeeded" if response["exit_code"] == 0 else "failed"
+        for key in ("exit_code", "result", "error", "duration"):
+            result[key] = response[key]
+        if response["exit_code"] != 0:
+            exit_code = 1
+
+    summary = {
+        "exit_code": exit_code,
+        "policy": policy,
+        "steps": results,
+        "duration": time.time() - start_time,
+    }
+    outputs.append(json.dumps(summary) + "\n")
+    send_output(outputs[-1])
+    return {
+        "exit_code": exit_code,
+        "output": "".join(outputs),
+        "result": summary,
+        "error": None,
+        "duration": summary["duration"],
+    }
+
+
+def run_request(env):
+    import_overrides = get_import_env_overrides(env)
+    if import_overrides:
+        logger.info(
+            "Operation changes %s read at import, leave it to the client",
+            ", ".join(import_overrides),
+        )
+        # exit_code None tells run_in_daemon to run the operation itself
+        return {
+            "exit_code": None,
+            "output": "",
+            "result": None,
+            "error": None,
+            "duration": 0,
+        }
+    if env.get("srv_opr_batch"):
+        try:
+            return run_batch(env)
+        except Exception as e:
+            logger.exception(e)
+            send_output("%s\n" % e)
+            return {
+                "exit_code": 1,
+                "output": "%s\n" % e,
+                "result": None,
+                "error": str(e),
+                "duration": 0,
+            }
+    return run_operation(env)
+
+
+class OperationRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        request = json.loads(self.rfile.readline().decode("utf-8"))
+        env = request["env"]
+        logger.info(
+            "Operation srv_opr_type: %s, srv_opr_action: %s, request_id: %s",
+            env.get("srv_opr_type"),
+            env.get("srv_opr_action"),
+            env.get("request_id"),
+        )
+        operation_local.stream = self.wfile
+        response = run_request(env)
+        operation_local.stream = None
+        logger.info(
+            "Operation srv_opr_type: %s, srv_opr_action: %s exit with code %s in %.3fs",
+            env.get("srv_opr_type"),
+            env.get("srv_opr_action"),
+            response["exit_code"],
+            response["duration"],
+        )
+        # the output has been streamed
+        response.pop("output")
+        self.wfile.write((json.dumps(response) + "\n").encode("utf-8"))
+
+
+class OperationServer(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+    """
+    Run each request in a process forked from the daemon. The daemon keeps a
+    single thread, so the forked processes do not inherit locks held by others.
+    """
+
+
+def serve_operations(socket_path=MANAGER_SOCKET):
+    """Serve operations on the unix socket until the process exits."""
+    from pg_utils.pg_connection import enable_connection_pool
+
+    # warm the modules of the operations, so the first operation does not import them.
+    # The daemon itself opens no connections, the processes of the operations pool
+    # their own.
+    import entry_point
+
+    for task in entry_point.TASKS.values():
+        if hasattr(task, "load"):
+            task.load()
+
+    enable_connection_pool()
+    install_operation_output()
+
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    server = OperationServer(socket_path, OperationRequestHandler)
+    os.chmod(socket_path, 0o600)
+    logger.info("Serve operations on %s", socket_path)
+    server.serve_forever()
+
+
+def run_in_daemon(env, socket_path=MANAGER_SOCKET):
+    """
+    Run an operation in the daemon, write its output to stdout and return its
+    exit code, or None if no daemon is listening or the operation has to run
+    in a new interpreter.
+    """
+    if not os.path.exists(socket_path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stdout = getattr(sys.stdout, "buffer", sys.stdout)
+    response = None
+    try:
+        try:
+            sock.connect(socket_path)
+        except socket.error:
+            return None
+        sock.sendall((json.dumps({"env": dict(env)}) + "\n").encode("utf-8"))
+        sock.shutdown(socket.SHUT_WR)
+        reader = sock.makefile("rb")
+        try:
+            for line in reader:
+                message = json.loads(line.decode("utf-8"))
+                if "exit_code" in message:
+                    response = message
+                    break
+                stdout.write(message["output"].encode("utf-8"))
+                stdout.flush()
+        finally:
+            reader.close()
+    finally:
+        sock.close()
+    if response is None:
+        raise Exception("The manager daemon closed the connection of the operation")
+    # None if the env of the operation needs a new interpreter, see run_request
+    return response["exit_code"]
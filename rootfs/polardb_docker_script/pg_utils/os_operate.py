@@ -22,7 +22,7 @@ import pwd
 import shutil
 import time
 
-from pg_common import exec_command
+from pg_utils.pg_common import run_command
 
 from pg_utils.logger import logger
 from pg_utils.pg_const import CORE_PATTERN_FILE, LOG_CORE_DIR
@@ -38,11 +38,11 @@ def mkdir_paths(path_list):
 def chown_paths(path_list, user, mode="700"):
     for path in path_list:
         if os.path.exists(path):
-            status, stdout = exec_command("chown -R %s %s" % (user, path))
+            status, stdout = run_command("chown -R %s %s" % (user, path))
             if status != 0:
                 raise Exception("chown -R %s %s ERROR: %s" % (user, path, stdout))
 
-            status, stdout = exec_command("chmod %s -R %s" % (mode, path))
+            status, stdout = run_command("chmod %s -R %s" % (mode, path))
             if status != 0:
                 raise Exception("chmod %s -R  %s ERROR: %s" % (mode, path, stdout))
             logger.info("Run: os.chown(%s)", path)
@@ -113,9 +113,9 @@ def add_os_user(user, uid=None):
         logger.info("The user %s exists, go on!", user)
     except KeyError:
         if not uid:
-            status, stdout = exec_command("useradd %s" % user)
+            status, stdout = run_command("useradd %s" % user)
         else:
-            status, stdout = exec_command("useradd -u %s %s" % (uid, user))
+            status, stdout = run_command("useradd -u %s %s" % (uid, user))
         if status != 0:
             raise Exception("We can not create the user %s with uid %d!" % (user, uid))
 
@@ -141,7 +141,7 @@ def add_user_to_group(user, group):
     logger.info("Add user %s to group %s" % (user, group))
     if not is_os_group_exists(group):
         raise Exception("Group %s does not exist." % group)
-    status, stdout = exec_command("usermod -a -G %s %s" % (group, user))
+    status, stdout = run_command("usermod -a -G %s %s" % (group, user))
     if status != 0:
         raise Exception("We can not add user %s to group %s" % (user, group))
 
@@ -153,7 +153,7 @@ def remove_user_from_group(user, group):
     if not is_user_in_group(user, group):
         logger.info("User %s does not belong to group %s" % (user, group))
         return
-    status, stdout = exec_command("gpasswd -d %s %s" % (user, group))
+    status, stdout = run_command("gpasswd -d %s %s" % (user, group))
     if status != 0:
         logger.info("We can not remove user %s from %s group" % (user, group))
     # Double check, if user is in this group, raise exception.
@@ -175,7 +175,7 @@ def del_os_user(user, remove_home=False):
             params = " %s -r " % params
 
         del_cmd = "userdel %s %s" % (params, user)
-        exec_command(del_cmd)
+        run_command(del_cmd)
     except Exception as e:
         raise Exception("We can not delete the user %s, %s!" % (user, str(e)))
 
@@ -196,3 +196,21 @@ def create_core_pattern_dir():
             if not os.path.exists(dst):
                 mkdir_paths([os.path.dirname(dst)])
                 os.symlink(src, dst)
+
+
+def get_process_pids(name):
+    """
+    The pids of the processes named name, like pgrep -x name without running it
+    """
+    pids = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open("/proc/%s/comm" % entry, "r") as fd:
+                if fd.read().strip() == name:
+                    pids.append(int(entry))
+        except IOError:
+            # the process exited meanwhile
+            continue
+    return pids
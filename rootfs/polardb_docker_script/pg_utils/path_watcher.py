@@ -0,0 +1,168 @@
+#!/usr/bin/python
+# _*_ coding:UTF-8
+#
+# Copyright (c) 2021, Alibaba Group Holding Limited
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#
+
+"""
+Wait for changes of a file with inotify, e.g. the stop lock file or postmaster.pid
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import time
+
+from pg_utils.logger import logger
+
+# see <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+# the file is watched in its directory, it may not exist yet or be replaced
+WATCH_MASK = (
+    IN_MODIFY
+    | IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+)
+# the watch of the directory is gone, or events were dropped
+RESCAN_MASK = IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED | IN_Q_OVERFLOW
+INOTIFY_EVENT = struct.Struct("iIII")
+INOTIFY_READ_SIZE = 64 * 1024
+# the interval to check the file without inotify
+POLL_INTERVAL = 1
+
+libc = None
+
+
+def get_libc():
+    global libc
+    if libc is None:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    return libc
+
+
+class PathWatcher(object):
+    """
+    Watch a file for creation, removal and writes. It falls back to check the
+    file every POLL_INTERVAL seconds where inotify is not available, e.g. the
+    directory does not exist or the inotify instances are used up.
+
+        with PathWatcher(INS_LOCK_FILE) as watcher:
+            while not watcher.wait_for(is_instance_unlocked, 60):
+                logger.info("wait and check later...")
+    """
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.dirname, self.basename = os.path.split(self.path)
+        self.basename = self.basename.encode("utf-8")
+        self.fd = None
+        self.watch()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def watch(self):
+        try:
+            libc = get_libc()
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_init1")
+            dirname = self.dirname.encode("utf-8")
+            if libc.inotify_add_watch(fd, dirname, WATCH_MASK) < 0:
+                e = ctypes.get_errno()
+                os.close(fd)
+                raise OSError(e, "inotify_add_watch %s" % self.dirname)
+            self.fd = fd
+        except (AttributeError, OSError) as e:
+            logger.info("Can not watch %s with inotify, poll it: %s", self.path, e)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def read_events(self):
+        """Whether the events read concern the file, stop watching on RESCAN_MASK"""
+        changed = False
+        while self.fd is not None:
+            try:
+                data = os.read(self.fd, INOTIFY_READ_SIZE)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    break
+                raise
+            offset = 0
+            while offset < len(data):
+                _, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+                offset += INOTIFY_EVENT.size
+                name = data[offset : offset + length].rstrip(b"\0")
+                offset += length
+                if mask & RESCAN_MASK:
+                    logger.info("Stop watching %s, poll it", self.path)
+                    self.close()
+                    return True
+                if name == self.basename:
+                    changed = True
+        return changed
+
+    def wait(self, timeout):
+        """Wait for a change of the file no longer than timeout seconds"""
+        if self.fd is None:
+            if timeout is None or timeout > POLL_INTERVAL:
+                timeout = POLL_INTERVAL
+            time.sleep(timeout)
+            return True
+        try:
+            rlist, _, _ = select.select([self.fd], [], [], timeout)
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return True
+        return bool(rlist) and self.read_events()
+
+    def wait_for(self, predicate, timeout=None):
+        """
+        Wait until predicate() is true, checking it whenever the file changes.
+        Return False if it is still false after timeout seconds.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while not predicate():
+            remaining = None if deadline is None else deadline - time.time()
+            if remaining is not None and remaining <= 0:
+                return False
+            self.wait(remaining)
+        return True
@@ -16,113 +16,360 @@
 """
 The common fuctions:
 
-exec_command: execute command
+run_command: execute command
+run_as_user: execute a program as another user without su
 get_pgsql_process_id: get process id from postmaster.pid
 check_pid_pg_process: check the postgresql process existed
 check_port_exists: check the port listened
 
 """
 import errno
+import fcntl
+import grp
 import os
+import pwd
+import resource
+import select
+import shlex
+import signal
 import socket
 import subprocess
 import sys
+import threading
 import time
 
 from ConfigParser import ConfigParser
 
+try:
+    from shlex import quote as shell_quote
+except ImportError:
+    from pipes import quote as shell_quote
+
 from pg_utils.logger import logger
-from pg_utils.pg_const import PGDATA, STORAGE_TYPE_POLAR_STORE, STORAGE_TYPE_FC_SAN
+from pg_utils.pg_const import (
+    ALL_LIBRARY_PATHS,
+    PATH,
+    PGDATA,
+    STORAGE_TYPE_POLAR_STORE,
+    STORAGE_TYPE_FC_SAN,
+    INIT_SCRIPT,
+)
 
 
-def exec_command(cmd, timeout=180):
-    def get_interval_iter():
-        """a interval iterator"""
-        MIN_INTERVAL, MAX_INTERVAL = 0.1, 1
-        while True:
-            yield min(MIN_INTERVAL, MAX_INTERVAL)
-            if MIN_INTERVAL < MAX_INTERVAL:
-                MIN_INTERVAL *= 2
-
-    logger.info("Run command[timeout=%d]: %s", timeout, cmd)
-    interval_iter = get_interval_iter()
-    start_time = time.time()
-    deadline = start_time + timeout
-    close_fds = False if os.name == "nt" else True
+# exit code returned by run_command when the command is killed at its deadline
+RUN_COMMAND_TIMEOUT = 0x7F
+RUN_COMMAND_MAX_OUTPUT = 4 * 1024 * 1024
+RUN_COMMAND_READ_SIZE = 64 * 1024
+# seconds between SIGTERM and SIGKILL to the process group of a timed out command
+RUN_COMMAND_KILL_GRACE = 5
+
+# the variables exported by INIT_SCRIPT, read once, see get_init_script_env
+init_script_env = None
+
+
+class CommandOutput(object):
+    """
+    The output of a command. Only the head and the tail are kept if it is
+    larger than max_size, complete lines are logged as they come with log_lines.
+    """
+
+    def __init__(self, max_size, log_lines=False):
+        self.head_size = max_size // 2
+        self.tail_size = max_size - self.head_size
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.truncated = 0
+        self.log_lines = log_lines
+        self.partial_line = bytearray()
+
+    def append(self, data):
+        if self.log_lines:
+            self.log(data)
+        if len(self.head) < self.head_size:
+            room = self.head_size - len(self.head)
+            self.head.extend(data[:room])
+            data = data[room:]
+        self.tail.extend(data)
+        # trim the tail when it doubled, so a large output is copied only once
+        if len(self.tail) > 2 * self.tail_size:
+            self.trim_tail()
+
+    def trim_tail(self):
+        extra = len(self.tail) - self.tail_size
+        if extra > 0:
+            del self.tail[:extra]
+            self.truncated += extra
+
+    def log(self, data):
+        self.partial_line.extend(data)
+        lines = self.partial_line.split(b"\n")
+        self.partial_line = lines.pop()
+        for line in lines:
+            logger.info("| %s", line.decode("utf-8", "replace").rstrip())
+
+    def getvalue(self):
+        if self.log_lines and self.partial_line:
+            self.log(b"\n")
+        self.trim_tail()
+        if not self.truncated:
+            return bytes(self.head + self.tail)
+        marker = "\n... %d bytes truncated ...\n" % self.truncated
+        return bytes(self.head + bytearray(marker.encode("utf-8")) + self.tail)
+
+
+def wait_command(pipe, wake_fd):
+    """Reap the command, then wake up run_command which selects on wake_fd."""
+    try:
+        pipe.wait()
+    finally:
+        try:
+            os.write(wake_fd, b"x")
+        except OSError:
+            pass
+        os.close(wake_fd)
+
+
+def kill_command(pipe, waiter, cmd):
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.killpg(pipe.pid, sig)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+        waiter.join(RUN_COMMAND_KILL_GRACE)
+        if not waiter.is_alive():
+            return
+    logger.info("the process cannot be killed: %s", cmd)
+
+
+def read_available(fd, output):
+    """Read what is in the pipe without blocking, return False at EOF."""
+    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+    while True:
+        try:
+            data = os.read(fd, RUN_COMMAND_READ_SIZE)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return True
+            raise
+        if not data:
+            return False
+        output.append(data)
+
+
+def run_command(cmd, timeout=180, max_output=RUN_COMMAND_MAX_OUTPUT, log_output=False):
+    """
+    Run a shell command, return its exit code and its stdout and stderr.
+
+    The output and the exit of the command are waited for together, it returns
+    as soon as the command exits, also if a daemon it started keeps the pipe
+    open. An output larger than max_output keeps its head and tail, log_output
+    logs its lines while the command runs, e.g. the progress of polar_basebackup.
+
+    The command runs in its own process group, which is killed after timeout
+    seconds and RUN_COMMAND_TIMEOUT is returned. With timeout 0 or None it
+    runs as long as it takes. It is killed as well if an exception interrupts
+    the wait.
+    """
+    logger.info("Run command[timeout=%s]: %s", timeout, cmd)
     pipe = subprocess.Popen(
         cmd,
         shell=True,
         stdin=subprocess.PIPE,
         stdout=subprocess.PIPE,
         stderr=subprocess.STDOUT,
-        close_fds=close_fds,
+        close_fds=True,
+        preexec_fn=os.setsid,
     )
+    return wait_command_output(pipe, cmd, timeout, max_output, log_output)
+
+
+def wait_command_output(pipe, cmd, timeout, max_output, log_output):
+    deadline = time.time() + float(timeout) if timeout else None
+    pipe.stdin.close()
+    output = CommandOutput(max_output, log_output)
     pipe_fd = pipe.stdout.fileno()
-    # return the integer 'file descriptor' used by the underlying implementation
-    if os.name == "nt":
-        # get the file handler of windows platform to call win32 API
-        import msvcrt
-
-        pipe_fd = msvcrt.get_osfhandle(pipe_fd)
-    else:
-        # set the file to Nonblock file
-        import fcntl
-
-        fcntl.fcntl(pipe_fd, fcntl.F_SETFL, os.O_NONBLOCK)
-    output = ""
-    if timeout:
-        while time.time() < deadline:
-            if pipe.poll() is not None:
-                output += pipe.stdout.read()
-                return pipe.returncode, output
-            if os.name == "nt":
-                import ctypes.wintypes
-
-                c_avail = ctypes.wintypes.DWORD()
-                # get the number of data in pipe
-                ctypes.windll.kernel32.PeekNamedPipe(
-                    pipe_fd, None, 0, None, ctypes.byref(c_avail), None
-                )
-                # print (pipe_fd, c_avail)
-                # read all data of pipe in each second to avoid pipe to overflow
-                if c_avail.value:
-                    output += pipe.stdout.read(c_avail.value)
+    wake_fd, wake_write_fd = os.pipe()
+    waiter = threading.Thread(target=wait_command, args=(pipe, wake_write_fd))
+    waiter.daemon = True
+    waiter.start()
+
+    fds = [pipe_fd, wake_fd]
+    timed_out = False
+    try:
+        while True:
+            wait = None
+            if deadline is not None:
+                wait = deadline - time.time()
+                if wait <= 0:
+                    timed_out = True
+                    break
+            try:
+                rlist, _, _ = select.select(fds, [], [], wait)
+            except select.error as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                continue
+            if pipe_fd in rlist:
+                data = os.read(pipe_fd, RUN_COMMAND_READ_SIZE)
+                if data:
+                    output.append(data)
                 else:
-                    interval = next(interval_iter)
-                    time.sleep(interval)
-            else:
-                # select function wait until pipe_fd is ready for reading
-                import select
-
-                rlist, _, _ = select.select([pipe_fd], [], [], next(interval_iter))
-                if rlist:
-                    try:
-                        output += pipe.stdout.read(1024)
-                    except IOError as e:
-                        if e[0] != errno.EAGAIN:
-                            raise
-                        sys.exc_clear()
-        pipe.stdin.close()
+                    fds.remove(pipe_fd)
+            if wake_fd in rlist:
+                if pipe_fd in fds:
+                    read_available(pipe_fd, output)
+                break
+        if timed_out:
+            kill_command(pipe, waiter, cmd)
+        else:
+            waiter.join()
+    except BaseException:
+        # e.g. the srv_opr_timeout of the manager daemon, the command does not
+        # outlive the operation which ran it
+        kill_command(pipe, waiter, cmd)
+        raise
+    finally:
         pipe.stdout.close()
+        os.close(wake_fd)
+
+    if timed_out:
+        return RUN_COMMAND_TIMEOUT, output.getvalue() + b"time out"
+    return pipe.returncode, output.getvalue()
+
+
+def exec_command(cmd, timeout=180):
+    """The former name of run_command."""
+    return run_command(cmd, timeout)
+
+
+def get_init_script_env():
+    """
+    The variables INIT_SCRIPT exports like export MALLOC_CONF="...", which login
+    shells got from /etc/bashrc. An image without it exports nothing.
+    """
+    global init_script_env
+    if init_script_env is None:
+        exports = {}
         try:
-            pipe.terminate()
-        except OSError as e:
-            if e[0] != 5:
-                raise
-            for _ in range(10):
-                try:
-                    os.kill(pipe.pid, 9)
-                except OSError as e:
-                    if e[0] in (3, 87):
-                        break
-                    else:
-                        time.sleep(1)
-            else:
-                logger.info("the process cannot be killed: %s", cmd)
-        return 0x7F, "time out"
-    else:
-        pipe.wait()
-        return pipe.returncode, pipe.stdout.read()
+            with open(INIT_SCRIPT) as f:
+                for line in f:
+                    try:
+                        words = shlex.split(line, comments=True)
+                    except ValueError:
+                        # a quote spanning lines, not an export
+                        continue
+                    if len(words) == 2 and words[0] == "export" and "=" in words[1]:
+                        key, value = words[1].split("=", 1)
+                        exports[key] = value
+        except IOError as e:
+            logger.warn("Can not read the exports of %s: %s", INIT_SCRIPT, e)
+        init_script_env = exports
+    return init_script_env
+
+
+def get_user_env(pw, env=None):
+    """
+    The environment of a program run as the user pw, what its login shell set up
+    for su -l: the engine binaries and libraries first and the exports of
+    docker/init.sh. env is added to it, e.g. PGPASSWORD.
+    """
+    user_env = dict(get_init_script_env())
+    user_env.update(
+        {
+            "HOME": pw.pw_dir,
+            "USER": pw.pw_name,
+            "LOGNAME": pw.pw_name,
+            "SHELL": pw.pw_shell or "/bin/sh",
+            "PATH": "%s:%s" % (PATH, os.getenv("PATH", os.defpath)),
+            "LD_LIBRARY_PATH": ":".join(filter(None, ALL_LIBRARY_PATHS)),
+            "LANG": os.getenv("LANG", "en_US.UTF-8"),
+        }
+    )
+    if env:
+        user_env.update(env)
+    return user_env
+
+
+def get_user_preexec(pw):
+    """
+    The function the child runs before it execs the program: its own process
+    group, the core size limit of the login profile and the groups, gid and uid
+    of pw. The groups are looked up here, the child only makes system calls.
+    """
+    groups = [pw.pw_gid] + [
+        group.gr_gid for group in grp.getgrall() if pw.pw_name in group.gr_mem
+    ]
+
+    def preexec():
+        os.setsid()
+        # ulimit -c unlimited of the login profile, as far as the hard limit allows
+        _, hard = resource.getrlimit(resource.RLIMIT_CORE)
+        resource.setrlimit(resource.RLIMIT_CORE, (hard, hard))
+        os.setgroups(groups)
+        os.setgid(pw.pw_gid)
+        os.setuid(pw.pw_uid)
+
+    return preexec
+
+
+def run_as_user(
+    user,
+    args,
+    env=None,
+    timeout=180,
+    max_output=RUN_COMMAND_MAX_OUTPUT,
+    log_output=False,
+):
+    """
+    Run the program args[0] with args as user, return its exit code and its
+    stdout and stderr like run_command.
+
+    Unlike su -l user -c, no shell, PAM or login profile runs before the program
+    and args need no quoting, passwords and certificates are passed as they are.
+    The environment is get_user_env(user, env), secrets like PGPASSWORD belong
+    into env instead of args, env is not logged.
+    """
+    pw = pwd.getpwnam(user)
+    cmd = " ".join(shell_quote(arg) for arg in args)
+    logger.info("Run command as %s[timeout=%s]: %s", user, timeout, cmd)
+    try:
+        pipe = subprocess.Popen(
+            args,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            close_fds=True,
+            cwd=pw.pw_dir if os.path.isdir(pw.pw_dir) else "/",
+            env=get_user_env(pw, env),
+            preexec_fn=get_user_preexec(pw),
+        )
+    except OSError as e:
+        # the exit code of a shell which cannot run the program
+        return 127, "%s: %s" % (args[0], e)
+    return wait_command_output(pipe, cmd, timeout, max_output, log_output)
+
+
+def write_user_file(user, path, content, mode=None, append=False):
+    """
+    Write content to path owned by user, like echo content > path as the user.
+    The owner and mode are set before the content is written, a private key is
+    never readable by others.
+    """
+    pw = pwd.getpwnam(user)
+    flags = os.O_WRONLY | os.O_CREAT | (os.O_APPEND if append else os.O_TRUNC)
+    fd = os.open(path, flags, 0o644 if mode is None else mode)
+    with os.fdopen(fd, "a" if append else "w") as f:
+        os.fchown(fd, pw.pw_uid, pw.pw_gid)
+        if mode is not None:
+            os.fchmod(fd, mode)
+        f.write(content)
+
+
+def copy_user_file(user, src, dst):
+    """Copy src to dst owned by user, like cat src > dst as the user."""
+    with open(src) as f:
+        write_user_file(user, dst, f.read())
 
 
 def get_pgsql_process_id():
@@ -153,7 +400,7 @@ def check_pid_pg_process(pid):
 
 
 def check_pid_process(check_cmd):
-    result, output = exec_command(check_cmd)
+    result, output = run_command(check_cmd)
     if result != 0:
         return False
     output = output.strip()
@@ -17,13 +17,70 @@
 This is the pg connection functions
 """
 
+import threading
 import time
 
 import psycopg2
+import psycopg2.extensions
 
 from pg_utils.pg_const import SYSTEM_ACCOUNT_AURORA, RDS_INTERNAL_MARK
 
 
+class ConnectionPool(object):
+    """Idle psycopg2 connections of a long running process, by connection args.
+
+    Tasks open a Connection per operation, with the pool enabled closing it
+    keeps the connection for the next Connection with the same args instead.
+    """
+
+    def __init__(self, max_idle_time=600, max_idle_connections=4):
+        self.max_idle_time = float(max_idle_time)
+        self.max_idle_connections = max_idle_connections
+        self.lock = threading.Lock()
+        # connection args -> [(connection, release time)]
+        self.idle = {}
+
+    @staticmethod
+    def get_key(db_args):
+        return tuple(sorted(db_args.items()))
+
+    def get(self, db_args):
+        key = self.get_key(db_args)
+        while True:
+            with self.lock:
+                connections = self.idle.get(key)
+                if not connections:
+                    return None
+                db, release_time = connections.pop()
+            if db.closed or time.time() - release_time > self.max_idle_time:
+                db.close()
+                continue
+            return db
+
+    def put(self, db_args, db):
+        if (
+            db.closed
+            or db.get_transaction_status()
+            != psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        ):
+            db.close()
+            return
+        with self.lock:
+            connections = self.idle.setdefault(self.get_key(db_args), [])
+            if len(connections) < self.max_idle_connections:
+                connections.append((db, time.time()))
+                return
+        db.close()
+
+
+connection_pool = None
+
+
+def enable_connection_pool(**kwargs):
+    global connection_pool
+    connection_pool = ConnectionPool(**kwargs)
+
+
 class Connection(object):
     """A lightweight wrapper around psycopg2 DB-API connections.
 
@@ -91,15 +148,27 @@ class Connection(object):
         self.close()
 
     def close(self):
-        """Closes this database connection."""
+        """Closes this database connection, or returns it to the pool."""
+        if getattr(self, "_db", None) is not None:
+            if connection_pool is not None:
+                connection_pool.put(self._db_args, self._db)
+            else:
+                self._db.close()
+            self._db = None
+
+    def discard(self):
+        """Closes this database connection, also if the pool is enabled."""
         if getattr(self, "_db", None) is not None:
             self._db.close()
             self._db = None
 
     def reconnect(self):
         """Closes the existing database connection and re-opens it."""
-        self.close()
-        self._db = psycopg2.connect(**self._db_args)
+        self.discard()
+        if connection_pool is not None:
+            self._db = connection_pool.get(self._db_args)
+        if self._db is None:
+            self._db = psycopg2.connect(**self._db_args)
         self._db.autocommit = self.autocommit
 
     def iter(self, query, *parameters, **kwparameters):
@@ -163,7 +232,7 @@ class Connection(object):
             query = RDS_INTERNAL_MARK + query
             return cursor.execute(query, kwparameters or parameters)
         except psycopg2.OperationalError as e:
-            self.close()
+            self.discard()
             # raise real exception to debug
             raise e
 
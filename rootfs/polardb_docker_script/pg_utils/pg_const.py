@@ -15,19 +15,31 @@
 
 import os
 
+# env keys read when this module is imported, a process can not change the
+# values derived from them afterwards, see manager_daemon.run_request
+IMPORT_ENV_KEYS = set()
+
+
+def get_import_env(key, default=None):
+    IMPORT_ENV_KEYS.add(key)
+    return os.getenv(key, default)
+
+
 """
 The dir in the docker
 """
-PGDATA = os.getenv("PG_DATA", "/data")
-PG_EXTERNAL_DATA = os.getenv("PG_EXTERNAL_DATA ", "/disk1")
-LOG = os.getenv("PG_LOG", "/log")
+PGDATA = get_import_env("PG_DATA", "/data")
+PG_EXTERNAL_DATA = get_import_env("PG_EXTERNAL_DATA ", "/disk1")
+LOG = get_import_env("PG_LOG", "/log")
 CONF = "/conf"
 HBA_CONF_PATH = os.path.join(PGDATA, "pg_hba.conf")
 
-PG_BASE_DIR = os.getenv("POLARDB_BASE_DIR", "/u01/polardbmpd")
+PG_BASE_DIR = get_import_env("POLARDB_BASE_DIR", "/u01/polardbmpd")
 PATH = "%s/bin" % PG_BASE_DIR
 POSTGRESQL_CONF_DEMO = "/postgresql.conf.demo"
 ENV_FILE = "/conf/env_file"
+# unix socket of the operation daemon of the manager container, see init_and_pause.py
+MANAGER_SOCKET = get_import_env("PG_MANAGER_SOCKET", "/var/run/polardb_pg_manager.sock")
 POSTGRES_CONF_PATH = "/data/postgresql.conf"
 HBA_CONF = "pg_hba.conf"
 POSTGRES_CONF = "postgresql.conf"
@@ -98,6 +110,7 @@ NEED_UPGRADE_POSTGRESQL_CONF_PARAMS = [
     "max_prepared_transactions",
 ]
 INSTALL_INSTANCE_SCRIPT = "/docker_script/pg_tasks/install_instance.py"
+ENTRY_POINT_SCRIPT = "/docker_script/entry_point.py"
 
 """
 The default value of connection
@@ -129,7 +142,7 @@ PG_SAFE_CONF = os.path.join(LOG, "pg_safe.cnf")
 INS_LOCK_FILE = os.path.join(PGDATA, "ins_lock")
 INS_INSTALL_STEP = os.path.join(PGDATA, "ins_install_step")
 INS_CTX = os.path.join(PGDATA, "ins_ctx")
-SET_INSTALL_STEP_LOCK = os.getenv(
+SET_INSTALL_STEP_LOCK = get_import_env(
     "PG_SET_INSTALL_STEP_LOCK", "/tmp/set_install_step_lock"
 )
 INS_LOGIC_ID = os.path.join(PGDATA, "ins_logic_id")
@@ -146,30 +159,49 @@ SERVICE_TYPE_STANDBY_CODE = 7
 LOG_AGENT_DATA_DIR = "/home/pgsql/data"
 
 ALL_LIBRARY_PATHS = [
-    os.getenv("LD_LIBRARY_PATH", ""),
+    get_import_env("LD_LIBRARY_PATH", ""),
     os.path.join(PG_BASE_DIR, "lib"),
     os.path.join(PG_BASE_DIR, "lib/postgresql"),
 ]
 
 SECRET_ENV_KEYS = {"srv_opr_password", "password"}
 
-INITDB_SUPERUSER = os.environ.get("INITDB_SUPERUSER", "postgres")
+INITDB_SUPERUSER = get_import_env("INITDB_SUPERUSER", "postgres")
+
+# docker/init.sh, appended to /etc/bashrc of the engine image. The variables it
+# exports, e.g. MALLOC_CONF, are passed to the programs of pg_common.run_as_user
+INIT_SCRIPT = "/init.sh"
 
 ENGINE = "engine"
 MANAGER = "manager"
 STORAGE_TYPE_LOCAL = "local"
 STORAGE_TYPE_POLAR_STORE = "polarstore"
 STORAGE_TYPE_FC_SAN = "fcsan"
-
-RESTORE_DOWNLOADS_DIR = os.getenv(
+PFSD_PROCESS_NAME = "pfsdaemon"
+# seconds to wait for pfsdaemon before starting anyway, checked at an interval
+# doubling from PFSD_READY_MIN_INTERVAL to PFSD_READY_MAX_INTERVAL
+PFSD_READY_TIMEOUT = 40
+PFSD_READY_MIN_INTERVAL = 0.05
+PFSD_READY_MAX_INTERVAL = 2
+# seconds a pfs stat of the disk may take to tell whether pfsdaemon serves it
+PFSD_PROBE_TIMEOUT = 10
+
+RESTORE_DOWNLOADS_DIR = get_import_env(
     "RESTORE_DOWNLOADS_DIR", "/home/pgsql/restore/downloads"
 )
-RESTORE_JOB_STATUS = os.getenv("RESTORE_JOB_STATUS", "/home/pgsql/restore/status")
-RESTORE_JOB_WORKER = os.getenv("RESTORE_JOB_WORKER", "/home/pgsql/restore/worker")
-RESTORE_JOB_LOG = os.getenv("RESTORE_JOB_LOG", "/home/pgsql/restore/log")
+RESTORE_JOB_STATUS = get_import_env("RESTORE_JOB_STATUS", "/home/pgsql/restore/status")
+RESTORE_JOB_WORKER = get_import_env("RESTORE_JOB_WORKER", "/home/pgsql/restore/worker")
+RESTORE_JOB_LOG = get_import_env("RESTORE_JOB_LOG", "/home/pgsql/restore/log")
 
 HUGETLB_SHM_GROUP = "root"
 PG_LOCK_FILE = "postmaster.pid"
+# the states of a postmaster read from its postmaster.pid, see pg_ctl.get_postgres_state
+POSTGRES_STOPPED = "stopped"
+POSTGRES_STARTING = "starting"
+POSTGRES_READY = "ready"
+POSTGRES_STOPPING = "stopping"
+POSTGRES_STALE_PID = "stale_pid"
+POSTGRES_RUNNING_STATES = (POSTGRES_STARTING, POSTGRES_READY, POSTGRES_STOPPING)
 DEFAULT_TDE_FUNCTION_OPT = "-e aes-256"
 DEFAULT_TDE_CLUSTER_COMMAND_PREFIX = "python /scripts/tde_get_plain_dk.py"
 DEFAULT_TDE_SCRIPT = "/scripts/tde_get_plain_dk.py"
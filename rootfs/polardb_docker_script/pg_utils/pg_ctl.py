@@ -17,33 +17,140 @@
 pg ctl run
 """
 
+import errno
+import os
+import shlex
+from collections import namedtuple
+
 from pg_utils.logger import logger
-from pg_utils.pg_common import exec_command
-from pg_utils.pg_const import RELOAD_LOG
+from pg_utils.pg_common import run_as_user
+from pg_utils.pg_const import (
+    PG_LOCK_FILE,
+    POSTGRES_READY,
+    POSTGRES_RUNNING_STATES,
+    POSTGRES_STALE_PID,
+    POSTGRES_STARTING,
+    POSTGRES_STOPPED,
+    POSTGRES_STOPPING,
+    RELOAD_LOG,
+)
 
+# lines of postmaster.pid, see LOCK_FILE_LINE_* of miscadmin.h
+LOCK_FILE_LINE_PID = 1
+LOCK_FILE_LINE_START_TIME = 3
+LOCK_FILE_LINE_PORT = 4
+LOCK_FILE_LINE_PM_STATUS = 8
+# a standby postmaster does not accept connections yet
+PM_STATUS_STATES = {
+    "starting": POSTGRES_STARTING,
+    "standby": POSTGRES_STARTING,
+    "ready": POSTGRES_READY,
+    "stopping": POSTGRES_STOPPING,
+}
+# seconds between the start of the postmaster and the start time it writes
+POSTMASTER_START_TIME_TOLERANCE = 5
 
-def check_postgres_is_running(pg_user, pg_bin_dir, pg_data, time_out=300):
-    pg_ctl_cmd = "%s/pg_ctl status -D %s" % (pg_bin_dir, pg_data)
-    cmd = 'su -l %s -c "%s"' % (pg_user, pg_ctl_cmd)
-    logger.info("Run pg_ctl cmd: %s", cmd)
-    status, stdout = exec_command(cmd, time_out)
-    if status == 0:
-        return True
+PostgresStatus = namedtuple("PostgresStatus", ["state", "pid", "port"])
+
+boot_time = None
+
+
+def get_boot_time():
+    global boot_time
+    if boot_time is None:
+        with open("/proc/stat") as f:
+            for line in f:
+                if line.startswith("btime "):
+                    boot_time = int(line.split()[1])
+                    break
+    return boot_time
+
+
+def get_process_start_time(pid):
+    """The start time of a process in seconds since the epoch."""
+    with open("/proc/%d/stat" % pid) as f:
+        stat = f.read()
+    # the command name in parentheses may contain spaces, starttime is the 22nd field
+    fields = stat[stat.rindex(")") + 2 :].split()
+    return get_boot_time() + float(fields[19]) / os.sysconf("SC_CLK_TCK")
+
+
+def is_postmaster(pid, start_time=None):
+    """
+    Whether pid is a live postgres process which started at start_time, not a
+    process which got the pid of a postmaster which is gone.
+    """
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        if e.errno != errno.EPERM:
+            return False
+    try:
+        with open("/proc/%d/cmdline" % pid, "rb") as f:
+            if b"postgres" not in f.read():
+                return False
+        if start_time is not None:
+            started = get_process_start_time(pid)
+            if abs(started - start_time) > POSTMASTER_START_TIME_TOLERANCE:
+                return False
+    except (IOError, OSError):
+        # the process exited meanwhile
+        return False
+    return True
 
-    return False
+
+def get_postgres_state(pg_data):
+    """
+    The state of the postmaster of pg_data read from its postmaster.pid, without
+    running pg_ctl status: stopped without the file, stale_pid if the process
+    in it is gone, else starting, ready or stopping by its status line.
+    """
+    try:
+        with open(os.path.join(pg_data, PG_LOCK_FILE)) as f:
+            lines = f.read().splitlines()
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return PostgresStatus(POSTGRES_STOPPED, None, None)
+        raise
+
+    def get_line(number):
+        if len(lines) < number:
+            return ""
+        return lines[number - 1].strip()
+
+    try:
+        # a single user backend writes its pid negated
+        pid = abs(int(get_line(LOCK_FILE_LINE_PID)))
+    except ValueError:
+        # pg_ctl status also takes an invalid file for a stopped server
+        return PostgresStatus(POSTGRES_STALE_PID, None, None)
+    start_time = get_line(LOCK_FILE_LINE_START_TIME)
+    port = get_line(LOCK_FILE_LINE_PORT)
+    port = int(port) if port.isdigit() else None
+
+    if not is_postmaster(pid, int(start_time) if start_time.isdigit() else None):
+        return PostgresStatus(POSTGRES_STALE_PID, pid, port)
+    state = PM_STATUS_STATES.get(get_line(LOCK_FILE_LINE_PM_STATUS), POSTGRES_STARTING)
+    return PostgresStatus(state, pid, port)
+
+
+def check_postgres_is_running(pg_user, pg_bin_dir, pg_data, time_out=300):
+    """pg_user, pg_bin_dir and time_out are of the former pg_ctl status call."""
+    return get_postgres_state(pg_data).state in POSTGRES_RUNNING_STATES
 
 
 def run_pgctl_cmd(pg_user, pg_bin_dir, pg_data, action, log, args="", time_out=300):
-    pg_ctl_cmd = "%s/pg_ctl %s -D %s -c -s -l %s %s" % (
-        pg_bin_dir,
+    pg_ctl_args = [
+        "%s/pg_ctl" % pg_bin_dir,
         action,
+        "-D",
         pg_data,
+        "-c",
+        "-s",
+        "-l",
         log,
-        args,
-    )
-    cmd = 'su -l %s -c "%s"' % (pg_user, pg_ctl_cmd)
-    logger.info("Run pg_ctl cmd: %s", cmd)
-    status, stdout = exec_command(cmd, time_out)
+    ] + shlex.split(args)
+    status, stdout = run_as_user(pg_user, pg_ctl_args, timeout=time_out)
     if status != 0:
         raise Exception("Run pg_ctl cmd error: %s" % stdout)
     else: